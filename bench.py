@@ -0,0 +1,443 @@
+"""
+Benchmarks every stage of the pipeline, and the chatbot, offline.
+
+    python bench.py run --out results.json
+    python bench.py compare baseline.json results.json
+
+`run` generates synthetic transcripts shaped like download_transcripts.py's
+output, then times:
+
+    chunkify    chunking them (in this process, one worker)
+    chunklines  turning the chunked files into chunk entries
+    embed       embeddingify.py against fake_openai.py, whose latency is set
+                with --api-latency
+    index       index.py loading the embeddings into a fresh Chroma, and
+                again with --incremental, when nothing has changed
+    chat        AquariumCoOpChatBot.chat over the embedded chunks, with
+                fake_openai.py as the LLM, a few turns per conversation
+    startup     chatbot.py --startup-report: how long until the prompt shows,
+                and until the chatbot is warmed up
+
+and writes the numbers as JSON. `compare` lists the differences between two
+runs and exits with status 1 if any metric got worse by more than
+--threshold. Throughputs (`*_per_sec`) should go up, times (`*_ms`,
+`*_seconds`) down; anything else is only shown.
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+
+import chunkify
+import chunklines
+import fake_openai
+import videos
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = (
+    "tank fish shrimp plants water filter substrate gravel algae snail guppy "
+    "betta tetra corydoras neocaridina pleco cichlid molly platy danio "
+    "easy green fertilizer root tabs java fern anubias moss driftwood heater "
+    "temperature ph hardness ammonia nitrite nitrate cycle feed flakes pellets "
+    "frozen bloodworms brine daphnia breeding fry eggs spawn quarantine "
+    "medication ich velvet fungus water change gallon light co2 aquascape"
+).split()
+
+QUESTIONS = [
+    "What do {0} eat?",
+    "How do I keep {0} with {1} in one tank?",
+    "What temperature do {0} need?",
+    "Why is my {0} covered in {1}?",
+]
+FOLLOW_UPS = [
+    "How often should I feed them?",
+    "And what about {0}?",
+    "Can they live with {0}?",
+    "What size tank do {0} need?",
+]
+
+
+def synthetic_video(i, lines, rng):
+    """A video as download_transcripts.py writes it, with a made-up transcript"""
+    video_id = f"bench{i:05d}"
+    transcript = []
+    start = 0.0
+    for _ in range(lines):
+        duration = round(rng.uniform(1.5, 5.0), 3)
+        words = rng.randint(4, 14)
+        transcript.append(
+            {
+                "text": " ".join(rng.choice(WORDS) for _ in range(words)),
+                "start": round(start, 3),
+                "duration": duration,
+            }
+        )
+        start += duration
+
+    thumbnail = f"https://i.ytimg.com/vi/{video_id}"
+    return {
+        "publishedAt": f"2023-01-{1 + i % 28:02d}T12:00:00Z",
+        "channelId": "UCbench",
+        "title": f"Benchmark video {i}: " + " ".join(rng.sample(WORDS, 5)),
+        # real descriptions run to a few paragraphs of links and sponsors
+        "description": " ".join(rng.choice(WORDS) for _ in range(200)),
+        "thumbnails": {
+            "default": {"url": f"{thumbnail}/default.jpg", "width": 120},
+            "high": {"url": f"{thumbnail}/hqdefault.jpg", "width": 480},
+            "maxres": {"url": f"{thumbnail}/maxresdefault.jpg", "width": 1280},
+        },
+        "channelTitle": "Aquarium Co-Op",
+        "playlistId": "UUbench",
+        "position": i,
+        "resourceId": {"kind": "youtube#video", "videoId": video_id},
+        "videoOwnerChannelTitle": "Aquarium Co-Op",
+        "videoOwnerChannelId": "UCbench",
+        "transcript": transcript,
+        "url": f"https://youtube.com/watch?v={video_id}",
+    }
+
+
+def _percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def bench_chunkify(transcripts_dir, chunked_dir):
+    paths = sorted(
+        os.path.join(transcripts_dir, name) for name in os.listdir(transcripts_dir)
+    )
+    started = time.perf_counter()
+    chunks = sum(chunkify.chunk_file(path, chunked_dir) for path in paths)
+    seconds = time.perf_counter() - started
+    return {
+        "videos": len(paths),
+        "chunks": chunks,
+        "seconds": seconds,
+        "videos_per_sec": len(paths) / seconds,
+        "chunks_per_sec": chunks / seconds,
+    }
+
+
+def bench_chunklines(chunked_dir, chunks_path, videos_path):
+    started = time.perf_counter()
+    chunklines.chunklines.callback(chunked_dir, chunks_path, videos_path)
+    seconds = time.perf_counter() - started
+    chunks = sum(1 for _ in open(chunks_path))
+    return {
+        "chunks": chunks,
+        "seconds": seconds,
+        "chunks_per_sec": chunks / seconds,
+        "chunks_bytes": os.path.getsize(chunks_path),
+    }
+
+
+def _run_script(args, workdir, api_base):
+    env = dict(os.environ, OPENAI_API_BASE=api_base)
+    env.setdefault("OPENAI_API_KEY", "bench")
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable] + args, cwd=workdir, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise click.ClickException(f"{' '.join(args)} failed:\n{result.stderr}")
+    return time.perf_counter() - started
+
+
+def bench_embed(workdir, chunks_path, embeddings_path, api_base):
+    seconds = _run_script(
+        [
+            os.path.join(HERE, "embeddingify.py"),
+            chunks_path,
+            embeddings_path,
+            "--cache",
+            os.path.join(workdir, "embedding-cache.db"),
+        ],
+        workdir,
+        api_base,
+    )
+    chunks = sum(1 for _ in open(chunks_path))
+    return {"chunks": chunks, "seconds": seconds, "chunks_per_sec": chunks / seconds}
+
+
+def bench_index(workdir, embeddings_path, api_base):
+    chunks = len(np.load(embeddings_path, mmap_mode="r"))
+    results = {"chunks": chunks}
+    for name, extra in (("full", []), ("incremental", ["--incremental"])):
+        # index.py writes to ./chroma.db
+        seconds = _run_script(
+            [os.path.join(HERE, "index.py"), embeddings_path] + extra,
+            workdir,
+            api_base,
+        )
+        results[f"{name}_seconds"] = seconds
+        results[f"{name}_chunks_per_sec"] = chunks / seconds
+    return results
+
+
+def bench_chat(embeddings_path, videos_path, api_base, conversations, turns, rng):
+    os.environ["OPENAI_API_BASE"] = api_base
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    import openai
+
+    from chat_backend import AquariumCoOpChatBot, ChatBackend
+
+    openai.api_base = api_base
+    backend = ChatBackend(embeddings_path, videos_path=videos_path)
+    # PromptLayer logs every call to an outside service; leave it out so the
+    # numbers only depend on this machine
+    backend.llm.callbacks = None
+    backend.condense_question_llm.callbacks = None
+
+    latencies = []
+    for _ in range(conversations):
+        chatbot = AquariumCoOpChatBot(backend=backend)
+        for turn in range(turns):
+            template = rng.choice(QUESTIONS if turn == 0 else FOLLOW_UPS)
+            question = template.format(*rng.sample(WORDS, 2))
+            started = time.perf_counter()
+            chatbot.chat(question)
+            latencies.append(time.perf_counter() - started)
+
+    condense = backend.condense_stats.as_dict()
+    return dict(
+        _percentiles(latencies),
+        questions=len(latencies),
+        condense_calls=condense["condense_calls"],
+    )
+
+
+def bench_startup(workdir, embeddings_path, videos_path, api_base):
+    env = dict(os.environ, OPENAI_API_BASE=api_base)
+    env.setdefault("OPENAI_API_KEY", "bench")
+    args = [
+        os.path.join(HERE, "chatbot.py"),
+        "--index",
+        embeddings_path,
+        "--videos",
+        videos_path,
+        "--history-db",
+        os.path.join(workdir, "chat-history.db"),
+        "--log-file",
+        os.path.join(workdir, "chatbot.log"),
+        "--startup-report",
+    ]
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable] + args,
+        cwd=workdir,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - started
+    if result.returncode != 0:
+        raise click.ClickException(f"chatbot.py failed:\n{result.stderr}")
+
+    # the milestones of the report, e.g. "startup:  141.3 | 0.0 | -- prompt --"
+    marks = {}
+    for line in result.stdout.splitlines():
+        if line.startswith("startup:") and line.endswith("--"):
+            at, _, name = line[len("startup:") :].split("|")
+            marks[name.strip(" -")] = float(at) / 1000
+    return {
+        "prompt_seconds": marks["prompt"],
+        "warm_seconds": marks["warm"],
+        "process_seconds": seconds,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--out", "out_path", default="bench-results.json")
+@click.option("--videos", "num_videos", default=50)
+@click.option("--lines", default=200, help="Transcript lines per video.")
+@click.option("--api-latency", default=0.05, help="Seconds the fake API waits.")
+@click.option(
+    "--token-latency", default=0.005, help="Seconds between fake streamed tokens."
+)
+@click.option("--conversations", default=10)
+@click.option("--turns", default=3, help="Questions per conversation.")
+@click.option("--seed", default=0)
+@click.option("--workdir", default=None, help="Keep the generated files here.")
+def run(
+    out_path,
+    num_videos,
+    lines,
+    api_latency,
+    token_latency,
+    conversations,
+    turns,
+    seed,
+    workdir,
+):
+    """Run every benchmark and write the results to --out."""
+    keep = workdir is not None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="bench-"))
+    transcripts_dir = os.path.join(workdir, "transcripts")
+    chunked_dir = os.path.join(workdir, "chunked")
+    chunks_path = os.path.join(workdir, "chunks.jsonl")
+    embeddings_path = os.path.join(workdir, "embeddings.npy")
+    videos_path = os.path.join(workdir, videos.DEFAULT_PATH)
+    os.makedirs(transcripts_dir, exist_ok=True)
+    os.makedirs(chunked_dir, exist_ok=True)
+
+    server = fake_openai.make_server(
+        port=0, latency=api_latency, token_latency=token_latency
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    rng = random.Random(seed)
+    for i in range(num_videos):
+        video = synthetic_video(i, lines, rng)
+        path = os.path.join(transcripts_dir, f"{video['resourceId']['videoId']}.json")
+        with open(path, "w") as f:
+            json.dump(video, f)
+
+    results = {}
+    try:
+        stages = [
+            ("chunkify", lambda: bench_chunkify(transcripts_dir, chunked_dir)),
+            (
+                "chunklines",
+                lambda: bench_chunklines(chunked_dir, chunks_path, videos_path),
+            ),
+            (
+                "embed",
+                lambda: bench_embed(workdir, chunks_path, embeddings_path, api_base),
+            ),
+            ("index", lambda: bench_index(workdir, embeddings_path, api_base)),
+            (
+                "chat",
+                lambda: bench_chat(
+                    embeddings_path,
+                    videos_path,
+                    api_base,
+                    conversations,
+                    turns,
+                    rng,
+                ),
+            ),
+            (
+                "startup",
+                lambda: bench_startup(workdir, embeddings_path, videos_path, api_base),
+            ),
+        ]
+        for name, stage in stages:
+            click.echo(f"{name}...", err=True)
+            results[name] = stage()
+    finally:
+        server.shutdown()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "params": {
+            "videos": num_videos,
+            "lines": lines,
+            "api_latency": api_latency,
+            "token_latency": token_latency,
+            "conversations": conversations,
+            "turns": turns,
+            "seed": seed,
+        },
+        "results": results,
+    }
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, metrics in results.items():
+        shown = ", ".join(
+            f"{metric} {value:.1f}" if isinstance(value, float) else f"{metric} {value}"
+            for metric, value in metrics.items()
+        )
+        print(f"{name}: {shown}")
+
+
+def _direction(metric):
+    """1 if higher is better, -1 if lower is, 0 if it's just informational"""
+    if metric.endswith("_per_sec"):
+        return 1
+    if metric.endswith(("_ms", "_seconds")) or metric == "seconds":
+        return -1
+    return 0
+
+
+@cli.command()
+@click.argument("baseline_path")
+@click.argument("results_path")
+@click.option(
+    "--threshold",
+    default=0.10,
+    help="Relative change past which a metric getting worse is a regression.",
+)
+def compare(baseline_path, results_path, threshold):
+    """Compare two runs, failing if anything regressed."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(results_path) as f:
+        current = json.load(f)
+
+    if baseline["params"] != current["params"]:
+        print("warning: the runs used different parameters")
+
+    regressions = []
+    for stage, metrics in current["results"].items():
+        for metric, value in metrics.items():
+            old = baseline["results"].get(stage, {}).get(metric)
+            if old is None or not old:
+                continue
+            change = (value - old) / old
+            worse = -change * _direction(metric)
+            flag = ""
+            if _direction(metric) and worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append(f"{stage}.{metric}")
+            elif _direction(metric) and -worse > threshold:
+                flag = "  improved"
+            print(f"{stage}.{metric}: {old:.4g} -> {value:.4g} ({change:+.1%}){flag}")
+
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,369 @@
+"""
+The chatbot itself: ChatBackend (the index, caches and LLM clients) and
+AquariumCoOpChatBot (one conversation). chatbot.py is its command line, and
+server.py serves it.
+"""
+
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from langchain.vectorstores import Chroma
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.chat_models import ChatOpenAI
+from langchain.chains import ConversationalRetrievalChain
+from langchain.document_loaders import TextLoader
+from langchain.memory import ChatMessageHistory, ConversationBufferMemory
+from langchain.callbacks import PromptLayerCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+from langchain.prompts import (
+    ChatPromptTemplate,
+    PromptTemplate,
+    SystemMessagePromptTemplate,
+    AIMessagePromptTemplate,
+    HumanMessagePromptTemplate,
+)
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+
+from condense import CondenseStats, CondensingRetrievalChain
+from context_packing import PackingRetriever
+from defaults import (
+    CONDENSE_MODEL,
+    CONTEXT_TOKEN_BUDGET,
+    MEMORY_TOKEN_LIMIT,
+)
+from lexicalsearch import HybridRetriever, LexicalIndex, LexicalRetriever
+from memory import ConversationWithSourcesTokenBufferMemory
+import videos
+from query_cache import CachedEmbeddings, CachingRetriever, QueryCache, index_version
+from tracing import Tracer
+from vectorsearch import MmapRetriever, VectorIndex
+
+PERSONALITY_PROMPT = f"""Your name is Corydora. You are a hyper-intelligent AI fishkeeping sidekick. You are here to help people with their fishkeeping questions.
+
+You have been trained with entire corpus of the Aquarium Co-Op YouTube channel transcripts. You have watched every video, and read every comment.
+
+All of your responses should be in the voice and tone of Cory Mcelroy, the owner of Aquarium Co-Op.
+"""
+
+SYSTEM_PROMPT = r""" 
+Use the following pieces of context to answer the users question. 
+If you don't know the answer, just say that you are unsure, but then try to answer anyway.
+----
+{context}
+----
+Question: {question}
+"""
+GENERIC_QUESTION_PROMPT = "Question:```{question}```"
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class _TokenQueueHandler(BaseCallbackHandler):
+    """Forwards the tokens of streaming LLM calls to a queue"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.put(token)
+
+
+class _AsyncTokenHandler(AsyncCallbackHandler):
+    """Awaits `on_token(token)` for each token of streaming LLM calls"""
+
+    def __init__(self, on_token):
+        self.on_token = on_token
+
+    async def on_llm_new_token(self, token, **kwargs):
+        await self.on_token(token)
+
+
+class ChatStream:
+    """
+    The answer to a question, as it's being generated. Iterating over it
+    yields the answer's tokens as they arrive; once it's exhausted, `answer`,
+    `related_videos`, `time_to_first_token` and `total_time` are set.
+    """
+
+    def __init__(self, chatbot, question):
+        self.question = question
+        self.answer = None
+        self.related_videos = None
+        self.time_to_first_token = None
+        self.total_time = None
+
+        self._chatbot = chatbot
+        self._tokens = queue.Queue()
+        self._error = None
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with self._chatbot.backend.tracer.turn() as tracing:
+                resp = self._chatbot.convo_chain(
+                    {"question": self.question},
+                    callbacks=[_TokenQueueHandler(self._tokens), tracing],
+                )
+            self.answer = resp["answer"]
+            self.related_videos = self._chatbot.parse_related_videos(
+                resp["source_documents"]
+            )
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._tokens.put(_DONE)
+
+    def __iter__(self):
+        while True:
+            token = self._tokens.get()
+            if token is _DONE:
+                break
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - self._started
+                logger.info("time to first token: %.3fs", self.time_to_first_token)
+            yield token
+
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+        self.total_time = time.perf_counter() - self._started
+        logger.info("total answer time: %.3fs", self.total_time)
+
+
+class ChatBackend:
+    """
+    Everything a conversation needs apart from its memory: the index, the
+    query caches and the LLM clients. A server shares one between all of its
+    sessions.
+    """
+
+    def __init__(
+        self,
+        index_path=None,
+        context_tokens=CONTEXT_TOKEN_BUDGET,
+        condense_mode="auto",
+        condense_model=CONDENSE_MODEL,
+        lexical_path=None,
+        retrieval="vector",
+        videos_path=videos.DEFAULT_PATH,
+        trace_path=None,
+        metrics_path=None,
+    ):
+        """
+        Args:
+            index_path: A .npy embedding matrix to search in-process (see
+                vectorsearch.py). Defaults to the Chroma collection.
+            context_tokens: Token budget for the retrieved chunks in the
+                prompt, after merging neighbouring chunks (see
+                context_packing.py).
+            condense_mode: When follow-up questions are rewritten into
+                standalone ones before retrieval, one of CONDENSE_MODES (see
+                condense.py).
+            condense_model: The model that rewrites them, and summarizes
+                the history if asked to.
+            lexical_path: A BM25 index of the chunks (see lexicalsearch.py).
+            retrieval: One of RETRIEVAL_MODES: search by embedding, by
+                keyword in the lexical index (no embedding request), or both
+                with their results fused.
+            videos_path: The video table that chunks' video ids are looked
+                up in (see videos.py).
+            trace_path: A JSONL file each turn's trace is appended to (see
+                tracing.py).
+            metrics_path: A file the Prometheus metrics of the traces are
+                written to after each turn.
+        """
+        if retrieval != "vector" and lexical_path is None:
+            raise ValueError(f"{retrieval} retrieval needs a lexical index")
+
+        # Repeated questions skip the embedding request and the search, until
+        # the index is rebuilt
+        self.index_path = index_path
+        self.lexical_path = lexical_path
+        self.retrieval = retrieval
+        self.videos_path = videos_path
+        self.videos = videos.VideoTable(videos_path)
+        # a refresh adds the videos of the chunks it indexes to the table,
+        # which is reloaded along with the index
+        self.query_cache = QueryCache(
+            lambda: (
+                index_version(index_path or "./chroma.db"),
+                index_version(lexical_path) if lexical_path is not None else None,
+                index_version(videos_path),
+            ),
+            on_change=self._reopen_index,
+        )
+        self.embeddings = CachedEmbeddings(OpenAIEmbeddings(), self.query_cache)
+        self.retriever = CachingRetriever(
+            retriever=self._open_retriever(), cache=self.query_cache
+        )
+        self.context_retriever = PackingRetriever(
+            retriever=self.retriever, max_tokens=context_tokens
+        )
+
+        messages = [
+            SystemMessagePromptTemplate.from_template(PERSONALITY_PROMPT),
+            SystemMessagePromptTemplate.from_template(SYSTEM_PROMPT),
+        ]
+        self.system_prompt = ChatPromptTemplate.from_messages(messages)
+
+        # Only the answer is streamed, the condensed question isn't shown. The
+        # tags name the calls' spans in traces.
+        self.llm = ChatOpenAI(
+            model_name="gpt-3.5-turbo-16k",
+            temperature=0,
+            streaming=True,
+            callbacks=[PromptLayerCallbackHandler(pl_tags=["langchain"])],
+            tags=["generate"],
+        )
+        self.condense_question_llm = ChatOpenAI(
+            model_name=condense_model,
+            temperature=0,
+            callbacks=[PromptLayerCallbackHandler(pl_tags=["langchain"])],
+            tags=["condense"],
+        )
+        self.condense_mode = condense_mode
+        self.condense_stats = CondenseStats()
+        self.tracer = Tracer(trace_path, metrics_path)
+
+    def _open_retriever(self):
+        if self.retrieval == "vector":
+            return self._open_vector_retriever()
+
+        lexical = LexicalRetriever(index=LexicalIndex(self.lexical_path), k=25)
+        if self.retrieval == "lexical":
+            self.chromadb = None
+            return lexical
+        return HybridRetriever(
+            retriever=self._open_vector_retriever(), lexical=lexical, k=25
+        )
+
+    def _open_vector_retriever(self):
+        if self.index_path is not None:
+            self.chromadb = None
+            return MmapRetriever(
+                index=VectorIndex(self.index_path), embeddings=self.embeddings, k=25
+            )
+
+        self.chromadb = Chroma(
+            persist_directory="./chroma.db",
+            collection_name="aquarium-co-op-youtube",
+            embedding_function=self.embeddings,
+        )
+        return self.chromadb.as_retriever(search_kwargs={"k": 25})
+
+    def _reopen_index(self):
+        self.retriever.retriever = self._open_retriever()
+        self.videos = videos.VideoTable(self.videos_path)
+
+
+# TODO:
+# * add the ability to chat
+class AquariumCoOpChatBot:
+    def __init__(
+        self,
+        index_path=None,
+        backend=None,
+        memory_tokens=MEMORY_TOKEN_LIMIT,
+        summarize_history=False,
+        history=None,
+    ):
+        """
+        Args:
+            index_path: A .npy embedding matrix to search in-process (see
+                vectorsearch.py). Defaults to the Chroma collection.
+            backend: A ChatBackend to share with other conversations, instead
+                of opening a new one on `index_path`.
+            memory_tokens: How much of the conversation, in tokens, is given
+                to the LLM with each question.
+            summarize_history: Keep a summary of the conversation that no
+                longer fits in `memory_tokens`.
+            history: Where the conversation is kept, e.g. a
+                SQLiteChatMessageHistory to resume it later. Defaults to
+                memory.
+        """
+        self.backend = backend if backend is not None else ChatBackend(index_path)
+
+        # The chain reads the chat history from here and saves each turn to it
+        self.memory = ConversationWithSourcesTokenBufferMemory(
+            memory_key="chat_history",
+            return_messages=True,
+            max_token_limit=memory_tokens,
+            llm=self.backend.condense_question_llm if summarize_history else None,
+            chat_memory=history if history is not None else ChatMessageHistory(),
+        )
+
+        self.query_cache = self.backend.query_cache
+
+        self.convo_chain = CondensingRetrievalChain.from_llm(
+            llm=self.backend.llm,
+            condense_question_llm=self.backend.condense_question_llm,
+            retriever=self.backend.context_retriever,
+            memory=self.memory,
+            return_source_documents=True,
+            combine_docs_chain_kwargs={"prompt": self.backend.system_prompt},
+            condense_mode=self.backend.condense_mode,
+            condense_stats=self.backend.condense_stats,
+        )
+        # pydantic gives the chain its own copy of the memory
+        self.memory = self.convo_chain.memory
+
+    def parse_related_videos(self, source_documents, limit=5):
+        video_data = []
+        for doc in source_documents:
+            metadata = doc.metadata
+            # chunks indexed before the video table existed carry their
+            # video's metadata themselves
+            video = self.backend.videos.get(metadata["video_id"], metadata)
+            if "url" not in video:
+                # indexed, but not in the table (yet): nothing to link to
+                logger.warning(
+                    "video %s is not in the video table", metadata["video_id"]
+                )
+                continue
+            video_data.append(
+                {
+                    "url": f"{video['url']}?t={metadata['start']}",
+                    "title": video["title"],
+                    "thumbnail": video["thumbnail"],
+                    "publishedAt": datetime.fromisoformat(
+                        video["publishedAt"].rstrip("Z")
+                    ),
+                }
+            )
+        return video_data[:limit]
+
+    def chat(self, question):
+        with self.backend.tracer.turn() as tracing:
+            resp = self.convo_chain({"question": question}, callbacks=[tracing])
+        related_videos = self.parse_related_videos(resp["source_documents"])
+        return resp["answer"], related_videos
+
+    async def achat(self, question, on_token=None):
+        """
+        Async version of `chat`. If given, `on_token(token)` is awaited for
+        each token of the answer as it's generated.
+        """
+        callbacks = [_AsyncTokenHandler(on_token)] if on_token is not None else []
+        # the memory would otherwise load the history and summarize it with
+        # blocking calls
+        await self.memory.aload()
+        with self.backend.tracer.turn() as tracing:
+            resp = await self.convo_chain.acall(
+                {"question": question}, callbacks=callbacks + [tracing]
+            )
+        related_videos = self.parse_related_videos(resp["source_documents"])
+        return resp["answer"], related_videos
+
+    def chat_stream(self, question):
+        """Like `chat`, but returns a ChatStream of the answer's tokens."""
+        return ChatStream(self, question)
@@ -1,111 +1,154 @@
+"""
+Corydora's command line.
+
+    python chatbot.py [--index index.npy] [--session SESSION_ID]
+
+Only click and prompt_toolkit are imported before the banner and the prompt
+are shown. langchain, the index, the embedding client and the chain take
+seconds to load, so they're loaded on a background thread meanwhile (see
+WarmUp), and the first question only waits for what isn't loaded yet. A
+resumed conversation (--session) waits for it before the prompt, to show
+where the conversation left off.
+
+Each startup step is timed and logged; --startup-report prints them, import
+by import, in the style of `python -X importtime`, and exits at the prompt:
+
+    python chatbot.py --startup-report
+"""
+
+import time
+
+# as early as possible, so the report covers this module's own imports
+STARTED = time.perf_counter()
+
+import importlib
+import logging
 import signal
 import sys
-from datetime import datetime
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 
-from langchain.vectorstores import Chroma
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import ConversationalRetrievalChain
-from langchain.document_loaders import TextLoader
-from langchain.memory import ConversationBufferMemory
-from langchain.callbacks import PromptLayerCallbackHandler
-from langchain.prompts import (
-    ChatPromptTemplate,
-    PromptTemplate,
-    SystemMessagePromptTemplate,
-    AIMessagePromptTemplate,
-    HumanMessagePromptTemplate,
+import click
+from prompt_toolkit import Application, HTML, print_formatted_text, PromptSession
+from prompt_toolkit.formatted_text import FormattedText
+from prompt_toolkit.key_binding import KeyBindings
+from prompt_toolkit.styles import Style
+
+from defaults import (
+    CONDENSE_MODEL,
+    CONDENSE_MODES,
+    CONTEXT_TOKEN_BUDGET,
+    HISTORY_PATH,
+    MEMORY_TOKEN_LIMIT,
+    RETRIEVAL_MODES,
+    VIDEOS_PATH,
 )
-from langchain.schema import AIMessage, HumanMessage, SystemMessage
 
+# Imported on the warm-up thread, in this order, each timed on its own.
+# Importing any part of langchain imports nearly all of it.
+HEAVY_IMPORTS = ("langchain", "tiktoken", "chat_backend")
 
-from memory import ConversationWithSourcesBufferMemory
+logger = logging.getLogger(__name__)
 
-PERSONALITY_PROMPT = f"""Your name is Corydora. You are a hyper-intelligent AI fishkeeping sidekick. You are here to help people with their fishkeeping questions.
 
-You have been trained with entire corpus of the Aquarium Co-Op YouTube channel transcripts. You have watched every video, and read every comment.
+class StartupTimer:
+    """The steps of startup, on any thread, timed from STARTED"""
 
-All of your responses should be in the voice and tone of Cory Mcelroy, the owner of Aquarium Co-Op.
-"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = [
+            ("imports (click, prompt_toolkit)", 0.0, time.perf_counter() - STARTED)
+        ]
+        self.marks = {}
 
-SYSTEM_PROMPT = r""" 
-Use the following pieces of context to answer the users question. 
-If you don't know the answer, just say that you are unsure, but then try to answer anyway.
-----
-{context}
-----
-Question: {question}
-"""
-GENERIC_QUESTION_PROMPT = "Question:```{question}```"
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            ended = time.perf_counter()
+            with self.lock:
+                self.steps.append((name, started - STARTED, ended - started))
 
+    def mark(self, name):
+        """Notes when a milestone (e.g. "prompt") was reached"""
+        self.marks[name] = time.perf_counter() - STARTED
 
-# TODO:
-# * add the ability to chat
-# * add the ability to load a chat from a file
-# * add the ability to save a chat to a file
-# * could be interesting to have an abstract class for writing to chat history, then you could write to a db, sqlite, or whatever...
-class AquariumCoOpChatBot:
-    def __init__(self):
-        # Create an empty list where we can store the chat history.
-        self.chat_history = []
+    def summary(self):
+        return ", ".join(f"{name} at {at:.3f}s" for name, at in self.marks.items())
 
-        self.memory = ConversationWithSourcesBufferMemory(
-            memory_key="chat_history", return_messages=True
-        )
+    def report(self):
+        lines = ["startup:    at ms |  self ms | step"]
+        events = [(at, seconds, name) for name, at, seconds in self.steps]
+        events += [(at, 0.0, f"-- {name} --") for name, at in self.marks.items()]
+        for at, seconds, name in sorted(events):
+            lines.append(f"startup: {at * 1000:8.1f} | {seconds * 1000:8.1f} | {name}")
+        return "\n".join(lines)
 
-        self.chromadb = Chroma(
-            persist_directory="./chroma.db",
-            collection_name="aquarium-co-op-youtube",
-            embedding_function=OpenAIEmbeddings(),
-        )
-        messages = [
-            SystemMessagePromptTemplate.from_template(PERSONALITY_PROMPT),
-            SystemMessagePromptTemplate.from_template(SYSTEM_PROMPT),
-        ]
-        system_prompt = ChatPromptTemplate.from_messages(messages)
-
-        self.convo_chain = ConversationalRetrievalChain.from_llm(
-            llm=ChatOpenAI(
-                model_name="gpt-3.5-turbo-16k",
-                temperature=0,
-                callbacks=[PromptLayerCallbackHandler(pl_tags=["langchain"])],
-            ),
-            retriever=self.chromadb.as_retriever(search_kwargs={"k": 25}),
-            memory=self.memory,
-            return_source_documents=True,
-            combine_docs_chain_kwargs={"prompt": system_prompt},
-        )
 
-    def parse_related_videos(self, source_documents, limit=5):
-        video_data = []
-        for doc in source_documents:
-            metadata = doc.metadata
-            video_data.append(
-                {
-                    "url": f"{metadata['url']}?t={metadata['start']}",
-                    "title": metadata["title"],
-                    "thumbnail": metadata["thumbnail"],
-                    "publishedAt": datetime.fromisoformat(
-                        metadata["publishedAt"].rstrip("Z")
-                    ),
-                }
-            )
-        return video_data[:limit]
+class WarmUp:
+    """
+    Runs `load(timer)` on a background thread; `result()` waits for what it
+    returns, or raises what it raised.
+    """
 
-    def chat(self, question):
-        query = {"question": question, "chat_history": self.chat_history}
-        resp = self.convo_chain(query)
+    def __init__(self, load, timer):
+        self.timer = timer
+        self.future = Future()
+        threading.Thread(
+            target=self._run, args=(load,), name="warm-up", daemon=True
+        ).start()
 
-        self.chat_history.append((question, resp["answer"]))
+    def _run(self, load):
+        try:
+            self.future.set_result(load(self.timer))
+        except BaseException as e:
+            self.future.set_exception(e)
+        finally:
+            self.timer.mark("warm")
+            logger.info("startup: %s", self.timer.summary())
 
-        related_videos = self.parse_related_videos(resp["source_documents"])
-        return resp["answer"], related_videos
+    def done(self):
+        return self.future.done()
 
+    def result(self):
+        return self.future.result()
+
+
+def load_chatbot(
+    timer, backend_kwargs, memory_tokens, summarize_history, history_db, session_id
+):
+    """Imports everything the chatbot needs and opens it, a step at a time"""
+    global chatbot
+    imports = HEAVY_IMPORTS
+    if backend_kwargs["index_path"] is None:
+        imports += ("chromadb",)
+    for name in imports:
+        with timer.step(f"import {name}"):
+            importlib.import_module(name)
+    from chat_backend import AquariumCoOpChatBot, ChatBackend
+    import sqlite_history
+
+    with timer.step("open history"):
+        store = sqlite_history.HistoryStore(history_db)
+        if session_id is None:
+            session_id = sqlite_history.new_session_id()
+        elif not store.call(store.exists, session_id).result():
+            raise click.BadParameter(f"no conversation {session_id} in {history_db}")
+        history = sqlite_history.SQLiteChatMessageHistory(store, session_id)
+    with timer.step("open index, embedding and LLM clients"):
+        backend = ChatBackend(**backend_kwargs)
+    with timer.step("build chain"):
+        chatbot = AquariumCoOpChatBot(
+            backend=backend,
+            memory_tokens=memory_tokens,
+            summarize_history=summarize_history,
+            history=history,
+        )
+    return chatbot
 
-from prompt_toolkit import Application, HTML, print_formatted_text, PromptSession
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.styles import Style
 
 banner = """
  _____                 _           _____         _____     
@@ -126,7 +169,7 @@ style = Style.from_dict(
 )
 
 
-def main():
+def main(warm_up, resumed, startup_report=False):
     print_formatted_text(HTML("<banner>{}</banner>".format(banner)), style=style)
     print_formatted_text(
         HTML(
@@ -135,35 +178,220 @@ def main():
         style=style,
     )
 
+    # show where a resumed conversation left off
+    if resumed:
+        for message in warm_up.result().memory.chat_memory.messages[-2:]:
+            speaker = "CORYDORA>" if message.type == "ai" else "HUMAN>"
+            print_formatted_text(
+                FormattedText([("class:thinking", f"{speaker} {message.content}\n")]),
+                style=style,
+            )
+
     session = PromptSession()
+    warm_up.timer.mark("prompt")
+    if startup_report:
+        warm_up.result()
+        print(warm_up.timer.report())
+        return
 
     while True:
         user_input = session.prompt(
             HTML("<humanprompt>HUMAN> </humanprompt>"), style=style
         )
-        resp = chatbot.chat(user_input)
-
         print_formatted_text(
-            HTML(
-                f"<botprompt>CORYDORA> </botprompt><response>{resp[0]}</response>\n",
-            ),
-            style=style,
+            HTML("<botprompt>CORYDORA> </botprompt>"), style=style, end=""
         )
+        if not warm_up.done():
+            print_formatted_text(
+                HTML("<thinking>(waking up...) </thinking>"), style=style, end=""
+            )
+        stream = warm_up.result().chat_stream(user_input)
+        for token in stream:
+            # tokens are printed as plain text, they may contain markup
+            print_formatted_text(
+                FormattedText([("class:response", token)]),
+                style=style,
+                end="",
+                flush=True,
+            )
+        print_formatted_text("\n")
+
+        for video in stream.related_videos:
+            print_formatted_text(
+                FormattedText(
+                    [("class:thinking", f"  * {video['title']} - {video['url']}")]
+                ),
+                style=style,
+            )
+        print_formatted_text("")
+
+
+def __getattr__(name):
+    # the chatbot's classes used to live here, and scripts import them from here
+    return getattr(importlib.import_module("chat_backend"), name)
 
 
 def signal_handler(sig, frame):
+    if "chatbot" in globals():
+        print(chatbot.query_cache.stats_line())
+        print(chatbot.backend.condense_stats.stats_line())
+        chatbot.backend.tracer.close()
+        history = chatbot.memory.chat_memory
+        history.store.close()
+        print(f"Resume this conversation with --session {history.session_id}")
     print("exiting")
     sys.exit(0)
 
 
 signal.signal(signal.SIGINT, signal_handler)
 
+
+@click.command()
+@click.option(
+    "--index",
+    "index_path",
+    default=None,
+    help="Search this .npy embedding matrix in-process instead of Chroma.",
+)
+@click.option(
+    "--lexical-index",
+    "lexical_path",
+    default=None,
+    help="BM25 index of the chunks, built with lexicalsearch.py.",
+)
+@click.option(
+    "--retrieval",
+    type=click.Choice(RETRIEVAL_MODES),
+    default="vector",
+    help="Search by embedding, by keyword (needs --lexical-index), or both.",
+)
+@click.option(
+    "--videos",
+    "videos_path",
+    default=VIDEOS_PATH,
+    help="Video table the related videos are looked up in.",
+)
+@click.option(
+    "--log-file",
+    default="chatbot.log",
+    help="Where answer latencies (time to first token, total) are logged.",
+)
+@click.option(
+    "--context-tokens",
+    default=CONTEXT_TOKEN_BUDGET,
+    help="Token budget for the retrieved transcript excerpts in the prompt.",
+)
+@click.option(
+    "--memory-tokens",
+    default=MEMORY_TOKEN_LIMIT,
+    help="How much of the conversation, in tokens, goes with each question.",
+)
+@click.option(
+    "--summarize-history",
+    is_flag=True,
+    help="Summarize the part of the conversation that no longer fits.",
+)
+@click.option(
+    "--condense",
+    "condense_mode",
+    type=click.Choice(CONDENSE_MODES),
+    default="auto",
+    help="When to rewrite follow-up questions before retrieval (see condense.py).",
+)
+@click.option(
+    "--condense-model",
+    default=CONDENSE_MODEL,
+    help="Model that rewrites follow-up questions.",
+)
+@click.option(
+    "--trace-file",
+    "trace_path",
+    default=None,
+    help="Append a trace of each turn's stages to this JSONL file.",
+)
+@click.option(
+    "--metrics-file",
+    "metrics_path",
+    default=None,
+    help="Write Prometheus metrics of the traces to this file after each turn.",
+)
+@click.option(
+    "--history-db",
+    default=HISTORY_PATH,
+    help="SQLite database conversations are saved to.",
+)
+@click.option(
+    "--session",
+    "session_id",
+    default=None,
+    help="Resume the conversation with this id.",
+)
+@click.option(
+    "--startup-report",
+    is_flag=True,
+    help="Print how long each step of startup took, then exit.",
+)
+def cli(
+    index_path,
+    lexical_path,
+    retrieval,
+    videos_path,
+    log_file,
+    context_tokens,
+    memory_tokens,
+    summarize_history,
+    condense_mode,
+    condense_model,
+    trace_path,
+    metrics_path,
+    history_db,
+    session_id,
+    startup_report,
+):
+    logging.basicConfig(
+        filename=log_file, level=logging.INFO, format="%(asctime)s %(message)s"
+    )
+
+    if retrieval != "vector" and lexical_path is None:
+        raise click.BadParameter(
+            f"{retrieval} retrieval needs --lexical-index", param_hint="--retrieval"
+        )
+
+    backend_kwargs = dict(
+        index_path=index_path,
+        context_tokens=context_tokens,
+        condense_mode=condense_mode,
+        condense_model=condense_model,
+        lexical_path=lexical_path,
+        retrieval=retrieval,
+        videos_path=videos_path,
+        trace_path=trace_path,
+        metrics_path=metrics_path,
+    )
+    timer = StartupTimer()
+    warm_up = WarmUp(
+        lambda timer: load_chatbot(
+            timer,
+            backend_kwargs,
+            memory_tokens,
+            summarize_history,
+            history_db,
+            session_id,
+        ),
+        timer,
+    )
+    if session_id is not None:
+        # an unknown session is reported here, before anything is shown
+        warm_up.result()
+
+    main(warm_up, session_id is not None, startup_report)
+
+
 if "__main__" == __name__:
     signal.signal(signal.SIGINT, signal_handler)
-    chatbot = AquariumCoOpChatBot()
     # question = "What is the best food for cherry neocardina shrimp?"
     # resp = chatbot.chat(question)
     # print(resp)
     # import ipdb; ipdb.set_trace()  # fmt: skip
     # print("wat")
-    main()
+    cli()
@@ -1,10 +1,17 @@
 import click
 import csv
+import json
+import queue
+import threading
 import chromadb
+import numpy as np
 from chromadb.config import Settings
 from tqdm import tqdm
 import logging
 
+import vectorfile
+import videos
+
 # Use colorful logging
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 logger = logging.getLogger()
@@ -23,73 +30,210 @@ chroma_client = chromadb.Client(
 collection = chroma_client.get_or_create_collection(name="aquarium-co-op-youtube")
 
 
+BATCH_SIZE = 1000
+# Batches fetched ahead of the one being written
+PREFETCH_BATCHES = 4
+
+# Each page starts after the last row of the previous one, so the database
+# seeks to it instead of skipping over every row before it like OFFSET does.
+# Pages are keyed on DuckDB's rowid, the order rows are stored in: there's no
+# index on the chunk ids, so paging by id would scan the whole table for
+# every page, while row groups outside a rowid range are skipped outright.
+KEYSET_QUERY = """
+    SELECT rowid, id, document, metadata, embedding FROM embeddings
+    WHERE collection_uuid = ? AND rowid > ?
+    ORDER BY rowid
+    LIMIT ?
+"""
+
+# 9 significant digits round-trip float32, which is all the projector uses
+TSV_FLOAT_FORMAT = "%.9g"
+
+_DONE = object()
+
+
+def _duckdb():
+    """
+    The DuckDB database behind Chroma 0.3's duckdb+parquet backend, or None
+    if this Chroma doesn't have one where keyset_batches expects it.
+    """
+    if not chromadb.__version__.startswith("0.3."):
+        return None
+    db = getattr(chroma_client, "_db", None)
+    if not hasattr(db, "_conn") or not hasattr(db, "get_collection_uuid_from_name"):
+        return None
+    return db
+
+
+def id_batches(batch_size=BATCH_SIZE):
+    """
+    keyset_batches through Chroma's public API. Its offset pages aren't in a
+    stable order, and repeat or skip rows, so every id is listed first and the
+    rows are then fetched by id, a page at a time. Each page scans the table
+    for its ids, so this is much slower.
+    """
+    ids = collection.get(include=[])["ids"]
+    for start in range(0, len(ids), batch_size):
+        batch = collection.get(
+            ids=ids[start : start + batch_size],
+            include=["documents", "metadatas", "embeddings"],
+        )
+        yield (
+            batch["ids"],
+            batch["documents"],
+            [m or {} for m in batch["metadatas"]],
+            np.array(batch["embeddings"], dtype=np.float64),
+        )
+
+
+def keyset_batches(batch_size=BATCH_SIZE):
+    """
+    Yields (ids, documents, metadatas, embeddings) batches of the whole
+    collection in storage order, `embeddings` being a float64 matrix.
+
+    Chroma's collection API can only page by offset, so this queries the
+    DuckDB database of Chroma 0.3's duckdb+parquet backend directly. Those
+    are Chroma's internals: any other Chroma gets id_batches instead.
+    """
+    db = _duckdb()
+    if db is None:
+        logging.warning(
+            "Chroma %s has no DuckDB database to page through, "
+            "falling back to fetching rows by id",
+            chromadb.__version__,
+        )
+        yield from id_batches(batch_size)
+        return
+
+    collection_uuid = str(db.get_collection_uuid_from_name(collection.name))
+    # a cursor of its own, as it's used from the prefetch thread
+    cursor = db._conn.cursor()
+    after = -1
+    while True:
+        rows = cursor.execute(
+            KEYSET_QUERY, [collection_uuid, after, batch_size]
+        ).fetchnumpy()
+        ids = rows["id"].tolist()
+        if not ids:
+            return
+        metadatas = [json.loads(m) if m else {} for m in rows["metadata"]]
+        yield ids, rows["document"].tolist(), metadatas, np.stack(rows["embedding"])
+        after = int(rows["rowid"][-1])
+
+
+def prefetch(batches, size=PREFETCH_BATCHES):
+    """Runs the `batches` iterator on a background thread, up to `size` batches ahead"""
+    fetched = queue.Queue(maxsize=size)
+    error = None
+
+    def run():
+        nonlocal error
+        try:
+            for batch in batches:
+                fetched.put(batch)
+        except BaseException as e:
+            error = e
+        finally:
+            fetched.put(_DONE)
+
+    thread = threading.Thread(target=run, name="prefetch", daemon=True)
+    thread.start()
+    while True:
+        batch = fetched.get()
+        if batch is _DONE:
+            break
+        yield batch
+    thread.join()
+    if error is not None:
+        raise error
+
+
 @click.command()
 @click.argument("embeddings_output")
 @click.argument("metadata_output")
-def export(embeddings_output, metadata_output):
+@click.option(
+    "--videos",
+    "videos_path",
+    default=videos.DEFAULT_PATH,
+    help="Video table the titles, thumbnails and urls come from.",
+)
+@click.option("--batch-size", default=BATCH_SIZE)
+def export(embeddings_output, metadata_output, videos_path, batch_size):
     """
     This function exports all embeddings and corresponding metadata from
-    a ChromaDB collection into two TSV files. The embeddings are exported
-    into `embeddings_output` and the metadata into `metadata_output`.
+    a ChromaDB collection. The embeddings are exported into
+    `embeddings_output` and the metadata into `metadata_output`, a TSV file.
+
+    `embeddings_output` is a TSV file, as the embedding projector wants,
+    unless it ends in `.npy` or `.parquet`. Then the embeddings are written
+    as float32, along with each chunk's id, text and metadata (in a
+    `.meta.jsonl` sidecar for `.npy`, which index.py can load back; see
+    vectorfile.py).
+
+    Chunks are read in the order they're stored, a batch at a time, on a
+    background thread while the previous batches are being written.
 
     Parameters:
     embeddings_output (str): The output file path for the embeddings.
     metadata_output (str): The output file path for the metadata.
     """
     logging.info("Starting export process...")
-    with open(embeddings_output, "w", newline="") as embeddings_file, open(
-        metadata_output, "w", newline=""
-    ) as metadata_file:
-        embeddings_writer = csv.writer(embeddings_file, delimiter="\t")
+    table = videos.VideoTable(videos_path)
+    binary = embeddings_output.endswith((".npy", ".parquet"))
+    if binary:
+        embeddings_file = vectorfile.open_writer(embeddings_output)
+    else:
+        embeddings_file = open(embeddings_output, "w", newline="")
+
+    with embeddings_file, open(metadata_output, "w", newline="") as metadata_file:
         metadata_writer = csv.writer(metadata_file, delimiter="\t")
 
         # Write the headers for metadata.tsv
         metadata_writer.writerow(
             ["id", "document", "title", "video_id", "thumbnail", "url"]
         )
-        logging.info("Metadata headers written.")
-
-        # Initialize offset
-        offset = 0
-        while True:
-            logging.info(f"Fetching batch starting from offset {offset}...")
-            # Query the batch of embeddings and metadata from the ChromaDB collection
-            data = collection.get(
-                limit=1000,
-                offset=offset,
-                include=["documents", "metadatas", "embeddings"],
-            )
-            # If the query returned no data, we've reached the end of the collection
-            if not data["ids"]:
-                break
-
-            logging.info(f"Writing data to files...")
-            for id, embedding, document, metadata in tqdm(
-                zip(
-                    data["ids"],
-                    data["embeddings"],
-                    data["documents"],
-                    data["metadatas"],
-                )
+
+        with tqdm(total=collection.count(), unit="chunk") as progress:
+            for ids, documents, metadatas, embeddings in prefetch(
+                keyset_batches(batch_size)
             ):
                 # Write the embeddings
-                embeddings_writer.writerow(embedding)
-
-                # Write the metadata
-                metadata_writer.writerow(
-                    [
-                        id,
-                        document,
-                        metadata["title"],
-                        metadata["video_id"],
-                        metadata["thumbnail"],
-                        metadata["url"],
-                    ]
-                )
-
-            # Increment the offset for the next batch
-            offset += 1000
-            logging.info(f"Batch written. Updating offset to {offset}...")
+                if binary:
+                    for id, document, metadata, embedding in zip(
+                        ids, documents, metadatas, embeddings
+                    ):
+                        embeddings_file.write(
+                            {"id": id, "text": document, "metadata": metadata},
+                            embedding,
+                        )
+                else:
+                    # one format string per row is several times faster than
+                    # csv.writer's float reprs
+                    row_format = (
+                        "\t".join([TSV_FLOAT_FORMAT] * embeddings.shape[1]) + "\n"
+                    )
+                    embeddings_file.writelines(
+                        row_format % tuple(row) for row in embeddings.tolist()
+                    )
+
+                # Write the metadata; chunks indexed before the video table
+                # existed carry their video's metadata themselves, and a video
+                # missing from the table gets empty columns
+                rows = []
+                for id, document, metadata in zip(ids, documents, metadatas):
+                    video = table.get(metadata["video_id"], metadata)
+                    rows.append(
+                        [
+                            id,
+                            document,
+                            video.get("title", ""),
+                            metadata["video_id"],
+                            video.get("thumbnail", ""),
+                            video.get("url", ""),
+                        ]
+                    )
+                metadata_writer.writerows(rows)
+                progress.update(len(ids))
         logging.info("Export process completed successfully.")
 
 
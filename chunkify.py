@@ -1,15 +1,25 @@
+import hashlib
 import json
 import os
+import time
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 import click
+import numpy as np
 import tiktoken
 
 # Constants for token limits
 CHUNK_TOKEN_LIMIT = 80
 OVERLAP_TOKEN_LIMIT = 20
 
+# Every worker process ends up with its own copy of the tokenizer
 tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
+# Where the token arrays of transcripts are kept with --token-cache, so
+# re-chunking them with other limits doesn't tokenize them again
+TOKEN_CACHE_DIR = "./token-cache"
+
 
 def _best_thumbnail_url(thumbnails):
     if "maxres" in thumbnails:
@@ -20,10 +30,277 @@ def _best_thumbnail_url(thumbnails):
     return thumbnails["default"]["url"]
 
 
+def clean_metadata(video_data):
+    video_data["thumbnail"] = _best_thumbnail_url(video_data["thumbnails"])
+    video_data["video_id"] = video_data["resourceId"]["videoId"]
+    video_data.pop("thumbnails", None)
+    video_data.pop("resourceId", None)
+    video_data.pop("videoOwnerChannelTitle", None)
+    video_data.pop("videoOwnerChannelId", None)
+    return video_data
+
+
+def tokenize_transcript(transcript):
+    """
+    Tokenizes every entry of a transcript into a single token array.
+
+    Returns the concatenated token ids, and for each token the index of the
+    transcript entry it came from, which is what chunk timestamps are read
+    from.
+    """
+    # tiktoken's encode_batch farms each text out to a thread pool, which
+    # costs more than it saves for transcript lines of a few tokens each
+    encode = tokenizer.encode
+    encoded = [encode(entry["text"]) for entry in transcript]
+    lengths = [len(tokens) for tokens in encoded]
+
+    tokens = np.fromiter(
+        chain.from_iterable(encoded), dtype=np.uint32, count=sum(lengths)
+    )
+    entry_index = np.repeat(np.arange(len(transcript), dtype=np.int32), lengths)
+    return tokens, entry_index
+
+
+def token_cache_path(cache_dir, content):
+    # keyed by the file's bytes and the tokenizer: an edited transcript, or a
+    # different tokenizer, can't be served stale tokens
+    digest = hashlib.sha256(tokenizer.name.encode() + b"\0" + content).hexdigest()
+    return os.path.join(cache_dir, digest[:2], f"{digest}.npz")
+
+
+def cached_tokens(content, transcript, cache_dir):
+    """
+    `tokenize_transcript(transcript)`, read from `cache_dir` if the file whose
+    bytes are `content` was tokenized before, saved there otherwise.
+
+    Only the token count of each entry is saved alongside the token ids, the
+    entry index of each token is expanded from those.
+    """
+    path = token_cache_path(cache_dir, content)
+    try:
+        with np.load(path) as arrays:
+            tokens, lengths = arrays["tokens"], arrays["lengths"]
+        return tokens, np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    tokens, entry_index = tokenize_transcript(transcript)
+    lengths = np.bincount(entry_index, minlength=len(transcript)).astype(np.int32)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written to the side and moved into place, workers may race on a file
+    partial = f"{path}.{os.getpid()}.partial"
+    with open(partial, "wb") as f:
+        np.savez(f, tokens=tokens, lengths=lengths)
+    os.replace(partial, path)
+    return tokens, entry_index
+
+
+def read_transcript(filepath, token_cache=None):
+    """
+    Reads a transcript file and tokenizes it, through the token cache if
+    there's one. Returns the cleaned video data, the token ids and the entry
+    index of each token, or None if the file can't be chunked.
+    """
+    with open(filepath, "rb") as file:
+        content = file.read()
+    try:
+        video_data = clean_metadata(json.loads(content))
+    except json.JSONDecodeError:
+        print(f"Skipping file {filepath} due to invalid JSON.")
+        return None
+
+    transcript = video_data.get("transcript")
+    if transcript is None:
+        print(f"Skipping file {filepath} due to missing 'transcript' key.")
+        return None
+
+    if token_cache is None:
+        tokens, entry_index = tokenize_transcript(transcript)
+    else:
+        tokens, entry_index = cached_tokens(content, transcript, token_cache)
+    return video_data, tokens, entry_index
+
+
+def window_bounds(
+    num_tokens, chunk_limit=CHUNK_TOKEN_LIMIT, overlap_limit=OVERLAP_TOKEN_LIMIT
+):
+    """
+    Computes where each chunk starts and ends, returning three arrays:
+
+        lo, hi: chunk i covers tokens lo[i]:hi[i]
+        end_token: the token whose transcript entry sets the end time of
+            chunk i, or -1 if the chunk ends where the previous one did
+
+    Every chunk is `chunk_limit` tokens followed by the first `overlap_limit`
+    tokens of the next one, so windows are `chunk_limit + overlap_limit` long
+    and start every `chunk_limit` tokens. The end time comes from the last
+    token of the window that isn't part of the overlap.
+    """
+    if not 0 <= overlap_limit < chunk_limit:
+        raise ValueError("overlap_limit must be smaller than chunk_limit")
+
+    if overlap_limit == 0:
+        num_full = num_tokens // chunk_limit
+    else:
+        num_full = max(0, (num_tokens - overlap_limit) // chunk_limit)
+
+    lo = np.arange(num_full, dtype=np.int64) * chunk_limit
+    hi = lo + chunk_limit + overlap_limit
+    end_token = lo + chunk_limit - 1
+
+    # Whatever is left over after the last full window becomes a final,
+    # shorter chunk
+    start = num_full * chunk_limit
+    if num_tokens > start:
+        if num_full == 0 or overlap_limit == 0:
+            last_end = min(num_tokens, start + chunk_limit) - 1
+        elif num_tokens > start + overlap_limit:
+            last_end = min(num_tokens, start + chunk_limit) - 1
+        else:
+            # only the overlap of the previous chunk is left
+            last_end = -1
+
+        lo = np.append(lo, start)
+        hi = np.append(hi, num_tokens)
+        end_token = np.append(end_token, last_end)
+
+    return lo, hi, end_token
+
+
+def chunk_tokens(
+    transcript,
+    tokens,
+    entry_index,
+    chunk_limit=CHUNK_TOKEN_LIMIT,
+    overlap_limit=OVERLAP_TOKEN_LIMIT,
+):
+    """
+    Breaks a tokenized transcript down into chunks with start/end timestamps.
+
+    A chunk starts where the previous one ended (the first one at the start
+    of the transcript). Without overlap, each chunk starts at the start of
+    its own first entry instead.
+    """
+    lo, hi, end_token = window_bounds(len(tokens), chunk_limit, overlap_limit)
+    decode = tokenizer.decode
+    texts = [decode(tokens[a:b].tolist()) for a, b in zip(lo, hi)]
+
+    chunks = []
+    chunk_end = 0.0
+    for a, last, text in zip(lo.tolist(), end_token.tolist(), texts):
+        if overlap_limit == 0 or not chunks:
+            chunk_start = transcript[entry_index[a]]["start"]
+        else:
+            chunk_start = chunk_end
+
+        if last >= 0:
+            entry = transcript[entry_index[last]]
+            chunk_end = entry["start"] + entry["duration"]
+
+        chunks.append(
+            {
+                "text": text,
+                "start": chunk_start,
+                "end": chunk_end,
+                "duration": chunk_end - chunk_start,
+            }
+        )
+
+    return chunks
+
+
+def chunk_transcript_reference(transcript):
+    """
+    The original token-at-a-time chunking algorithm, kept to check the output
+    of `chunk_tokens` against (see `--verify`).
+    """
+    chunks = []
+    current_chunk = []
+    chunk_start = 0.0
+    chunk_end = 0.0
+    overlap_buffer = deque(maxlen=OVERLAP_TOKEN_LIMIT)
+
+    for entry in transcript:
+        tokens = tokenizer.encode(entry["text"])
+        for token in tokens:
+            if len(current_chunk) < CHUNK_TOKEN_LIMIT:
+                current_chunk.append(token)
+                if len(current_chunk) == 1:
+                    chunk_start = entry["start"]
+                chunk_end = entry["start"] + entry["duration"]
+            else:
+                overlap_buffer.append(token)
+
+            if (
+                len(current_chunk) >= CHUNK_TOKEN_LIMIT
+                and len(overlap_buffer) >= OVERLAP_TOKEN_LIMIT
+            ):
+                add_chunk(chunks, current_chunk, overlap_buffer, chunk_start, chunk_end)
+                current_chunk = list(overlap_buffer)
+                chunk_start = chunk_end
+                overlap_buffer.clear()
+
+    if current_chunk:
+        add_chunk(chunks, current_chunk, overlap_buffer, chunk_start, chunk_end)
+
+    return chunks
+
+
+def chunk_file(
+    filepath,
+    output_dir,
+    verify=False,
+    token_cache=None,
+    chunk_limit=CHUNK_TOKEN_LIMIT,
+    overlap_limit=OVERLAP_TOKEN_LIMIT,
+):
+    """
+    Chunks a single transcript file into `output_dir`.
+
+    Returns the number of chunks written, or None if the file was skipped.
+    """
+    filename = os.path.basename(filepath)
+    read = read_transcript(filepath, token_cache)
+    if read is None:
+        return None
+
+    video_data, tokens, entry_index = read
+    transcript = video_data["transcript"]
+    chunks = chunk_tokens(transcript, tokens, entry_index, chunk_limit, overlap_limit)
+
+    if verify and chunks != chunk_transcript_reference(transcript):
+        raise AssertionError(f"Chunks for {filepath} differ from the reference")
+
+    video_data["chunks"] = chunks
+    with open(os.path.join(output_dir, filename), "w") as file:
+        json.dump(video_data, file, indent=2)
+
+    return len(chunks)
+
+
 @click.command()
 @click.argument("input_dir")
 @click.argument("output_dir")
-def chunk_transcripts(input_dir, output_dir):
+@click.option(
+    "--workers",
+    default=os.cpu_count(),
+    help="Number of processes to chunk files with.",
+)
+@click.option(
+    "--verify",
+    is_flag=True,
+    help="Check every file against the original token-at-a-time algorithm.",
+)
+@click.option(
+    "--token-cache",
+    default=None,
+    help=f"Keep the tokens of each transcript in this directory, e.g. {TOKEN_CACHE_DIR}.",
+)
+@click.option("--chunk-tokens", "chunk_limit", default=CHUNK_TOKEN_LIMIT)
+@click.option("--overlap-tokens", "overlap_limit", default=OVERLAP_TOKEN_LIMIT)
+def chunk_transcripts(
+    input_dir, output_dir, workers, verify, token_cache, chunk_limit, overlap_limit
+):
     """
     Breaks down transcripts into smaller chunks.
 
@@ -31,66 +308,50 @@ def chunk_transcripts(input_dir, output_dir):
         input_dir: The directory containing the input files.
         output_dir: The directory where the output files will be written.
     """
-    for filename in os.listdir(input_dir):
-        filepath = os.path.join(input_dir, filename)
-        if not filepath.endswith(".json"):
-            continue
-
-        try:
-            with open(filepath) as file:
-                video_data = json.load(file)
-
-                # Clean up metadata
-                video_data["thumbnail"] = _best_thumbnail_url(video_data["thumbnails"])
-                video_data["video_id"] = video_data["resourceId"]["videoId"]
-                video_data.pop("thumbnails", None)
-                video_data.pop("resourceId", None)
-                video_data.pop("videoOwnerChannelTitle", None)
-                video_data.pop("videoOwnerChannelId", None)
-
-        except json.JSONDecodeError:
-            print(f"Skipping file {filepath} due to invalid JSON.")
-            continue
-
-        transcript = video_data.get("transcript")
-        if transcript is None:
-            print(f"Skipping file {filepath} due to missing 'transcript' key.")
-            continue
-
-        chunks = []
-        current_chunk = []
-        chunk_start = 0.0
-        chunk_end = 0.0
-        overlap_buffer = deque(maxlen=OVERLAP_TOKEN_LIMIT)
-
-        for entry in transcript:
-            tokens = tokenizer.encode(entry["text"])
-            for token in tokens:
-                if len(current_chunk) < CHUNK_TOKEN_LIMIT:
-                    current_chunk.append(token)
-                    if len(current_chunk) == 1:
-                        chunk_start = entry["start"]
-                    chunk_end = entry["start"] + entry["duration"]
-                else:
-                    overlap_buffer.append(token)
-
-                if (
-                    len(current_chunk) >= CHUNK_TOKEN_LIMIT
-                    and len(overlap_buffer) >= OVERLAP_TOKEN_LIMIT
-                ):
-                    add_chunk(
-                        chunks, current_chunk, overlap_buffer, chunk_start, chunk_end
-                    )
-                    current_chunk = list(overlap_buffer)
-                    chunk_start = chunk_end
-                    overlap_buffer.clear()
-
-        if current_chunk:
-            add_chunk(chunks, current_chunk, overlap_buffer, chunk_start, chunk_end)
-
-        video_data["chunks"] = chunks
-        with open(os.path.join(output_dir, filename), "w") as file:
-            json.dump(video_data, file, indent=2)
+    if verify and (chunk_limit, overlap_limit) != (
+        CHUNK_TOKEN_LIMIT,
+        OVERLAP_TOKEN_LIMIT,
+    ):
+        raise click.BadParameter(
+            "the reference algorithm only chunks with the default limits",
+            param_hint="--verify",
+        )
+
+    filepaths = [
+        os.path.join(input_dir, filename)
+        for filename in os.listdir(input_dir)
+        if filename.endswith(".json")
+    ]
+
+    started = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = list(
+                executor.map(
+                    chunk_file,
+                    filepaths,
+                    [output_dir] * len(filepaths),
+                    [verify] * len(filepaths),
+                    [token_cache] * len(filepaths),
+                    [chunk_limit] * len(filepaths),
+                    [overlap_limit] * len(filepaths),
+                    chunksize=8,
+                )
+            )
+    else:
+        counts = [
+            chunk_file(
+                filepath, output_dir, verify, token_cache, chunk_limit, overlap_limit
+            )
+            for filepath in filepaths
+        ]
+    elapsed = time.perf_counter() - started
+
+    num_chunks = sum(count for count in counts if count)
+    print(
+        f"Chunked {len(filepaths)} files into {num_chunks} chunks in {elapsed:.2f}s "
+        f"({num_chunks / max(elapsed, 1e-9):,.0f} chunks/sec)"
+    )
 
 
 def add_chunk(chunks, current_chunk, overlap_buffer, chunk_start, chunk_end):
@@ -2,11 +2,46 @@ import os
 import json
 import click
 
+import videos
+
+
+def chunk_entries(data):
+    """
+    Turns a chunked video into one entry per chunk. A chunk's metadata is the
+    video's id and the chunk's start, end, and duration; the rest of the
+    video's metadata goes in the video table (see videos.py).
+    """
+    # Remove the transcript and chunks keys
+    data.pop("transcript", None)
+    chunks = data.pop("chunks", [])
+
+    # Iterate over the chunks
+    for idx, chunk in enumerate(chunks, start=1):
+        # Create the new chunk entry
+        metadata = {
+            "video_id": data["video_id"],
+            "start": chunk["start"],
+            "end": chunk["end"],
+            "duration": chunk["duration"],
+        }
+        yield {
+            "id": f'{data["video_id"]}-{idx}',
+            "text": chunk["text"],
+            "metadata": metadata,
+        }
+
 
 @click.command()
 @click.argument("input_dir")
 @click.argument("output_file")
-def chunklines(input_dir, output_file):
+@click.option(
+    "--videos",
+    "videos_path",
+    default=videos.DEFAULT_PATH,
+    help="Video table the chunked videos are added to.",
+)
+def chunklines(input_dir, output_file, videos_path):
+    table = videos.VideoTable(videos_path)
     # Open the output file
     with open(output_file, "w") as out:
         # Walk through the input directory
@@ -16,34 +51,15 @@ def chunklines(input_dir, output_file):
                     # Open each json file
                     with open(os.path.join(root, file)) as json_file:
                         data = json.load(json_file)
+                        table.add(videos.video_record(data))
 
-                        # Remove the transcript key
-                        data.pop("transcript", None)
-
-                        # Iterate over the chunks
-                        for idx, chunk in enumerate(data.get("chunks", []), start=1):
-                            # Create the new chunk entry
-                            new_entry = {
-                                "id": f'{data["video_id"]}-{idx}',
-                                "text": chunk["text"],
-                                "metadata": data,
-                            }
-                            # Remove the 'chunks' key from metadata
-                            new_entry["metadata"].pop("chunks", None)
-                            # Add the start, end, and duration from chunk to metadata
-                            new_entry["metadata"].update(
-                                {
-                                    "start": chunk["start"],
-                                    "end": chunk["end"],
-                                    "duration": chunk["duration"],
-                                }
-                            )
-
+                        for new_entry in chunk_entries(data):
                             # Write the new chunk entry to the output file
                             out.write(json.dumps(new_entry))
                             out.write(
                                 "\n"
                             )  # Newline separates entries in a JSON Lines file
+    table.save()
 
 
 if __name__ == "__main__":
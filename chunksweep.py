@@ -0,0 +1,157 @@
+"""
+Compares chunk window sizes over a directory of transcripts in one pass.
+
+    python chunksweep.py transcripts/ --window 80/20 --window 160/40
+
+Each transcript is tokenized once, through chunkify's token cache, so the
+first sweep pays for tiktoken and later ones only read the token arrays. The
+windows are then laid over the token counts (see chunkify.window_bounds),
+which is all the statistics need: how many chunks each window size makes, how
+long they are, and how many tokens get embedded with the overlap counted in.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+
+import chunkify
+
+DEFAULT_WINDOWS = ("80/20", "160/40", "256/64", "512/128")
+
+
+def token_count(filepath, token_cache):
+    """
+    The number of tokens in a transcript file and whether they were cached,
+    or (None, False) if the file can't be chunked.
+    """
+    with open(filepath, "rb") as file:
+        content = file.read()
+    # on a hit, neither the JSON nor the tokenizer is needed
+    try:
+        with np.load(chunkify.token_cache_path(token_cache, content)) as arrays:
+            return len(arrays["tokens"]), True
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    read = chunkify.read_transcript(filepath, token_cache)
+    if read is None:
+        return None, False
+    _, tokens, _ = read
+    return len(tokens), False
+
+
+def parse_window(value):
+    chunk_limit, _, overlap_limit = value.partition("/")
+    try:
+        chunk_limit, overlap_limit = int(chunk_limit), int(overlap_limit or 0)
+    except ValueError:
+        raise click.BadParameter(
+            f"{value!r} is not CHUNK/OVERLAP", param_hint="--window"
+        )
+    if not 0 <= overlap_limit < chunk_limit:
+        raise click.BadParameter(
+            f"{value}: the overlap must be smaller than the chunk",
+            param_hint="--window",
+        )
+    return chunk_limit, overlap_limit
+
+
+def window_stats(counts, chunk_limit, overlap_limit):
+    chunks_per_video = []
+    lengths = []
+    for num_tokens in counts:
+        lo, hi, _ = chunkify.window_bounds(num_tokens, chunk_limit, overlap_limit)
+        chunks_per_video.append(len(lo))
+        lengths.append(hi - lo)
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    embedded = int(lengths.sum())
+    return {
+        "window": f"{chunk_limit}/{overlap_limit}",
+        "chunks": len(lengths),
+        "chunks_per_video": float(np.mean(chunks_per_video)) if counts else 0.0,
+        "tokens_embedded": embedded,
+        # tokens embedded per transcript token: what the overlap costs
+        "overhead": embedded / max(sum(counts), 1),
+        "p50_chunk_tokens": float(np.percentile(lengths, 50)) if embedded else 0.0,
+        "short_chunks": int((lengths < chunk_limit).sum()),
+    }
+
+
+@click.command()
+@click.argument("input_dir")
+@click.option(
+    "--window",
+    "windows",
+    multiple=True,
+    default=DEFAULT_WINDOWS,
+    help="A chunk size and overlap in tokens, as CHUNK/OVERLAP. Repeatable.",
+)
+@click.option("--token-cache", default=chunkify.TOKEN_CACHE_DIR)
+@click.option(
+    "--workers",
+    default=os.cpu_count(),
+    help="Number of processes to tokenize uncached files with.",
+)
+@click.option(
+    "--out", "output_path", default=None, help="Also write the stats as JSON."
+)
+def sweep(input_dir, windows, token_cache, workers, output_path):
+    """
+    Print the chunks and tokens each window size makes of the transcripts in
+    INPUT_DIR, the output directory of download_transcripts.py.
+    """
+    windows = [parse_window(window) for window in windows]
+    filepaths = sorted(
+        os.path.join(input_dir, filename)
+        for filename in os.listdir(input_dir)
+        if filename.endswith(".json")
+    )
+
+    started = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    token_count,
+                    filepaths,
+                    [token_cache] * len(filepaths),
+                    chunksize=8,
+                )
+            )
+    else:
+        results = [token_count(filepath, token_cache) for filepath in filepaths]
+    counts = [count for count, _ in results if count is not None]
+    hits = sum(cached for _, cached in results)
+    read = time.perf_counter() - started
+
+    stats = [window_stats(counts, *window) for window in windows]
+    print(
+        f"{len(counts)} transcripts, {sum(counts):,} tokens, read in {read:.2f}s "
+        f"({hits} from the token cache, {len(counts) - hits} tokenized)"
+    )
+    print(
+        f"{'window':>10}{'chunks':>10}{'per video':>11}{'tokens':>13}"
+        f"{'overhead':>10}{'p50 len':>9}{'short':>8}"
+    )
+    for row in stats:
+        print(
+            f"{row['window']:>10}{row['chunks']:>10,}{row['chunks_per_video']:>11.1f}"
+            f"{row['tokens_embedded']:>13,}{row['overhead']:>9.2f}x"
+            f"{row['p50_chunk_tokens']:>9.0f}{row['short_chunks']:>8,}"
+        )
+
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            json.dump(
+                {"transcripts": len(counts), "tokens": sum(counts), "windows": stats},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    sweep()
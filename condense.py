@@ -0,0 +1,381 @@
+"""
+Skips the extra LLM call that condenses follow-up questions, where it can.
+
+ConversationalRetrievalChain has the LLM rewrite every follow-up question,
+together with the conversation so far, into a standalone question before it
+retrieves anything. That's a whole extra round trip ahead of the answer.
+CondensingRetrievalChain does the same, depending on its mode:
+
+    always    condense every follow-up, like ConversationalRetrievalChain
+    auto      don't condense questions that already read as standalone (see
+              `is_standalone`, a cheap local check)
+    parallel  like auto, but when a question is condensed, retrieve for it as
+              asked at the same time. Those results are kept if condensing
+              left the question as it was, or if condensing hasn't finished
+              by `condense_deadline` (the answer is then written to the
+              question as asked, with the conversation)
+
+The model that condenses is chosen separately (see ChatBackend), so it can
+be a smaller, faster one than the one answering. Each turn logs what was
+done and how long condensing took, and CondenseStats adds it all up.
+"""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, Optional
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForChainRun,
+    CallbackManagerForChainRun,
+)
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+
+from defaults import CONDENSE_MODES
+from query_cache import normalize_query
+from tracing import copy_context
+
+# Shorter questions ("and why?", "how many?") are almost always follow-ups
+MIN_STANDALONE_WORDS = 4
+
+# Words that point back at something said earlier in the conversation
+REFERRING_WORDS = {
+    "it",
+    "its",
+    "it's",
+    "itself",
+    "they",
+    "them",
+    "their",
+    "theirs",
+    "they're",
+    "themselves",
+    "this",
+    "that",
+    "these",
+    "those",
+    "he",
+    "him",
+    "his",
+    "she",
+    "her",
+    "one",
+    "ones",
+    "there",
+    "also",
+    "too",
+    "else",
+    "same",
+    "former",
+    "latter",
+    "above",
+    "instead",
+}
+FOLLOW_UP_OPENERS = ("and ", "but ", "or ", "so ", "then ", "what about", "how about")
+
+# In parallel mode, how long condensing may take before the question is
+# answered as asked. Condensing usually takes well under a second, this only
+# cuts in when the API is slow.
+CONDENSE_DEADLINE = 2.0
+
+# What happened on a turn
+FIRST_TURN = "first turn"
+STANDALONE = "standalone"
+CONDENSED = "condensed"
+UNCHANGED = "unchanged"
+DEADLINE = "deadline"
+
+logger = logging.getLogger(__name__)
+
+# Condenses the question, and retrieves for it as asked, for the sync chain in
+# parallel mode
+_parallel_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="condense")
+
+
+def is_standalone(question):
+    """
+    Whether a follow-up question makes sense without the conversation before
+    it. Errs towards no, which only costs the condensing call.
+    """
+    text = question.strip().lower()
+    words = re.findall(r"[a-z']+", text)
+    if len(words) < MIN_STANDALONE_WORDS or text.startswith(FOLLOW_UP_OPENERS):
+        return False
+    return REFERRING_WORDS.isdisjoint(words)
+
+
+class CondenseStats:
+    """
+    Running totals over turns, shared by every conversation of a ChatBackend.
+    Time saved by skipping a call is estimated from the average condensing
+    call so far.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = Counter()
+        self.condense_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    @property
+    def condense_calls(self):
+        return self.turns[CONDENSED] + self.turns[UNCHANGED]
+
+    def average_condense_seconds(self):
+        calls = self.condense_calls
+        return self.condense_seconds / calls if calls else 0.0
+
+    def record(self, outcome, condense_seconds=0.0, retrieval_seconds=0.0):
+        """Adds up a turn, returning the time it saved"""
+        with self.lock:
+            if outcome == STANDALONE:
+                saved = self.average_condense_seconds()
+            elif outcome == UNCHANGED:
+                # retrieval overlapped with condensing instead of following it
+                saved = min(condense_seconds, retrieval_seconds)
+            elif outcome == DEADLINE:
+                # at least the retrieval, and whatever condensing had left
+                saved = retrieval_seconds
+            else:
+                saved = 0.0
+            self.turns[outcome] += 1
+            self.condense_seconds += condense_seconds
+            self.saved_seconds += saved
+        return saved
+
+    def as_dict(self):
+        return {
+            "turns": sum(self.turns.values()),
+            "first_turns": self.turns[FIRST_TURN],
+            "skipped_standalone": self.turns[STANDALONE],
+            "condense_calls": self.condense_calls,
+            "unchanged": self.turns[UNCHANGED],
+            "past_deadline": self.turns[DEADLINE],
+            "condense_seconds": round(self.condense_seconds, 3),
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+    def stats_line(self):
+        follow_ups = self.condense_calls + self.turns[STANDALONE] + self.turns[DEADLINE]
+        return (
+            f"Condensing: {self.turns[STANDALONE]} of {follow_ups} follow-ups "
+            f"skipped, {self.turns[UNCHANGED]} condensed unchanged, "
+            f"{self.turns[DEADLINE]} answered as asked past the deadline, "
+            f"{self.condense_seconds:.1f}s spent condensing, "
+            f"~{self.saved_seconds:.1f}s saved"
+        )
+
+
+class CondensingRetrievalChain(ConversationalRetrievalChain):
+    """
+    ConversationalRetrievalChain that only condenses follow-up questions as
+    its `condense_mode` says to, adding each turn to `condense_stats`.
+    """
+
+    condense_mode: str = "auto"
+    condense_stats: Any = None
+    condense_deadline: float = CONDENSE_DEADLINE
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _skip(self, question, chat_history_str):
+        """Why the question doesn't need condensing, or None if it does"""
+        if not chat_history_str:
+            return FIRST_TURN
+        if self.condense_mode != "always" and is_standalone(question):
+            return STANDALONE
+        return None
+
+    def _record(self, outcome, condense_seconds=0.0, retrieval_seconds=0.0):
+        saved = 0.0
+        if self.condense_stats is not None:
+            saved = self.condense_stats.record(
+                outcome, condense_seconds, retrieval_seconds
+            )
+        logger.info(
+            "condense: %s, %.3fs condensing, ~%.3fs saved",
+            outcome,
+            condense_seconds,
+            saved,
+        )
+
+    def _timed_docs(self, question, inputs, run_manager):
+        started = time.perf_counter()
+        docs = self._get_docs(question, inputs, run_manager=run_manager)
+        return docs, time.perf_counter() - started
+
+    async def _atimed_docs(self, question, inputs, run_manager):
+        started = time.perf_counter()
+        docs = await self._aget_docs(question, inputs, run_manager=run_manager)
+        return docs, time.perf_counter() - started
+
+    def _output(self, new_question, docs, answer):
+        output = {self.output_key: answer}
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        if self.return_generated_question:
+            output["generated_question"] = new_question
+        return output
+
+    def _answer_inputs(self, inputs, chat_history_str, new_question):
+        new_inputs = inputs.copy()
+        if self.rephrase_question:
+            new_inputs["question"] = new_question
+        new_inputs["chat_history"] = chat_history_str
+        return new_inputs
+
+    def _condense_parallel(self, question, chat_history_str, inputs, run_manager):
+        """
+        Condenses the question while retrieving for it as asked. Returns the
+        question to answer, and its documents if they're the ones retrieved
+        for the question as asked, or None.
+        """
+        # each in the turn's context, so its spans are traced with the turn
+        raw = _parallel_pool.submit(
+            copy_context().run, self._timed_docs, question, inputs, run_manager
+        )
+        started = time.perf_counter()
+        condensing = _parallel_pool.submit(
+            copy_context().run,
+            self.question_generator.run,
+            question=question,
+            chat_history=chat_history_str,
+            callbacks=run_manager.get_child(),
+        )
+        try:
+            new_question = condensing.result(timeout=self.condense_deadline)
+        except FutureTimeoutError:
+            # the call can't be cancelled. Its result is dropped, and so are
+            # the spans it adds once the turn's trace is finished.
+            docs, retrieval_seconds = raw.result()
+            self._record(DEADLINE, retrieval_seconds=retrieval_seconds)
+            return question, docs
+        condense_seconds = time.perf_counter() - started
+
+        if normalize_query(new_question) == normalize_query(question):
+            docs, retrieval_seconds = raw.result()
+            self._record(UNCHANGED, condense_seconds, retrieval_seconds)
+            return new_question, docs
+        # a retrieval still running for the raw question only fills the
+        # query cache
+        self._record(CONDENSED, condense_seconds)
+        return new_question, None
+
+    async def _acondense_parallel(
+        self, question, chat_history_str, inputs, run_manager
+    ):
+        """`_condense_parallel`, on the event loop"""
+        raw = asyncio.ensure_future(self._atimed_docs(question, inputs, run_manager))
+        started = time.perf_counter()
+        condensing = asyncio.ensure_future(
+            self.question_generator.arun(
+                question=question,
+                chat_history=chat_history_str,
+                callbacks=run_manager.get_child(),
+            )
+        )
+        try:
+            await asyncio.wait({condensing}, timeout=self.condense_deadline)
+        except BaseException:
+            raw.cancel()
+            condensing.cancel()
+            raise
+        if not condensing.done():
+            condensing.cancel()
+            docs, retrieval_seconds = await raw
+            self._record(DEADLINE, retrieval_seconds=retrieval_seconds)
+            return question, docs
+
+        try:
+            new_question = condensing.result()
+        except BaseException:
+            raw.cancel()
+            raise
+        condense_seconds = time.perf_counter() - started
+
+        if normalize_query(new_question) == normalize_query(question):
+            docs, retrieval_seconds = await raw
+            self._record(UNCHANGED, condense_seconds, retrieval_seconds)
+            return new_question, docs
+        raw.cancel()
+        self._record(CONDENSED, condense_seconds)
+        return new_question, None
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        question = inputs["question"]
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+
+        new_question, docs = question, None
+        skip = self._skip(question, chat_history_str)
+        if skip is not None:
+            self._record(skip)
+        elif self.condense_mode == "parallel":
+            new_question, docs = self._condense_parallel(
+                question, chat_history_str, inputs, _run_manager
+            )
+        else:
+            started = time.perf_counter()
+            new_question = self.question_generator.run(
+                question=question,
+                chat_history=chat_history_str,
+                callbacks=_run_manager.get_child(),
+            )
+            self._record(CONDENSED, time.perf_counter() - started)
+
+        if docs is None:
+            docs = self._get_docs(new_question, inputs, run_manager=_run_manager)
+        answer = self.combine_docs_chain.run(
+            input_documents=docs,
+            callbacks=_run_manager.get_child(),
+            **self._answer_inputs(inputs, chat_history_str, new_question),
+        )
+        return self._output(new_question, docs, answer)
+
+    async def _acall(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        question = inputs["question"]
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+
+        new_question, docs = question, None
+        skip = self._skip(question, chat_history_str)
+        if skip is not None:
+            self._record(skip)
+        elif self.condense_mode == "parallel":
+            new_question, docs = await self._acondense_parallel(
+                question, chat_history_str, inputs, _run_manager
+            )
+        else:
+            started = time.perf_counter()
+            new_question = await self.question_generator.arun(
+                question=question,
+                chat_history=chat_history_str,
+                callbacks=_run_manager.get_child(),
+            )
+            self._record(CONDENSED, time.perf_counter() - started)
+
+        if docs is None:
+            docs = await self._aget_docs(new_question, inputs, run_manager=_run_manager)
+        answer = await self.combine_docs_chain.arun(
+            input_documents=docs,
+            callbacks=_run_manager.get_child(),
+            **self._answer_inputs(inputs, chat_history_str, new_question),
+        )
+        return self._output(new_question, docs, answer)
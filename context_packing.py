@@ -0,0 +1,192 @@
+"""
+Packs retrieved chunks into the prompt's context.
+
+Chunks are windows of CHUNK_TOKEN_LIMIT tokens plus the first
+OVERLAP_TOKEN_LIMIT tokens of the next window (see chunkify.py), so when
+neighbouring chunks of a video are retrieved together, the overlap shows up
+twice. Neighbours are recognised by their timestamps, since each chunk starts
+where the previous one ended, and merged into one passage with the duplicated
+text removed. Chunks are taken in relevance order for as long as the passages
+they make up fit in the token budget.
+"""
+
+import logging
+from collections import defaultdict
+from typing import Any, List
+
+import tiktoken
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import BaseRetriever, Document
+
+from defaults import CONTEXT_TOKEN_BUDGET
+from tracing import span
+
+# Shorter matches between the end of one chunk and the start of the next are
+# more likely to be coincidence than overlap
+MIN_OVERLAP_CHARS = 10
+
+logger = logging.getLogger(__name__)
+
+tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+
+def _overlap(a, b):
+    """Length of the longest suffix of `a` that is a prefix of `b`"""
+    probe = b[:MIN_OVERLAP_CHARS]
+    if len(probe) < MIN_OVERLAP_CHARS:
+        return 0
+    # the earliest place the suffix can start that matches is the longest one
+    i = a.find(probe, max(0, len(a) - len(b)))
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(probe, i + 1)
+    return 0
+
+
+def _follows(previous, chunk):
+    """Whether `chunk` continues on from `previous`, in the same video"""
+    return chunk.metadata["start"] <= previous.metadata["end"] + 1e-6
+
+
+def _runs(chunks):
+    """Splits chunks of one video, sorted by start time, into contiguous runs"""
+    run = [chunks[0]]
+    for chunk in chunks[1:]:
+        if _follows(run[-1], chunk):
+            run.append(chunk)
+        else:
+            yield run
+            run = [chunk]
+    yield run
+
+
+def _token_counter():
+    # the same chunks are counted again for every candidate, only encode once
+    counts = {}
+
+    def count(text):
+        if text not in counts:
+            counts[text] = len(tokenizer.encode(text))
+        return counts[text]
+
+    return count
+
+
+def merge_run(run, count_tokens):
+    """
+    Merges a run of contiguous chunks into one passage without the duplicated
+    overlap, returning it with its token count. The passage keeps the metadata
+    of its first chunk, with the start, end and duration of the whole run.
+    """
+    # the overlap is between neighbouring chunks, whatever came before them
+    pieces = [run[0].page_content]
+    for previous, chunk in zip(run, run[1:]):
+        overlap = _overlap(previous.page_content, chunk.page_content)
+        piece = chunk.page_content[overlap:]
+        # chunks whose times touch but whose texts don't overlap (enough) are
+        # joined with a space, rather than gluing two words together
+        if overlap == 0 and not (
+            previous.page_content[-1:].isspace() or piece[:1].isspace()
+        ):
+            piece = " " + piece
+        pieces.append(piece)
+    tokens = sum(count_tokens(piece) for piece in pieces)
+
+    if len(run) == 1:
+        return run[0], tokens
+    start = run[0].metadata["start"]
+    end = max(chunk.metadata["end"] for chunk in run)
+    metadata = dict(run[0].metadata, start=start, end=end, duration=end - start)
+    return Document(page_content="".join(pieces), metadata=metadata), tokens
+
+
+def _pack(chunks, count_tokens):
+    """
+    Merges the chunks of each video, and orders the passages by their best
+    chunk. Returns the passages and their total token count.
+    """
+    by_video = defaultdict(list)
+    rank = {}
+    for i, chunk in enumerate(chunks):
+        rank[id(chunk)] = i
+        metadata = chunk.metadata
+        if "video_id" in metadata and "start" in metadata and "end" in metadata:
+            by_video[metadata["video_id"]].append(chunk)
+        else:
+            # nothing to merge it with
+            by_video[id(chunk)].append(chunk)
+
+    ranked = []
+    total = 0
+    for video_chunks in by_video.values():
+        video_chunks.sort(key=lambda c: c.metadata.get("start", 0))
+        for run in _runs(video_chunks):
+            passage, tokens = merge_run(run, count_tokens)
+            total += tokens
+            # a passage ranks as high as the best chunk in it
+            ranked.append((min(rank[id(c)] for c in run), passage))
+
+    ranked.sort(key=lambda pair: pair[0])
+    return [passage for _, passage in ranked], total
+
+
+def pack_documents(documents, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """
+    Merges neighbouring chunks in `documents` (most relevant first) and
+    returns the passages of as many of the most relevant chunks as fit in
+    `max_tokens`, most relevant passage first. Token counts add up the
+    chunks' tokens without their overlap, which can be off from encoding the
+    merged passage by a token at each seam.
+
+    A chunk that would push the context over budget is skipped, but less
+    relevant chunks after it are still considered, as they may be smaller or
+    only cost the few tokens that don't overlap with a chunk already taken.
+    """
+    with span("pack_context") as attributes:
+        count_tokens = _token_counter()
+        selected = []
+        for document in documents:
+            _, tokens = _pack(selected + [document], count_tokens)
+            if tokens <= max_tokens:
+                selected.append(document)
+
+        packed, tokens = _pack(selected, count_tokens)
+        attributes.update(chunks=len(selected), passages=len(packed), tokens=tokens)
+    logger.info(
+        "context: %d chunks, %d tokens -> %d passages, %d tokens",
+        len(documents),
+        sum(count_tokens(doc.page_content) for doc in documents),
+        len(packed),
+        tokens,
+    )
+    return packed
+
+
+class PackingRetriever(BaseRetriever):
+    """Wraps a retriever, packing its results into at most `max_tokens` tokens."""
+
+    retriever: Any
+    max_tokens: int = CONTEXT_TOKEN_BUDGET
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        documents = self.retriever.get_relevant_documents(
+            query, callbacks=run_manager.get_child()
+        )
+        return pack_documents(documents, self.max_tokens)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        documents = await self.retriever.aget_relevant_documents(
+            query, callbacks=run_manager.get_child()
+        )
+        return pack_documents(documents, self.max_tokens)
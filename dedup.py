@@ -0,0 +1,196 @@
+"""
+Drops near-duplicate chunks before they're embedded.
+
+Intros, outros and sponsor reads come back in hundreds of videos, nearly word
+for word. Each copy would cost an embedding request, a row in the index and,
+worst, retrieval slots that a question's real answers need. Chunks are
+clustered by the MinHash of their word shingles instead. Only the first
+chunk of each cluster, its representative, is kept. The others are recorded
+against it in a JSON lines file of {"id", "representative", "similarity"}.
+
+Clusters found in at least --drop-boilerplate different videos are filler by
+definition, and can be dropped whole, representative included.
+
+    python chunklines.py chunked/ chunks.jsonl
+    python dedup.py chunks.jsonl deduped.jsonl --drop-boilerplate 20
+    python embeddingify.py deduped.jsonl embeddings.npy
+
+pipeline.py does the same as it streams, with --dedup, without dropping
+boilerplate (it can't know a cluster is one until it has seen the videos).
+"""
+
+import hashlib
+import json
+import re
+import zlib
+from collections import defaultdict
+
+import click
+import numpy as np
+from tqdm import tqdm
+
+# Words per shingle. Every word that differs (a misheard word in the
+# transcript) changes this many shingles, so longer ones make near-identical
+# chunks look less alike.
+SHINGLE_WORDS = 3
+
+# MinHash signature length, cut into bands for locality-sensitive hashing:
+# chunks agreeing on every row of any band are compared. 32 bands of 4 rows
+# find most pairs similar from ~0.45 on.
+NUM_HASHES = 128
+BANDS = 32
+
+# Estimated Jaccard similarity of the shingles from which chunks are
+# duplicates. A chunk that starts a few words earlier or later, or has a
+# couple of words transcribed differently, is still over it.
+SIMILARITY = 0.5
+
+_word = re.compile(r"\w+")
+
+# Mersenne prime modulus of the hash family h(x) = (a * x + b) mod p, small
+# enough that a * x fits in 64 bits for 32-bit x
+_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(0)
+_A = _rng.integers(1, _PRIME, NUM_HASHES, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, NUM_HASHES, dtype=np.uint64)
+
+
+def shingles(text):
+    """The distinct runs of SHINGLE_WORDS words in `text`, hashed to 32 bits"""
+    words = _word.findall(text.casefold())
+    if len(words) <= SHINGLE_WORDS:
+        runs = [" ".join(words)]
+    else:
+        runs = [
+            " ".join(words[i : i + SHINGLE_WORDS])
+            for i in range(len(words) - SHINGLE_WORDS + 1)
+        ]
+    return np.unique(np.fromiter((zlib.crc32(r.encode()) for r in runs), np.uint64))
+
+
+def signature(text):
+    """MinHash signature of `text`: per hash function, the minimum over its shingles"""
+    hashes = (np.outer(shingles(text), _A) + _B) % _PRIME
+    return hashes.min(axis=0).astype(np.uint32)
+
+
+def _text_key(text):
+    return hashlib.sha1(" ".join(_word.findall(text.casefold())).encode()).digest()
+
+
+class Deduplicator:
+    """
+    Clusters chunk texts as they come: a text joins the most similar
+    representative seen so far if it's at least `threshold` similar, or
+    becomes a representative itself.
+    """
+
+    def __init__(self, threshold=SIMILARITY, bands=BANDS):
+        self.threshold = threshold
+        self.rows = NUM_HASHES // bands
+        self.exact = {}
+        self.buckets = defaultdict(list)
+        self.signatures = []
+        self.representatives = []
+
+    def _bands(self, sig):
+        for band in range(0, NUM_HASHES, self.rows):
+            yield band, sig[band : band + self.rows].tobytes()
+
+    def add(self, id, text):
+        """
+        Returns the id of the representative of the cluster `text` joins and
+        the estimated similarity to it: `id` and 1.0 if it starts one.
+        """
+        # identical up to case and punctuation: no need to hash it
+        key = _text_key(text)
+        if key in self.exact:
+            return self.exact[key], 1.0
+
+        sig = signature(text)
+        candidates = {c for band in self._bands(sig) for c in self.buckets[band]}
+        best, similarity = None, 0.0
+        for c in candidates:
+            estimate = float(np.mean(self.signatures[c] == sig))
+            if estimate > similarity:
+                best, similarity = c, estimate
+        if best is not None and similarity >= self.threshold:
+            return self.representatives[best], similarity
+
+        cluster = len(self.representatives)
+        self.representatives.append(id)
+        self.signatures.append(sig)
+        for band in self._bands(sig):
+            self.buckets[band].append(cluster)
+        self.exact[key] = id
+        return id, 1.0
+
+
+@click.command()
+@click.argument("input_file")
+@click.argument("output_file")
+@click.option(
+    "--duplicates",
+    "duplicates_path",
+    default="./duplicates.jsonl",
+    help="Where the chunks left out are recorded against their representative.",
+)
+@click.option("--threshold", default=SIMILARITY, help="Similarity of duplicates.")
+@click.option(
+    "--drop-boilerplate",
+    "boilerplate_videos",
+    default=None,
+    type=int,
+    help="Drop clusters found in at least this many videos entirely.",
+)
+def dedup(input_file, output_file, duplicates_path, threshold, boilerplate_videos):
+    """
+    Copy the chunk entries of INPUT_FILE (from chunklines.py) to OUTPUT_FILE,
+    leaving out near-duplicates of earlier chunks.
+    """
+    deduplicator = Deduplicator(threshold)
+    clusters = {}
+    videos = defaultdict(set)
+    with open(input_file) as f:
+        for line in tqdm(f, desc="clustering"):
+            entry = json.loads(line)
+            representative, similarity = deduplicator.add(entry["id"], entry["text"])
+            clusters[entry["id"]] = (representative, similarity)
+            videos[representative].add(entry["metadata"]["video_id"])
+
+    boilerplate = set()
+    if boilerplate_videos is not None:
+        boilerplate = {r for r, v in videos.items() if len(v) >= boilerplate_videos}
+
+    kept = dropped = 0
+    with open(input_file) as f, open(output_file, "w") as out, open(
+        duplicates_path, "w"
+    ) as duplicates:
+        for line in f:
+            id = json.loads(line)["id"]
+            representative, similarity = clusters[id]
+            if representative == id and id not in boilerplate:
+                out.write(line)
+                kept += 1
+                continue
+
+            record = {
+                "id": id,
+                "representative": representative,
+                "similarity": round(similarity, 3),
+            }
+            if representative in boilerplate:
+                record["dropped"] = True
+                dropped += 1
+            duplicates.write(json.dumps(record) + "\n")
+
+    total = len(clusters)
+    print(
+        f"{total} chunks: kept {kept}, left out {total - kept - dropped} "
+        f"duplicates and {dropped} chunks of {len(boilerplate)} boilerplate "
+        f"clusters ({(total - kept) / max(total, 1):.1%} fewer to embed)"
+    )
+
+
+if __name__ == "__main__":
+    dedup()
@@ -0,0 +1,26 @@
+"""
+Defaults and choices of the chatbot's options, shared by the modules they
+configure and the command lines that expose them.
+
+Nothing here imports anything, so chatbot.py can build its command line and
+show the prompt before langchain (seconds of imports) is loaded.
+"""
+
+# Token budget for the retrieved chunks in the prompt (see context_packing.py)
+CONTEXT_TOKEN_BUDGET = 2000
+
+# The history kept in the prompt by default, in tokens (see memory.py)
+MEMORY_TOKEN_LIMIT = 2000
+
+# When follow-up questions are condensed (see condense.py)
+CONDENSE_MODES = ("always", "auto", "parallel")
+
+# Rewriting a follow-up into a standalone question needs no more than the
+# memory's few thousand tokens, so it doesn't need the 16k model
+CONDENSE_MODEL = "gpt-3.5-turbo"
+
+# How chunks are retrieved (see lexicalsearch.py)
+RETRIEVAL_MODES = ("vector", "hybrid", "lexical")
+
+HISTORY_PATH = "./chat-history.db"
+VIDEOS_PATH = "./videos.jsonl"
@@ -1,5 +1,9 @@
 import os
+import time
 import click
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from googleapiclient.discovery import build
 from youtube_transcript_api import YouTubeTranscriptApi
 from tqdm import tqdm
@@ -9,10 +13,18 @@ import json
 # You need to set up your own YouTube Data API key and insert it here
 API_KEY = os.environ["YOUTUBE_API_KEY"]
 
+# Transcripts are scraped from youtube.com, be gentle with it
+TRANSCRIPT_HOST = "www.youtube.com"
+WORKERS = 8
+REQUESTS_PER_SECOND = 5
+
+# Per-URL newest publishedAt we've synced, kept next to the transcripts
+SYNC_STATE_FILE = ".sync-state.json"
+
 
 def get_video_ids_from_playlist_url(url):
     """Extract video IDs from a given YouTube playlist URL."""
-    youtube = build("youtube", "v3", developerKey=API_KEY)
+    youtube = _youtube()
     playlist_id = url.split("list=")[-1]
     request = youtube.playlistItems().list(
         part="snippet",
@@ -37,7 +49,7 @@ def get_video_ids_from_playlist_url(url):
 
 def get_video_ids_from_channel_url(url):
     """Extract video IDs from a given YouTube channel URL."""
-    youtube = build("youtube", "v3", developerKey=API_KEY)
+    youtube = _youtube()
 
     channel_name = url.rsplit("/", 1)[-1]
     request = youtube.channels().list(part="contentDetails", forUsername=channel_name)
@@ -84,48 +96,70 @@ def get_video_ids(url):
         )
 
 
-def get_video_ids_and_metadata(url):
+def get_video_ids_and_metadata(url, newer_than=None):
     """Determine if the URL is for a playlist or a channel, and call the appropriate function."""
     if "playlist" in url:
-        return get_video_metadata_from_playlist_url(url)
+        return get_video_metadata_from_playlist_url(url, newer_than)
     elif "youtube.com/" in url:
-        return get_video_metadata_from_channel_url(url)
+        return get_video_metadata_from_channel_url(url, newer_than)
     else:
         raise ValueError(
             "Invalid YouTube URL. Please provide a URL for a playlist or a channel."
         )
 
 
-def get_video_metadata_from_playlist_url(url):
-    """Extract video metadata from a given YouTube playlist URL."""
-    youtube = build("youtube", "v3", developerKey=API_KEY)
-    playlist_id = url.split("list=")[-1]
+def _youtube():
+    """Build a YouTube Data API client, YOUTUBE_API_ENDPOINT can point it elsewhere."""
+    client_options = None
+    if "YOUTUBE_API_ENDPOINT" in os.environ:
+        client_options = {"api_endpoint": os.environ["YOUTUBE_API_ENDPOINT"]}
+    return build("youtube", "v3", developerKey=API_KEY, client_options=client_options)
+
+
+def _playlist_snippets(youtube, playlist_id, newer_than=None):
+    """
+    Yield the snippet of every item in a playlist, page by page.
+
+    If `newer_than` is given, only items with a later publishedAt are yielded.
+    An item's publishedAt is when it was added to the playlist. A channel's
+    uploads playlist ("UU...") lists its items newest first, so paging stops at
+    the first page reaching `newer_than`. Other playlists are kept in whatever
+    order their owner arranged them, so they're always paged through in full.
+    """
+    stops_early = newer_than is not None and playlist_id.startswith("UU")
     request = youtube.playlistItems().list(
         part="snippet",
         maxResults=50,
         playlistId=playlist_id,
     )
-    response = request.execute()
-    video_ids = [item["snippet"]["resourceId"]["videoId"] for item in response["items"]]
-    video_metadata = [item["snippet"] for item in response["items"]]
-    while "nextPageToken" in response:
-        request = youtube.playlistItems().list(
-            part="snippet",
-            maxResults=50,
-            playlistId=playlist_id,
-            pageToken=response["nextPageToken"],
-        )
+    while request is not None:
         response = request.execute()
-        video_ids += [
-            item["snippet"]["resourceId"]["videoId"] for item in response["items"]
-        ]
-        video_metadata += [item["snippet"] for item in response["items"]]
+
+        reached_known = False
+        for item in response["items"]:
+            if newer_than is not None and item["snippet"]["publishedAt"] <= newer_than:
+                reached_known = True
+                continue
+            yield item["snippet"]
+
+        if reached_known and stops_early:
+            return
+        request = youtube.playlistItems().list_next(request, response)
+
+
+def get_video_metadata_from_playlist_url(url, newer_than=None):
+    """Extract video metadata from a given YouTube playlist URL."""
+    youtube = _youtube()
+    playlist_id = url.split("list=")[-1]
+
+    video_metadata = list(_playlist_snippets(youtube, playlist_id, newer_than))
+    video_ids = [snippet["resourceId"]["videoId"] for snippet in video_metadata]
     return video_ids, video_metadata
 
 
-def get_video_metadata_from_channel_url(url):
+def get_video_metadata_from_channel_url(url, newer_than=None):
     """Extract video IDs and metadata from a given YouTube channel URL."""
-    youtube = build("youtube", "v3", developerKey=API_KEY)
+    youtube = _youtube()
 
     channel_name = url.rsplit("/", 1)[-1]
     request = youtube.channels().list(part="contentDetails", forUsername=channel_name)
@@ -139,74 +173,205 @@ def get_video_metadata_from_channel_url(url):
         "uploads"
     ]
 
-    request = youtube.playlistItems().list(
-        part="snippet",
-        maxResults=50,
-        playlistId=uploads_playlist_id,
-    )
-    response = request.execute()
+    video_metadata = list(_playlist_snippets(youtube, uploads_playlist_id, newer_than))
+    video_ids = [snippet["resourceId"]["videoId"] for snippet in video_metadata]
+    return video_ids, video_metadata
 
-    video_ids = [item["snippet"]["resourceId"]["videoId"] for item in response["items"]]
-    video_metadata = [item["snippet"] for item in response["items"]]
 
-    while "nextPageToken" in response:
-        request = youtube.playlistItems().list(
-            part="snippet",
-            maxResults=50,
-            playlistId=uploads_playlist_id,
-            pageToken=response["nextPageToken"],
-        )
-        response = request.execute()
+class HostRateLimiter:
+    """Spaces out requests to each host so that no host sees more than `per_second`."""
 
-        video_ids += [
-            item["snippet"]["resourceId"]["videoId"] for item in response["items"]
-        ]
-        video_metadata += [item["snippet"] for item in response["items"]]
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0.0
+        self.next_slot = {}
+        self.lock = threading.Lock()
 
-    return video_ids, video_metadata
+    def wait(self, host):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        time.sleep(max(0.0, slot - now))
 
 
-def download_transcripts(video_ids, video_metadata, output_path):
-    """Download transcripts for a list of video IDs."""
-    print(Fore.GREEN + "Downloading transcripts..." + Style.RESET_ALL)
+def load_sync_state(output_path):
+    try:
+        with open(os.path.join(output_path, SYNC_STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
 
-    for video_id, metadata in zip(
-        tqdm(video_ids, bar_format="{l_bar}{bar:20}{r_bar}{bar:-20b}"), video_metadata
-    ):
-        try:
-            transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
-            transcript = transcript_list.find_generated_transcript(["en"])
-            os.makedirs(output_path, exist_ok=True)
-            with open(os.path.join(output_path, f"{video_id}.json"), "w") as f:
-                video_info = metadata
-                video_info["transcript"] = []
-                video_info["url"] = f"https://youtube.com/watch?v={video_id}"
-
-                for line in transcript.fetch():
-                    video_info["transcript"].append(
-                        {
-                            "text": line["text"],
-                            "start": line["start"],
-                            "duration": line["duration"],
-                        }
-                    )
-                json.dump(video_info, f)
-        except Exception as e:
-            print(
-                Fore.RED
-                + f"Failed to download transcript for video {video_id}: {e}"
-                + Style.RESET_ALL
-            )
+def save_sync_state(output_path, state):
+    path = os.path.join(output_path, SYNC_STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def fetch_transcript(video_id):
+    """Fetch the English auto-generated transcript for a video."""
+    transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
+    transcript = transcript_list.find_generated_transcript(["en"])
+    return transcript.fetch()
+
+
+def build_video_info(video_id, metadata, lines):
+    """Combine a video's playlist snippet with its transcript lines."""
+    video_info = metadata
+    video_info["transcript"] = []
+    video_info["url"] = f"https://youtube.com/watch?v={video_id}"
+
+    for line in lines:
+        video_info["transcript"].append(
+            {
+                "text": line["text"],
+                "start": line["start"],
+                "duration": line["duration"],
+            }
+        )
+    return video_info
+
+
+def download_transcript(
+    video_id, metadata, output_path, limiter, force=False, fetch=fetch_transcript
+):
+    """
+    Download a single transcript to `<output_path>/<video_id>.json`.
+
+    Returns "skipped" if the file already exists (and `force` is off),
+    "downloaded" or "failed".
+    """
+    path = os.path.join(output_path, f"{video_id}.json")
+    if not force and os.path.exists(path):
+        return "skipped"
+
+    try:
+        limiter.wait(TRANSCRIPT_HOST)
+        lines = fetch(video_id)
+    except Exception as e:
+        tqdm.write(
+            Fore.RED
+            + f"Failed to download transcript for video {video_id}: {e}"
+            + Style.RESET_ALL
+        )
+        return "failed"
+
+    video_info = build_video_info(video_id, metadata, lines)
+
+    # write to a temporary file first so an interrupted run never leaves a
+    # truncated transcript behind that would be skipped next time
+    with open(path + ".tmp", "w") as f:
+        json.dump(video_info, f)
+    os.replace(path + ".tmp", path)
+    return "downloaded"
+
+
+def download_transcripts(
+    video_ids,
+    video_metadata,
+    output_path,
+    workers=WORKERS,
+    requests_per_second=REQUESTS_PER_SECOND,
+    force=False,
+    fetch=fetch_transcript,
+):
+    """
+    Download transcripts for a list of video IDs using a pool of `workers`
+    threads, with at most `requests_per_second` transcript requests a second.
+
+    Returns a dict of video ID to "downloaded", "skipped" or "failed".
+    """
+    print(Fore.GREEN + "Downloading transcripts..." + Style.RESET_ALL)
+    os.makedirs(output_path, exist_ok=True)
+
+    limiter = HostRateLimiter(requests_per_second)
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                download_transcript,
+                video_id,
+                metadata,
+                output_path,
+                limiter,
+                force,
+                fetch,
+            ): video_id
+            for video_id, metadata in zip(video_ids, video_metadata)
+        }
+        for future in tqdm(
+            as_completed(futures),
+            total=len(futures),
+            bar_format="{l_bar}{bar:20}{r_bar}{bar:-20b}",
+        ):
+            results[futures[future]] = future.result()
+
+    return results
+
+
+def _sync_watermark(published, results, previous):
+    """
+    The newest publishedAt we can safely skip next time: everything up to it
+    has been downloaded (or was already on disk). Videos that failed, e.g.
+    because their captions aren't ready yet, stay after the watermark so the
+    next sync tries them again.
+
+    `published` is a list of (publishedAt, video_id) pairs.
+    """
+    failed = [p for p, video_id in published if results.get(video_id) == "failed"]
+
+    candidates = [p for p, _ in published if not failed or p < min(failed)]
+    if previous is not None:
+        candidates.append(previous)
+    return max(candidates) if candidates else None
 
 
 @click.command()
 @click.argument("url")
 @click.argument("output_path")
-def main(url, output_path):
+@click.option("--workers", default=WORKERS, help="Number of parallel downloads.")
+@click.option(
+    "--rate",
+    default=REQUESTS_PER_SECOND,
+    help="Maximum transcript requests per second.",
+)
+@click.option("--force", is_flag=True, help="Re-download transcripts already on disk.")
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only list videos added since the last incremental run of this URL.",
+)
+def main(url, output_path, workers, rate, force, incremental):
     """Main function to be run from the command line."""
+    os.makedirs(output_path, exist_ok=True)
+    state = load_sync_state(output_path)
+    newer_than = state.get(url) if incremental else None
+
     print(Fore.GREEN + "Fetching video IDs and metadata..." + Style.RESET_ALL)
-    video_ids, video_metadata = get_video_ids_and_metadata(url)
-    download_transcripts(video_ids, video_metadata, output_path)
+    video_ids, video_metadata = get_video_ids_and_metadata(url, newer_than)
+    if newer_than is not None:
+        print(f"{len(video_ids)} videos added since {newer_than}")
+
+    results = download_transcripts(
+        video_ids, video_metadata, output_path, workers, rate, force
+    )
+
+    counts = Counter(results.values())
+    print(
+        f"{counts['downloaded']} downloaded, {counts['skipped']} already on disk, "
+        f"{counts['failed']} failed"
+    )
+
+    published = [
+        (snippet["publishedAt"], snippet["resourceId"]["videoId"])
+        for snippet in video_metadata
+    ]
+    watermark = _sync_watermark(published, results, state.get(url))
+    if watermark is not None:
+        state[url] = watermark
+        save_sync_state(output_path, state)
+
     print(Fore.GREEN + "Done!" + Style.RESET_ALL)
 
 
@@ -0,0 +1,206 @@
+"""
+A single-file, content-addressed cache of embeddings.
+
+Vectors are keyed by a hash of the model name and the normalized chunk text,
+so they survive re-chunking and id changes: a chunk only costs an API call the
+first time its text is seen.
+
+    python embedding_cache.py stats
+    python embedding_cache.py compact --older-than 90 --keep chunks.jsonl
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import time
+import unicodedata
+
+import click
+import numpy as np
+
+DEFAULT_PATH = "./embedding-cache.db"
+
+# SQLite limits the number of bound parameters per statement, stay below it
+LOOKUP_BATCH_SIZE = 500
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    return _whitespace.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path=DEFAULT_PATH, model="text-embedding-ada-002"):
+        self.path = path
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+
+        # the cache may be handed to a worker thread, but is only ever used
+        # from one thread at a time
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used INTEGER NOT NULL
+            ) WITHOUT ROWID
+            """)
+        self.db.commit()
+
+    def key(self, text):
+        return cache_key(self.model, text)
+
+    def get_many(self, texts):
+        """
+        Looks up a list of texts, returning a list with a float32 vector for
+        each text that is cached and None for each one that isn't.
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            batch = keys[start : start + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                batch,
+            )
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+
+        if found:
+            now = int(time.time())
+            self.db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self.db.commit()
+
+        vectors = [found.get(key) for key in keys]
+        hits = sum(1 for vector in vectors if vector is not None)
+        self.hits += hits
+        self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, texts, vectors):
+        now = int(time.time())
+        self.db.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+            [
+                (
+                    self.key(text),
+                    self.model,
+                    np.asarray(vector, dtype=np.float32).tobytes(),
+                    now,
+                )
+                for text, vector in zip(texts, vectors)
+            ],
+        )
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats_line(self):
+        return (
+            f"Embedding cache: {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate():.1%} hit rate), {len(self)} vectors stored"
+        )
+
+    def compact(self, older_than_days=None, keep_texts=None):
+        """
+        Evicts entries that haven't been used for `older_than_days` days,
+        and/or every entry whose text isn't in `keep_texts`, then reclaims the
+        space on disk. Returns the number of entries evicted.
+        """
+        before = len(self)
+
+        if older_than_days is not None:
+            cutoff = int(time.time() - older_than_days * 86400)
+            self.db.execute("DELETE FROM embeddings WHERE last_used < ?", (cutoff,))
+
+        if keep_texts is not None:
+            self.db.execute("CREATE TEMP TABLE keep (key BLOB PRIMARY KEY)")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO keep (key) VALUES (?)",
+                ((self.key(text),) for text in keep_texts),
+            )
+            self.db.execute(
+                "DELETE FROM embeddings WHERE model = ? AND key NOT IN (SELECT key FROM keep)",
+                (self.model,),
+            )
+            self.db.execute("DROP TABLE keep")
+
+        self.db.commit()
+        self.db.execute("VACUUM")
+        return before - len(self)
+
+    def close(self):
+        self.db.close()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--cache", "cache_path", default=DEFAULT_PATH)
+def stats(cache_path):
+    """Print the size of the cache."""
+    cache = EmbeddingCache(cache_path)
+    rows = cache.db.execute(
+        "SELECT model, COUNT(*), SUM(LENGTH(vector)), MIN(last_used), MAX(last_used) "
+        "FROM embeddings GROUP BY model"
+    ).fetchall()
+    for model, count, size, oldest, newest in rows:
+        print(
+            f"{model}: {count} vectors, {size / 1e6:.1f} MB, last used between "
+            f"{time.ctime(oldest)} and {time.ctime(newest)}"
+        )
+    cache.close()
+
+
+@cli.command()
+@click.option("--cache", "cache_path", default=DEFAULT_PATH)
+@click.option(
+    "--older-than",
+    type=int,
+    default=None,
+    help="Evict entries not used in this many days.",
+)
+@click.option(
+    "--keep",
+    "keep_file",
+    default=None,
+    help="Chunk JSONL file, evict every entry whose text isn't in it.",
+)
+@click.option("--model", default="text-embedding-ada-002")
+def compact(cache_path, older_than, keep_file, model):
+    """Evict stale entries and reclaim disk space."""
+    cache = EmbeddingCache(cache_path, model=model)
+
+    keep_texts = None
+    if keep_file is not None:
+        keep_texts = (json.loads(line)["text"] for line in open(keep_file))
+
+    evicted = cache.compact(older_than_days=older_than, keep_texts=keep_texts)
+    print(f"Evicted {evicted} entries, {len(cache)} remaining.")
+    cache.close()
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,37 +1,393 @@
 import os
 import json
+import time
 import click
 import openai
+import asyncio
 import logging
-from retrying import retry
+import tiktoken
+import itertools
+import threading
 from tqdm import tqdm
 
+import embedding_cache
+import vectorfile
 
-def retry_if_result_none(result):
-    """Return True if we should retry (in this case when result is None), False otherwise"""
-    return result is None
+EMBEDDING_MODEL = "text-embedding-ada-002"
 
+# Limits for a single embeddings request. The API accepts up to 2048 inputs per
+# request, we stay well under that and also cap the total number of tokens.
+BATCH_MAX_INPUTS = 500
+BATCH_MAX_TOKENS = 50000
 
-@retry(
-    retry_on_result=retry_if_result_none,
-    wait_exponential_multiplier=1000,
-    wait_exponential_max=10000,
-)
-def get_embedding(text):
-    # generate embedding for the text field
-    embedding = (
-        openai.Embedding.create(model="text-embedding-ada-002", input=text)
-        .data[0]
-        .embedding
+# Account-wide budgets for the embeddings endpoint, and how many requests we
+# keep in flight at once.
+REQUESTS_PER_MINUTE = 3000
+TOKENS_PER_MINUTE = 1000000
+CONCURRENCY = 8
+
+MAX_ATTEMPTS = 6
+
+# Number of chunks looked up in the embedding cache at once
+LOOKUP_SIZE = 1000
+
+encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+
+class TokenBucket:
+    """
+    A bucket that refills continuously at `per_minute / 60` units a second, up
+    to a maximum of `per_minute` units.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def delay_for(self, amount):
+        """Seconds to wait until `amount` units are available."""
+        self._refill()
+        # a request bigger than the whole bucket goes through once it's full
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    Keeps requests under the requests-per-minute and tokens-per-minute budgets,
+    and holds everyone back after the API tells us to slow down.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, num_tokens):
+        async with self.lock:
+            while True:
+                delay = max(
+                    self.resume_at - time.monotonic(),
+                    self.requests.delay_for(1),
+                    self.tokens.delay_for(num_tokens),
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            self.requests.take(1)
+            self.tokens.take(num_tokens)
+
+    def back_off(self, seconds):
+        # rate limits are per account, so one 429 pauses every worker
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+
+def _retry_after(error, attempt):
+    """How long to wait before retrying after `error`, preferring the server's advice"""
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(2**attempt, 10)
+
+
+async def get_embeddings(texts, num_tokens, limiter):
+    """
+    Generates embeddings for a batch of texts in a single request.
+
+    Rate limit responses honor the Retry-After header, other transient errors
+    are retried with exponential backoff. Rejected inputs are raised straight
+    away since retrying them won't help.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        await limiter.acquire(num_tokens)
+        try:
+            response = await openai.Embedding.acreate(
+                model=EMBEDDING_MODEL, input=texts
+            )
+        except openai.error.RateLimitError as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = _retry_after(e, attempt)
+            logging.warning(f"Rate limited, backing off for {delay:.1f}s...")
+            limiter.back_off(delay)
+            continue
+        except (
+            openai.error.APIError,
+            openai.error.APIConnectionError,
+            openai.error.ServiceUnavailableError,
+            openai.error.Timeout,
+        ) as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = _retry_after(e, attempt)
+            logging.warning(f"Embeddings request failed ({e}), retrying in {delay}s...")
+            await asyncio.sleep(delay)
+            continue
+
+        # the results carry the index of the input they belong to, use it to put
+        # them back in order
+        embeddings = [None] * len(texts)
+        for item in response.data:
+            embeddings[item.index] = item.embedding
+
+        if any(embedding is None for embedding in embeddings):
+            raise openai.error.APIError("Response is missing embeddings")
+        return embeddings
+
+
+def batch_entries(entries, max_inputs=BATCH_MAX_INPUTS, max_tokens=BATCH_MAX_TOKENS):
+    """
+    Groups entries into batches for the embeddings endpoint, yielding
+    (batch, num_tokens) pairs.
+
+    A batch is closed when adding the next entry would take it over either
+    `max_inputs` entries or `max_tokens` tokens. An entry that is larger than
+    `max_tokens` on its own is sent as a batch of one.
+    """
+    batch = []
+    batch_tokens = 0
+    for entry in entries:
+        num_tokens = len(encoding.encode(entry["text"]))
+        if batch and (
+            len(batch) >= max_inputs or batch_tokens + num_tokens > max_tokens
+        ):
+            yield batch, batch_tokens
+            batch = []
+            batch_tokens = 0
+        batch.append(entry)
+        batch_tokens += num_tokens
+
+    if batch:
+        yield batch, batch_tokens
+
+
+def count_tokens(batch):
+    return sum(
+        len(tokens) for tokens in encoding.encode_batch([e["text"] for e in batch])
     )
 
-    return embedding
+
+async def embed_batch(batch, num_tokens, limiter):
+    """
+    Embeds a batch of entries, returning (entry, embedding) pairs.
+
+    If the request keeps failing after retries, the batch is split in half and
+    each half is tried separately, so that a single bad input only costs us
+    that input rather than the whole batch.
+    """
+    try:
+        embeddings = await get_embeddings(
+            [entry["text"] for entry in batch], num_tokens, limiter
+        )
+    except Exception as e:
+        if len(batch) == 1:
+            logging.error(f"Failed to embed item {batch[0]['id']}: {e}")
+            return []
+
+        logging.warning(
+            f"Batch of {len(batch)} items failed ({e}), splitting it in half..."
+        )
+        middle = len(batch) // 2
+        left, right = batch[:middle], batch[middle:]
+        return await embed_batch(left, count_tokens(left), limiter) + await embed_batch(
+            right, count_tokens(right), limiter
+        )
+
+    return list(zip(batch, embeddings))
+
+
+class BackgroundEmbedder:
+    """
+    Runs the embedding engine on an event loop in a background thread, for
+    callers that aren't async themselves. `submit` returns a
+    concurrent.futures.Future of the batch's (entry, embedding) pairs.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE,
+    ):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        async def make_limiter():
+            return RateLimiter(requests_per_minute, tokens_per_minute)
+
+        self.limiter = asyncio.run_coroutine_threadsafe(
+            make_limiter(), self.loop
+        ).result()
+
+    def submit(self, batch, num_tokens):
+        return asyncio.run_coroutine_threadsafe(
+            embed_batch(batch, num_tokens, self.limiter), self.loop
+        )
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def read_entries(infile):
+    for line in infile:
+        yield json.loads(line)
+
+
+def skip_cached(entries, cache, writer, progress, lookup_size=LOOKUP_SIZE):
+    """
+    Looks entries up in the embedding cache `lookup_size` at a time. Entries
+    whose text has been embedded before are written straight to `writer`, the
+    rest are yielded to be embedded.
+    """
+    entries = iter(entries)
+    while True:
+        group = list(itertools.islice(entries, lookup_size))
+        if not group:
+            return
+
+        vectors = cache.get_many([data["text"] for data in group])
+        for data, vector in zip(group, vectors):
+            if vector is None:
+                yield data
+                continue
+
+            writer.write(data, vector)
+            progress.update(1)
+
+
+async def embed_entries(
+    batches,
+    writer,
+    progress,
+    cache,
+    concurrency=CONCURRENCY,
+    requests_per_minute=REQUESTS_PER_MINUTE,
+    tokens_per_minute=TOKENS_PER_MINUTE,
+):
+    """
+    Embeds batches with up to `concurrency` requests in flight, writing each
+    entry to `writer` and storing it in `cache` as soon as its batch completes.
+
+    Lines are written in completion order rather than input order, every line
+    carries its id.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    started = time.monotonic()
+    embedded_tokens = 0
+    in_flight = 0
+
+    def report():
+        elapsed = max(time.monotonic() - started, 1e-9)
+        progress.set_postfix(
+            tokens_per_sec=f"{embedded_tokens / elapsed:,.0f}",
+            in_flight=in_flight,
+            queued=queue.qsize(),
+        )
+
+    async def worker():
+        nonlocal embedded_tokens, in_flight
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+
+            batch, num_tokens = item
+            in_flight += 1
+            try:
+                results = await embed_batch(batch, num_tokens, limiter)
+            finally:
+                in_flight -= 1
+
+            for data, embedding in results:
+                writer.write(data, embedding)
+            if results:
+                cache.put_many(
+                    [data["text"] for data, _ in results],
+                    [embedding for _, embedding in results],
+                )
+
+            # entries that failed even on their own weren't embedded
+            if len(results) < len(batch):
+                num_tokens = count_tokens([data for data, _ in results])
+            embedded_tokens += num_tokens
+            progress.update(len(batch))
+            report()
+
+    async def produce():
+        for batch in batches:
+            await queue.put(batch)
+            report()
+        for _ in workers:
+            await queue.put(None)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    tasks = [asyncio.ensure_future(produce())] + workers
+    try:
+        # A worker that dies (say writing fails) stops taking batches, and
+        # the producer would wait on the full queue forever, so stop at the
+        # first error instead
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 @click.command()
 @click.argument("input_file")
 @click.argument("output_file")
-def process_file(input_file, output_file):
+@click.option(
+    "--batch-size",
+    default=BATCH_MAX_INPUTS,
+    help="Maximum number of chunks sent in a single embeddings request.",
+)
+@click.option(
+    "--batch-tokens",
+    default=BATCH_MAX_TOKENS,
+    help="Maximum number of tokens sent in a single embeddings request.",
+)
+@click.option(
+    "--concurrency",
+    default=CONCURRENCY,
+    help="Number of embeddings requests to keep in flight.",
+)
+@click.option("--rpm", default=REQUESTS_PER_MINUTE, help="Requests per minute budget.")
+@click.option("--tpm", default=TOKENS_PER_MINUTE, help="Tokens per minute budget.")
+@click.option(
+    "--cache",
+    "cache_path",
+    default=embedding_cache.DEFAULT_PATH,
+    help="Embedding cache file, text that is already in it isn't embedded again.",
+)
+def process_file(
+    input_file, output_file, batch_size, batch_tokens, concurrency, rpm, tpm, cache_path
+):
     openai.api_key = os.environ["OPENAI_API_KEY"]
 
     # Set up logging
@@ -40,36 +396,19 @@ def process_file(input_file, output_file):
     # Count the lines in the file for the progress bar
     num_lines = sum(1 for _ in open(input_file))
 
-    with open(input_file, "r") as infile, open(output_file, "w") as outfile:
-        for line in tqdm(infile, total=num_lines):
-            data = json.loads(line)
-
-            if os.path.exists("./embedded/" + data["id"]):
-                logging.info(f"Item {data['id']} already exists in index. Skipping...")
-                continue
-
-            # get the embedding with retry + backoff
-            embedding = get_embedding(data["text"])
-
-            # log the id and length of the embedding
-            logging.info(
-                f'Generated embedding for id {data["id"]}, length: {len(embedding)}'
-            )
-
-            # add the embedding before the metadata key
-            data = {
-                "id": data["id"],
-                "text": data["text"],
-                "embedding": embedding,
-                "metadata": data["metadata"],
-            }
+    cache = embedding_cache.EmbeddingCache(cache_path, model=EMBEDDING_MODEL)
 
-            json.dump(data, outfile)
-            outfile.write("\n")
+    with open(input_file, "r") as infile, vectorfile.open_writer(
+        output_file
+    ) as writer, tqdm(total=num_lines) as progress:
+        entries = skip_cached(read_entries(infile), cache, writer, progress)
+        batches = batch_entries(entries, batch_size, batch_tokens)
+        asyncio.run(
+            embed_entries(batches, writer, progress, cache, concurrency, rpm, tpm)
+        )
 
-            # after upserting, write the itemid to a file in the ./indexed folder, so we know it's been indexed
-            with open("./embedded/" + data["id"], "w") as f:
-                f.write("")
+    logging.info(cache.stats_line())
+    cache.close()
 
 
 if __name__ == "__main__":
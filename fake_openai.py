@@ -0,0 +1,216 @@
+"""
+A tiny stand-in for the OpenAI HTTP API, for exercising the pipeline offline.
+
+Point the openai client at it with OPENAI_API_BASE=http://127.0.0.1:8765/v1
+(any OPENAI_API_KEY will do). Embeddings are deterministic pseudo-random unit
+vectors derived from a hash of the input text, so the same text always gets the
+same vector. Chat completions answer with a canned reply quoting the last line
+of the prompt, streamed a word at a time when the client asks for a stream.
+"""
+
+import hashlib
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import numpy as np
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+def fake_embedding(text, dimensions=EMBEDDING_DIMENSIONS):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+
+def _detokenize(tokens):
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base").decode(tokens)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # These are set on the server object by `serve`
+    #   server.latency: seconds to sleep before answering each request
+    #   server.fail_on: inputs containing this substring make the request fail
+    #   server.rate_limit_every: answer every Nth request with a 429
+    #   server.token_latency: seconds between streamed chat tokens
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_POST(self):
+        request = self._read_json()
+        time.sleep(self.server.latency)
+        self.server.requests += 1
+
+        every = self.server.rate_limit_every
+        if every and self.server.requests % every == 0:
+            return self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                headers={"Retry-After": "1"},
+            )
+
+        if self.path.endswith("/embeddings"):
+            return self._embeddings(request)
+        if self.path.endswith("/chat/completions"):
+            return self._chat_completions(request)
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def _embeddings(self, request):
+        inputs = request["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        # LangChain's OpenAIEmbeddings sends token ids rather than text
+        inputs = [
+            _detokenize(text) if isinstance(text, list) else text for text in inputs
+        ]
+
+        if self.server.fail_on and any(self.server.fail_on in text for text in inputs):
+            return self._send_json(
+                400,
+                {
+                    "error": {
+                        "message": "Invalid input",
+                        "type": "invalid_request_error",
+                    }
+                },
+            )
+
+        self.server.inputs += len(inputs)
+        data = [
+            {"object": "embedding", "index": index, "embedding": fake_embedding(text)}
+            for index, text in enumerate(inputs)
+        ]
+        # The real API doesn't promise ordered results, so don't give them
+        data.reverse()
+        self._send_json(
+            200,
+            {
+                "object": "list",
+                "data": data,
+                "model": request.get("model"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            },
+        )
+
+    def _chat_completions(self, request):
+        reply = fake_reply(request["messages"])
+        if not request.get("stream"):
+            return self._send_json(
+                200,
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0,
+                        "total_tokens": 0,
+                    },
+                },
+            )
+
+        # Server-sent events, one per word, ending the connection after the last
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        deltas = [{"role": "assistant"}] + [
+            {"content": word} for word in re.findall(r"\S+\s*", reply)
+        ]
+        for i, delta in enumerate(deltas):
+            if i > 1:
+                time.sleep(self.server.token_latency)
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def fake_reply(messages):
+    lines = messages[-1]["content"].strip().splitlines() if messages else []
+    last_line = lines[-1] if lines else ""
+    return (
+        f"You asked about {last_line!r}. Keep your water clean, don't overfeed, "
+        "and give your fish plenty of plants to hide in."
+    )
+
+
+def make_server(
+    host="127.0.0.1",
+    port=8765,
+    latency=0.0,
+    fail_on=None,
+    rate_limit_every=0,
+    token_latency=0.05,
+):
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_on = fail_on
+    server.rate_limit_every = rate_limit_every
+    server.token_latency = token_latency
+    server.requests = 0
+    server.inputs = 0
+    return server
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8765)
+@click.option("--latency", default=0.0, help="Seconds to wait before each response.")
+@click.option("--fail-on", default=None, help="Reject batches containing this text.")
+@click.option(
+    "--rate-limit-every", default=0, help="Answer every Nth request with a 429."
+)
+@click.option(
+    "--token-latency", default=0.05, help="Seconds between streamed chat tokens."
+)
+def serve(host, port, latency, fail_on, rate_limit_every, token_latency):
+    server = make_server(host, port, latency, fail_on, rate_limit_every, token_latency)
+    print(f"Fake OpenAI API listening on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    serve()
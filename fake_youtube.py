@@ -0,0 +1,229 @@
+"""
+A tiny stand-in for YouTube, for exercising download_transcripts.py offline.
+
+It answers the two YouTube Data API calls the downloader makes (channels and
+playlistItems) and the watch page and timed text that youtube_transcript_api
+scrapes transcripts from. Point the API client at it with
+YOUTUBE_API_ENDPOINT=http://127.0.0.1:8766 (any YOUTUBE_API_KEY will do). The
+transcript scraper has no setting for its host, so tests swap
+youtube_transcript_api._transcripts.WATCH_URL for `server.watch_url`.
+
+The server starts with one channel, `fishchannel`, whose uploads playlist
+UUfishchannel lists its videos newest first, and a playlist PLfavourites of
+some of them listed oldest addition first, as a user might arrange them.
+Transcripts are bench.synthetic_video's.
+"""
+
+import json
+import random
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import click
+
+import bench
+
+CHANNEL = "fishchannel"
+UPLOADS = "UUfishchannel"
+FAVOURITES = "PLfavourites"
+
+
+def playlist_item(video_id, published_at, title):
+    return {
+        "kind": "youtube#playlistItem",
+        "id": f"item-{video_id}",
+        "snippet": {
+            "publishedAt": published_at,
+            "channelId": f"UC{CHANNEL}",
+            "title": title,
+            "description": "",
+            "resourceId": {"kind": "youtube#video", "videoId": video_id},
+        },
+    }
+
+
+class FakeYouTubeHandler(BaseHTTPRequestHandler):
+    # These are set on the server object by `make_server`
+    #   server.playlists: playlist ID to its items, in listing order
+    #   server.transcripts: video ID to its transcript lines, videos missing
+    #     from it have captions turned off
+    #   server.page_requests: playlist ID to the number of pages listed
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload):
+        self._send(status, json.dumps(payload), "application/json")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == "/youtube/v3/channels":
+            return self._channels(query)
+        if url.path == "/youtube/v3/playlistItems":
+            return self._playlist_items(query)
+        if url.path == "/watch":
+            return self._watch(query["v"])
+        if url.path == "/api/timedtext":
+            return self._timed_text(query["v"])
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def _channels(self, query):
+        items = []
+        if query.get("forUsername") == CHANNEL:
+            items.append(
+                {
+                    "kind": "youtube#channel",
+                    "id": f"UC{CHANNEL}",
+                    "contentDetails": {"relatedPlaylists": {"uploads": UPLOADS}},
+                }
+            )
+        self._send_json(200, {"kind": "youtube#channelListResponse", "items": items})
+
+    def _playlist_items(self, query):
+        playlist_id = query["playlistId"]
+        if playlist_id not in self.server.playlists:
+            return self._send_json(
+                404, {"error": {"code": 404, "message": "playlistNotFound"}}
+            )
+        items = self.server.playlists[playlist_id]
+        self.server.page_requests[playlist_id] = (
+            self.server.page_requests.get(playlist_id, 0) + 1
+        )
+
+        offset = int(query.get("pageToken", 0))
+        page_size = min(int(query.get("maxResults", 5)), 50)
+        response = {
+            "kind": "youtube#playlistItemListResponse",
+            "items": items[offset : offset + page_size],
+            "pageInfo": {"totalResults": len(items), "resultsPerPage": page_size},
+        }
+        if offset + page_size < len(items):
+            response["nextPageToken"] = str(offset + page_size)
+        self._send_json(200, response)
+
+    def _watch(self, video_id):
+        # just enough of a watch page for youtube_transcript_api to find the
+        # caption tracks in, or to see that captions are off
+        player = {"playabilityStatus": {"status": "OK"}}
+        if video_id in self.server.transcripts:
+            host, port = self.server.server_address
+            player["captions"] = {
+                "playerCaptionsTracklistRenderer": {
+                    "captionTracks": [
+                        {
+                            "baseUrl": f"http://{host}:{port}/api/timedtext?v={video_id}",
+                            "name": {"simpleText": "English (auto-generated)"},
+                            "languageCode": "en",
+                            "kind": "asr",
+                            "isTranslatable": False,
+                        }
+                    ],
+                    "translationLanguages": [],
+                }
+            }
+        player["videoDetails"] = {"videoId": video_id}
+        # the scraper splits the page on '"captions":' and ',"videoDetails'
+        # so the separators must be exactly these
+        player_json = json.dumps(player, separators=(",", ":"))
+        self._send(
+            200,
+            f"<html><body><script>var ytInitialPlayerResponse = {player_json};"
+            "</script></body></html>",
+            "text/html",
+        )
+
+    def _timed_text(self, video_id):
+        if video_id not in self.server.transcripts:
+            return self._send(404, "", "text/xml")
+        lines = "".join(
+            f'<text start="{line["start"]}" dur="{line["duration"]}">'
+            f'{escape(line["text"])}</text>'
+            for line in self.server.transcripts[video_id]
+        )
+        self._send(
+            200,
+            f'<?xml version="1.0" encoding="utf-8" ?><transcript>{lines}</transcript>',
+            "text/xml",
+        )
+
+
+def publish(server, video_id, published_at, lines=5, captions=True, seed=0):
+    """Put a new video at the top of the channel's uploads playlist."""
+    video = bench.synthetic_video(seed, lines, random.Random(seed))
+    server.playlists[UPLOADS].insert(
+        0, playlist_item(video_id, published_at, video["title"])
+    )
+    if captions:
+        server.transcripts[video_id] = video["transcript"]
+
+
+def add_to_playlist(server, playlist_id, video_id, added_at):
+    """Add a video to the end of a playlist, as a user arranging one would."""
+    title = f"Video {video_id}"
+    server.playlists[playlist_id].append(playlist_item(video_id, added_at, title))
+
+
+def make_server(host="127.0.0.1", port=8766, videos=120, favourites=60):
+    """
+    A fake YouTube with `videos` uploads on `fishchannel`, one a day, and the
+    oldest `favourites` of them in the PLfavourites playlist, added one a
+    minute in the order they're listed.
+    """
+    server = ThreadingHTTPServer((host, port), FakeYouTubeHandler)
+    server.daemon_threads = True
+    server.playlists = {UPLOADS: [], FAVOURITES: []}
+    server.transcripts = {}
+    server.page_requests = {}
+
+    for i in range(videos):
+        day = 1 + i % 28
+        publish(
+            server,
+            f"video{i:05d}",
+            f"2023-{1 + i // 28:02d}-{day:02d}T12:00:00Z",
+            seed=i,
+        )
+    server.playlists[FAVOURITES] = [
+        playlist_item(
+            item["snippet"]["resourceId"]["videoId"],
+            f"2024-01-01T{12 + i // 60:02d}:{i % 60:02d}:00Z",
+            item["snippet"]["title"],
+        )
+        for i, item in enumerate(server.playlists[UPLOADS][-favourites:])
+    ]
+
+    host, port = server.server_address
+    server.api_endpoint = f"http://{host}:{port}"
+    server.watch_url = f"http://{host}:{port}/watch?v={{video_id}}"
+    return server
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8766)
+@click.option("--videos", default=120, help="Number of videos on the channel.")
+def serve(host, port, videos):
+    server = make_server(host, port, videos)
+    print(f"Fake YouTube listening on {server.api_endpoint}")
+    print(f"  channel https://www.youtube.com/user/{CHANNEL}")
+    print(f"  playlist https://www.youtube.com/playlist?list={FAVOURITES}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    serve()
@@ -1,57 +1,195 @@
 import click
+import hashlib
 import json
+from collections import Counter
 from tqdm import tqdm
 
 import chromadb
 from chromadb.config import Settings
 
+import quantize
+import vectorfile
+
 # Initialize chroma client and create collection
 chroma_client = chromadb.Client(
     Settings(chroma_db_impl="duckdb+parquet", persist_directory="./chroma.db")
 )
 collection = chroma_client.get_or_create_collection(name="aquarium-co-op-youtube")
 
+# Ids are deleted this many at a time
+DELETE_BATCH_SIZE = 1000
+
+
+def content_hash(text, metadata):
+    """Hash of everything we store for a chunk, other than its embedding"""
+    payload = json.dumps({"text": text, "metadata": metadata}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class IncrementalIndexer:
+    """
+    Brings the collection in line with a stream of chunks, touching only what
+    changed.
+
+    The first time a video shows up, the ids and content hashes of its chunks
+    already in the collection are loaded. Incoming chunks are then added if
+    they are new, replaced if their hash differs, and skipped otherwise. Once
+    everything has been written, `finish` deletes chunks of those videos that
+    weren't in the stream, e.g. because the video was re-chunked into fewer
+    pieces. Videos that don't appear in the stream are left alone.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.existing = {}
+        self.seen = {}
+        self.counts = Counter()
+
+    def _existing_hashes(self, video_id):
+        result = self.collection.get(
+            where={"video_id": video_id}, include=["metadatas"]
+        )
+        return {
+            id: (metadata or {}).get("content_hash")
+            for id, metadata in zip(result["ids"], result["metadatas"])
+        }
+
+    def write(self, ids, documents, metadatas, embeddings):
+        new = []
+        changed = []
+        for i, (id, document, metadata) in enumerate(zip(ids, documents, metadatas)):
+            video_id = metadata["video_id"]
+            if video_id not in self.existing:
+                self.existing[video_id] = self._existing_hashes(video_id)
+                self.seen[video_id] = set()
+            self.seen[video_id].add(id)
+
+            digest = content_hash(document, metadata)
+            previous = self.existing[video_id].get(id)
+            if previous is None:
+                new.append((i, digest))
+            elif previous != digest:
+                changed.append((i, digest))
+            else:
+                self.counts["unchanged"] += 1
+
+        for rows, write in ((new, self.collection.add), (changed, self._replace)):
+            if not rows:
+                continue
+            write(
+                ids=[ids[i] for i, _ in rows],
+                documents=[documents[i] for i, _ in rows],
+                metadatas=[dict(metadatas[i], content_hash=h) for i, h in rows],
+                embeddings=[
+                    (
+                        embeddings[i].tolist()
+                        if hasattr(embeddings[i], "tolist")
+                        else embeddings[i]
+                    )
+                    for i, _ in rows
+                ],
+            )
+
+        self.counts["added"] += len(new)
+        self.counts["updated"] += len(changed)
+
+    def _replace(self, ids, documents, metadatas, embeddings):
+        # Chroma's own upsert/update rewrite rows one at a time and are an
+        # order of magnitude slower than deleting the old rows and adding new ones
+        self.collection.delete(ids=ids)
+        self.collection.add(
+            ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings
+        )
+
+    def finish(self, keep=()):
+        """
+        Deletes stale chunks of the videos seen, and returns the counts.
+
+        `keep` are ids that were in the stream but couldn't be written, e.g.
+        because they failed to embed: their rows from before stay.
+        """
+        stale = [
+            id
+            for video_id, existing in self.existing.items()
+            for id in existing
+            if id not in self.seen[video_id] and id not in keep
+        ]
+        for start in range(0, len(stale), DELETE_BATCH_SIZE):
+            self.collection.delete(ids=stale[start : start + DELETE_BATCH_SIZE])
+
+        self.counts["deleted"] = len(stale)
+        self.counts["videos"] = len(self.existing)
+        return self.counts
+
+    def summary(self):
+        counts = self.counts
+        return (
+            f"{counts['videos']} videos: {counts['added']} chunks added, "
+            f"{counts['updated']} updated, {counts['deleted']} deleted, "
+            f"{counts['unchanged']} unchanged"
+        )
+
 
 @click.command()
 @click.argument("input_file")
-def index_file(input_file):
-    # Count the lines in the file for the progress bar
-    num_lines = sum(1 for _ in open(input_file))
-
-    embeddings_batch = []
-    documents_batch = []
-    metadata_batch = []
-    ids_batch = []
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only write new or changed chunks, and delete stale chunks of the videos in the file.",
+)
+@click.option(
+    "--quantize",
+    "quantize_method",
+    type=click.Choice(quantize.METHODS),
+    default=None,
+    help="Also store compact codes of a .npy matrix for in-process search (see quantize.py).",
+)
+def index_file(input_file, incremental, quantize_method):
+    """
+    Adds embedded chunks to the collection. `input_file` is either the JSONL
+    written by embeddingify.py or a .npy matrix with its .meta.jsonl sidecar.
+    """
+    if quantize_method is not None and not vectorfile.is_binary(input_file):
+        raise click.BadParameter(
+            "only a .npy matrix can be quantized", param_hint="--quantize"
+        )
+
+    # Count the rows in the file for the progress bar
+    num_rows = vectorfile.count_rows(input_file)
     batch_size = 1000
 
-    with open(input_file, "r") as infile:
-        for line in tqdm(infile, total=num_lines):
-            entry = json.loads(line)
-            embeddings_batch.append(entry["embedding"])
-            documents_batch.append(entry["text"])
-            metadata_batch.append(entry["metadata"])
-            ids_batch.append(entry["id"])
-
-            if len(embeddings_batch) >= batch_size:
-                collection.add(
-                    embeddings=embeddings_batch,
-                    documents=documents_batch,
-                    metadatas=metadata_batch,
-                    ids=ids_batch,
-                )
-                embeddings_batch.clear()
-                documents_batch.clear()
-                ids_batch.clear()
-                metadata_batch.clear()
-
-        # add the remaining entries if they didn't reach the batch_size
-        if embeddings_batch:
+    indexer = IncrementalIndexer(collection) if incremental else None
+
+    with tqdm(total=num_rows) as progress:
+        for ids, documents, metadatas, embeddings in vectorfile.iter_batches(
+            input_file, batch_size
+        ):
+            if indexer is not None:
+                indexer.write(ids, documents, metadatas, embeddings)
+                progress.update(len(ids))
+                continue
+
+            if not isinstance(embeddings, list):
+                embeddings = embeddings.tolist()
+
             collection.add(
-                embeddings=embeddings_batch,
-                documents=documents_batch,
-                ids=ids_batch,
-                metadatas=metadata_batch,
+                embeddings=embeddings,
+                documents=documents,
+                metadatas=metadatas,
+                ids=ids,
             )
+            progress.update(len(ids))
+
+    if indexer is not None:
+        indexer.finish()
+        print(indexer.summary())
+
+    if quantize_method is not None:
+        codes = quantize.build_codes(input_file, quantize_method)
+        print(
+            f"Quantized to {quantize_method}: {codes.nbytes / 2**20:.1f} MB of codes "
+            f"in {vectorfile.codes_path(input_file)}"
+        )
 
 
 if __name__ == "__main__":
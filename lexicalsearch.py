@@ -0,0 +1,383 @@
+"""
+BM25 keyword search over the chunk texts, and hybrid search that fuses it
+with vector search.
+
+Embeddings are good at what a question means but can miss the exact names
+people ask about (a species, a product), and every vector search costs an
+embedding request. The lexical index finds those names without calling the
+API. It is built offline from the output of chunklines.py, or from the
+.meta.jsonl sidecar of a .npy index, which has the same rows:
+
+    python lexicalsearch.py build chunks.jsonl chunks.bm25
+    python lexicalsearch.py search chunks.bm25 "corydoras sterbai"
+    python lexicalsearch.py bench chunks.bm25
+
+The index is a directory of flat arrays that are memory-mapped when loaded:
+each term's postings (the chunks it's in and how often) are one contiguous
+slice of `docs.npy` and `tfs.npy`, found through `offsets.npy`. Chunk texts
+and metadata are read from the source file when needed, like VectorIndex does
+with its sidecar, so the source must stay where it was when the index was
+built.
+"""
+
+import json
+import logging
+import mmap
+import os
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from typing import Any, List
+
+import click
+import numpy as np
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import BaseRetriever, Document
+from tqdm import tqdm
+
+import vectorfile
+from tracing import span
+
+# The usual BM25 parameters: term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+# Rank constant of reciprocal rank fusion; larger values flatten the
+# difference between the top few results of each list
+RRF_K = 60
+
+# Too common to say anything about a chunk, and their postings are the longest
+STOP_WORDS = {
+    "a",
+    "an",
+    "and",
+    "are",
+    "as",
+    "at",
+    "be",
+    "but",
+    "by",
+    "do",
+    "for",
+    "from",
+    "i",
+    "if",
+    "in",
+    "is",
+    "it",
+    "of",
+    "on",
+    "or",
+    "so",
+    "that",
+    "the",
+    "this",
+    "to",
+    "was",
+    "we",
+    "what",
+    "with",
+    "you",
+}
+
+logger = logging.getLogger(__name__)
+
+_word = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return [w for w in _word.findall(text.casefold()) if w not in STOP_WORDS]
+
+
+def source_path(path):
+    """The chunk JSONL behind `path`, which may be a .npy index instead"""
+    return vectorfile.sidecar_path(path) if vectorfile.is_binary(path) else path
+
+
+def build_index(source, output_dir):
+    """
+    Builds the index of the {"id", "text", "metadata"} lines of `source` into
+    `output_dir`. Returns the number of chunks indexed.
+    """
+    source = source_path(source)
+    postings = defaultdict(list)
+    lengths = []
+    line_offsets = [0]
+
+    with open(source, "rb") as f:
+        for line in tqdm(f, desc="indexing"):
+            line_offsets.append(line_offsets[-1] + len(line))
+            terms = tokenize(json.loads(line)["text"])
+            doc = len(lengths)
+            lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings[term].append((doc, tf))
+
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(postings[t]) for t in terms])
+    docs = np.empty(offsets[-1], dtype=np.uint32)
+    tfs = np.empty(offsets[-1], dtype=np.uint16)
+    for i, term in enumerate(terms):
+        entries = np.array(postings[term], dtype=np.int64)
+        docs[offsets[i] : offsets[i + 1]] = entries[:, 0]
+        tfs[offsets[i] : offsets[i + 1]] = np.minimum(entries[:, 1], 65535)
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(output_dir, "docs.npy"), docs)
+    np.save(os.path.join(output_dir, "tfs.npy"), tfs)
+    np.save(os.path.join(output_dir, "lengths.npy"), np.array(lengths, np.uint32))
+    np.save(os.path.join(output_dir, "rows.npy"), np.array(line_offsets, np.int64))
+    with open(os.path.join(output_dir, "terms.txt"), "w") as f:
+        f.write("".join(f"{term}\n" for term in terms))
+    with open(os.path.join(output_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "source": os.path.abspath(source),
+                "documents": len(lengths),
+                "terms": len(terms),
+            },
+            f,
+        )
+    return len(lengths)
+
+
+class LexicalIndex:
+    """A read-only BM25 index built by `build_index`."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        self.offsets = load("offsets.npy")
+        self.docs = load("docs.npy")
+        self.tfs = load("tfs.npy")
+        self.rows = load("rows.npy")
+        lengths = np.asarray(load("lengths.npy"), dtype=np.float32)
+        with open(os.path.join(path, "terms.txt")) as f:
+            self.terms = {line[:-1]: i for i, line in enumerate(f)}
+
+        # the length normalization part of each chunk's BM25 denominator
+        average = lengths.mean() if len(lengths) else 1.0
+        self.norms = K1 * (1 - B + B * lengths / max(average, 1.0))
+
+        with open(self.meta["source"], "rb") as f:
+            self.source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.norms)
+
+    def search(self, query, k=25):
+        """
+        Finds the `k` chunks that best match `query` by BM25. Returns a list
+        of (row, score) pairs, best first; chunks sharing no term with the
+        query aren't returned.
+        """
+        n = len(self)
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(tokenize(query)):
+            i = self.terms.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            docs = self.docs[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            # each chunk appears once per term, so this doesn't drop repeats
+            scores[docs] += idf * tfs * (K1 + 1) / (tfs + self.norms[docs])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched])]
+        return list(zip(matched.tolist(), scores[matched].tolist()))
+
+    def row(self, i):
+        """The {"id", "text", "metadata"} entry of row `i`"""
+        return json.loads(self.source[self.rows[i] : self.rows[i + 1]])
+
+    def documents(self, hits):
+        documents = []
+        for i, _ in hits:
+            entry = self.row(i)
+            documents.append(
+                Document(page_content=entry["text"], metadata=entry["metadata"])
+            )
+        return documents
+
+
+def _key(document):
+    """What identifies a chunk, wherever it was retrieved from"""
+    metadata = document.metadata
+    if "video_id" in metadata and "start" in metadata:
+        return metadata["video_id"], metadata["start"]
+    return document.page_content
+
+
+def reciprocal_rank_fusion(rankings, k=25):
+    """
+    Merges lists of documents, each best first, into one list of at most `k`:
+    a document scores 1 / (RRF_K + rank) for each list it's in.
+    """
+    scores = defaultdict(float)
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = _key(document)
+            scores[key] += 1 / (RRF_K + rank)
+            documents.setdefault(key, document)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[key] for key in best]
+
+
+class LexicalRetriever(BaseRetriever):
+    """LangChain retriever over a LexicalIndex. It never calls the embedding API."""
+
+    index: Any
+    k: int = 25
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _search(self, query):
+        with span("lexical_search") as attributes:
+            documents = self.index.documents(self.index.search(query, self.k))
+            attributes["documents"] = len(documents)
+        return documents
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self._search(query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self._search(query)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses the results of a vector `retriever` and a LexicalRetriever with
+    reciprocal rank fusion. If the vector search fails, e.g. because the
+    embedding API is down, the lexical results are used on their own.
+    """
+
+    retriever: Any
+    lexical: Any
+    k: int = 25
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _fuse(self, vector, lexical):
+        if isinstance(vector, Exception):
+            logger.warning("vector search failed, using keywords only: %s", vector)
+            return lexical[: self.k]
+        return reciprocal_rank_fusion([vector, lexical], self.k)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        lexical = self.lexical.get_relevant_documents(
+            query, callbacks=run_manager.get_child()
+        )
+        try:
+            vector = self.retriever.get_relevant_documents(
+                query, callbacks=run_manager.get_child()
+            )
+        except Exception as e:
+            vector = e
+        return self._fuse(vector, lexical)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        lexical = await self.lexical.aget_relevant_documents(
+            query, callbacks=run_manager.get_child()
+        )
+        try:
+            vector = await self.retriever.aget_relevant_documents(
+                query, callbacks=run_manager.get_child()
+            )
+        except Exception as e:
+            vector = e
+        return self._fuse(vector, lexical)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("source")
+@click.argument("output_dir")
+def build(source, output_dir):
+    """
+    Index the chunks in SOURCE, a chunklines.py JSONL file or a .npy index,
+    into OUTPUT_DIR.
+    """
+    started = time.perf_counter()
+    count = build_index(source, output_dir)
+    print(f"Indexed {count} chunks in {time.perf_counter() - started:.1f}s")
+
+
+@cli.command()
+@click.argument("index_path")
+@click.argument("query")
+@click.option("--k", default=10)
+def search(index_path, query, k):
+    """Print the best matches for QUERY."""
+    index = LexicalIndex(index_path)
+    for i, score in index.search(query, k):
+        entry = index.row(i)
+        print(f"{score:6.2f}  {entry['id']}  {entry['text'][:80]!r}")
+
+
+@cli.command()
+@click.argument("index_path")
+@click.option("--queries", default=500)
+@click.option("--k", default=25)
+@click.option("--words", default=3, help="Words per query.")
+def bench(index_path, queries, k, words):
+    """
+    Time lexical search, with queries made of words drawn from random
+    chunks, so common words come up as often as they do in the chunks.
+    """
+    started = time.perf_counter()
+    index = LexicalIndex(index_path)
+    load_seconds = time.perf_counter() - started
+
+    rng = random.Random(0)
+    questions = []
+    while len(questions) < queries:
+        terms = tokenize(index.row(rng.randrange(len(index)))["text"])
+        if terms:
+            questions.append(" ".join(rng.choice(terms) for _ in range(words)))
+
+    latencies = []
+    for question in questions:
+        began = time.perf_counter()
+        index.documents(index.search(question, k))
+        latencies.append(time.perf_counter() - began)
+
+    latencies = np.array(latencies) * 1000
+    print(
+        f"{len(index)} chunks, {len(index.terms)} terms: load {load_seconds:.2f}s, "
+        f"p50 {np.percentile(latencies, 50):.2f}ms, "
+        f"p95 {np.percentile(latencies, 95):.2f}ms per query"
+    )
+
+
+if __name__ == "__main__":
+    cli()
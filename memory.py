@@ -1,14 +1,20 @@
 from abc import ABC
+from collections import deque
 
+import tiktoken
 from langchain.memory.chat_memory import BaseMemory
 from langchain.memory.chat_message_histories.in_memory import ChatMessageHistory
+from langchain.memory.prompt import SUMMARY_PROMPT
 from langchain.memory.utils import get_prompt_input_key
 from langchain.schema import BaseChatMessageHistory, BaseMemory
-from langchain.schema.messages import get_buffer_string
+from langchain.schema.language_model import BaseLanguageModel
+from langchain.schema.messages import SystemMessage, get_buffer_string
 
-from pydantic import Field
+from pydantic import Field, PrivateAttr
 from typing import Any, Dict, List, Optional, Tuple
 
+from defaults import MEMORY_TOKEN_LIMIT
+
 
 class BaseChatWithSourcesMemory(BaseMemory, ABC):
     chat_memory: BaseChatMessageHistory = Field(default_factory=ChatMessageHistory)
@@ -76,3 +82,119 @@ class ConversationWithSourcesBufferMemory(BaseChatWithSourcesMemory):
     def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
         """Return history buffer."""
         return {self.memory_key: self.buffer}
+
+
+# What the chat API adds to every message on top of its content
+TOKENS_PER_MESSAGE = 4
+
+tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+
+class ConversationWithSourcesTokenBufferMemory(ConversationWithSourcesBufferMemory):
+    """
+    Buffer of the most recent messages that fit in `max_token_limit` tokens.
+
+    The chat history itself keeps every message; only the window shown to the
+    chain is trimmed. Each message is tokenized once, when it's added, and
+    the window's total is kept up to date, so trimming never re-tokenizes the
+    history. Whole turns are dropped from the front, oldest first.
+
+    If `llm` is set, dropped turns are folded into a running summary that is
+    shown before the window. The summary is only brought up to date when the
+    memory is next read, so a turn costs at most one extra LLM call and only
+    once history has actually been dropped.
+    """
+
+    max_token_limit: int = MEMORY_TOKEN_LIMIT
+    llm: Optional[BaseLanguageModel] = None
+    summary: str = ""
+
+    # Token counts of the messages in the window, oldest first, and their sum
+    _counts: deque = PrivateAttr(default_factory=deque)
+    _window_tokens: int = PrivateAttr(default=0)
+    # How many messages of the history have been counted, and how many of
+    # those are before the window or already summarized
+    _seen: int = PrivateAttr(default=0)
+    _summarized: int = PrivateAttr(default=0)
+
+    @property
+    def window_tokens(self) -> int:
+        self._update_window()
+        return self._window_tokens
+
+    def _update_window(self) -> List:
+        messages = self.chat_memory.messages
+        for message in messages[self._seen :]:
+            count = len(tokenizer.encode(message.content)) + TOKENS_PER_MESSAGE
+            self._counts.append(count)
+            self._window_tokens += count
+        self._seen = len(messages)
+
+        while self._window_tokens > self.max_token_limit and len(self._counts) > 1:
+            # drop the oldest question together with its answer
+            for _ in range(min(2, len(self._counts) - 1)):
+                self._window_tokens -= self._counts.popleft()
+        return messages
+
+    @property
+    def _evicted(self) -> int:
+        return self._seen - len(self._counts)
+
+    def _unsummarized(self, messages) -> str:
+        if self.llm is None or self._summarized >= self._evicted:
+            return ""
+        return get_buffer_string(
+            messages[self._summarized : self._evicted],
+            human_prefix=self.human_prefix,
+            ai_prefix=self.ai_prefix,
+        )
+
+    def summarize_evicted(self) -> None:
+        """Folds turns dropped from the window since last time into the summary"""
+        messages = self._update_window()
+        new_lines = self._unsummarized(messages)
+        if new_lines:
+            prompt = SUMMARY_PROMPT.format(summary=self.summary, new_lines=new_lines)
+            self.summary = self.llm.predict(prompt)
+            self._summarized = self._evicted
+
+    async def asummarize_evicted(self) -> None:
+        messages = self._update_window()
+        new_lines = self._unsummarized(messages)
+        if new_lines:
+            prompt = SUMMARY_PROMPT.format(summary=self.summary, new_lines=new_lines)
+            self.summary = await self.llm.apredict(prompt)
+            self._summarized = self._evicted
+
+    async def aload(self) -> None:
+        """
+        Gets the memory ready to be read without blocking the event loop:
+        loads the chat history if it can be loaded asynchronously, and
+        updates the summary.
+        """
+        aload = getattr(self.chat_memory, "aload", None)
+        if aload is not None:
+            await aload()
+        await self.asummarize_evicted()
+
+    @property
+    def buffer(self) -> Any:
+        self.summarize_evicted()
+        messages = self.chat_memory.messages
+        window = messages[len(messages) - len(self._counts) :]
+        if self.summary:
+            window = [SystemMessage(content=self.summary)] + window
+
+        if self.return_messages:
+            return window
+        return get_buffer_string(
+            window, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix
+        )
+
+    def clear(self) -> None:
+        super().clear()
+        self.summary = ""
+        self._counts.clear()
+        self._window_tokens = 0
+        self._seen = 0
+        self._summarized = 0
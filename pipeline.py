@@ -0,0 +1,545 @@
+"""
+Runs a whole refresh - download, chunk, embed, index - as one streaming
+pipeline, instead of running each script to completion in turn.
+
+Every stage runs in its own thread and hands its output to the next one
+through a small bounded queue, so chunks from the first video are embedded and
+indexed while later videos are still downloading. Transcripts, chunks and
+embeddings are only held while they're in flight, however big the channel is.
+What does grow with the channel is the bookkeeping: the video table, the ids
+and hashes of each video's chunks in the index (see IncrementalIndexer) and,
+with --dedup, a MinHash signature per distinct chunk - hundreds of bytes per
+chunk rather than the ~6 KB of its embedding. Nothing is written to disk other
+than the index, the video table, the embedding cache and the sync state,
+unless one of the `--tap-*` options asks for the intermediate output.
+
+    python pipeline.py https://www.youtube.com/AquariumCoOp
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import click
+import openai
+from tqdm import tqdm
+
+import chunkify
+import chunklines
+import dedup
+import download_transcripts
+import embedding_cache
+import embeddingify
+import vectorfile
+import videos
+
+# Items waiting between two stages, small enough to keep memory flat but large
+# enough to absorb bursts
+QUEUE_SIZE = 64
+INDEX_BATCH_SIZE = 1000
+
+DONE = object()
+
+
+class Stage(threading.Thread):
+    """
+    Runs `fn(items, emit)` in a thread, where `items` iterates over the inbox
+    and `emit` puts onto the outbox. If any stage fails, the others stop.
+    """
+
+    def __init__(self, name, fn, inbox, outbox, failed):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.failed = failed
+        self.error = None
+
+    def items(self):
+        while not self.failed.is_set():
+            try:
+                item = self.inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is DONE:
+                return
+            yield item
+
+    def emit(self, item):
+        while not self.failed.is_set():
+            try:
+                self.outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        try:
+            self.fn(self.items() if self.inbox is not None else None, self.emit)
+        except BaseException as e:
+            self.error = e
+            self.failed.set()
+        finally:
+            if self.outbox is not None:
+                self.emit(DONE)
+
+
+def download_stage(video_ids, video_metadata, workers, rate, stats, tap_dir=None):
+    """Fetches transcripts with a bounded number of downloads outstanding."""
+
+    def run(_, emit):
+        limiter = download_transcripts.HostRateLimiter(rate)
+
+        def fetch(video_id, metadata):
+            limiter.wait(download_transcripts.TRANSCRIPT_HOST)
+            lines = download_transcripts.fetch_transcript(video_id)
+            return download_transcripts.build_video_info(video_id, metadata, lines)
+
+        pending = {}
+        videos = iter(zip(video_ids, video_metadata))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                for video_id, metadata in videos:
+                    pending[executor.submit(fetch, video_id, metadata)] = video_id
+                    if len(pending) >= workers * 2:
+                        break
+                if not pending:
+                    return
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    video_id = pending.pop(future)
+                    try:
+                        video_info = future.result()
+                    except Exception as e:
+                        tqdm.write(f"Failed to download transcript for {video_id}: {e}")
+                        stats["failed"].add(video_id)
+                        continue
+
+                    if tap_dir is not None:
+                        with open(os.path.join(tap_dir, f"{video_id}.json"), "w") as f:
+                            json.dump(video_info, f)
+
+                    stats["downloaded"] += 1
+                    emit(video_info)
+
+    return run
+
+
+def chunk_stage(stats, table, tap_file=None):
+    """
+    Chunks each video, emitting the list of chunk entries for the video, and
+    adds the video to `table`.
+    """
+
+    def run(video_infos, emit):
+        for video_info in video_infos:
+            video_data = chunkify.clean_metadata(video_info)
+            table.add(videos.video_record(video_data))
+            transcript = video_data["transcript"]
+            tokens, entry_index = chunkify.tokenize_transcript(transcript)
+            video_data["chunks"] = chunkify.chunk_tokens(
+                transcript, tokens, entry_index
+            )
+
+            entries = list(chunklines.chunk_entries(video_data))
+            if tap_file is not None:
+                for entry in entries:
+                    tap_file.write(json.dumps(entry))
+                    tap_file.write("\n")
+
+            stats["chunks"] += len(entries)
+            emit(entries)
+
+    return run
+
+
+def dedup_stage(stats, duplicates_file):
+    """
+    Leaves out chunks that are near-duplicates of one seen earlier in the run
+    (see dedup.py), recording each against its representative.
+    """
+
+    def run(videos, emit):
+        deduplicator = dedup.Deduplicator()
+        for entries in videos:
+            kept = []
+            for entry in entries:
+                representative, similarity = deduplicator.add(
+                    entry["id"], entry["text"]
+                )
+                if representative == entry["id"]:
+                    kept.append(entry)
+                    continue
+                record = {
+                    "id": entry["id"],
+                    "representative": representative,
+                    "similarity": round(similarity, 3),
+                }
+                duplicates_file.write(json.dumps(record) + "\n")
+                stats["duplicates"] += 1
+            if kept:
+                emit(kept)
+
+    return run
+
+
+def embed_stage(
+    inbox,
+    cache,
+    embedder,
+    concurrency,
+    batch_size,
+    batch_tokens,
+    stats,
+    tap_writer=None,
+):
+    """
+    Embeds chunk entries, looking each video's chunks up in the embedding cache
+    first and only sending the misses to the API, with up to `concurrency`
+    batches in flight. Emits lists of (entry, embedding) pairs.
+
+    Misses are batched across videos, but a partial batch is sent as soon as
+    `inbox` runs dry so that nothing waits on videos still downloading.
+
+    The ids of chunks that couldn't be embedded, even on their own, are added
+    to `stats["unembedded"]`, so that their rows from an earlier run aren't
+    deleted as stale, and their videos to `stats["incomplete"]`.
+    """
+
+    def run(videos, emit):
+        in_flight = deque()
+        batch = []
+        batch_num_tokens = 0
+
+        def forward(results):
+            if tap_writer is not None:
+                for entry, embedding in results:
+                    tap_writer.write(entry, embedding)
+            stats["embedded"] += len(results)
+            emit(results)
+
+        def harvest(block):
+            # results are forwarded in submission order, oldest first
+            while in_flight and (block or in_flight[0][0].done()):
+                future, num_tokens, entries = in_flight.popleft()
+                results = future.result()
+                if len(results) < len(entries):
+                    embedded = {entry["id"] for entry, _ in results}
+                    for entry in entries:
+                        if entry["id"] not in embedded:
+                            stats["unembedded"].add(entry["id"])
+                            stats["incomplete"].add(entry["metadata"]["video_id"])
+                if results:
+                    cache.put_many(
+                        [entry["text"] for entry, _ in results],
+                        [embedding for _, embedding in results],
+                    )
+                stats["tokens"] += num_tokens
+                forward(results)
+                block = len(in_flight) >= concurrency
+
+        def flush():
+            nonlocal batch, batch_num_tokens
+            if batch:
+                in_flight.append(
+                    (embedder.submit(batch, batch_num_tokens), batch_num_tokens, batch)
+                )
+                batch, batch_num_tokens = [], 0
+            harvest(block=len(in_flight) >= concurrency)
+
+        for entries in videos:
+            vectors = cache.get_many([entry["text"] for entry in entries])
+            hits = [(e, v) for e, v in zip(entries, vectors) if v is not None]
+            if hits:
+                forward(hits)
+
+            for entry, vector in zip(entries, vectors):
+                if vector is not None:
+                    continue
+                num_tokens = len(embeddingify.encoding.encode(entry["text"]))
+                if batch and (
+                    len(batch) >= batch_size
+                    or batch_num_tokens + num_tokens > batch_tokens
+                ):
+                    flush()
+                batch.append(entry)
+                batch_num_tokens += num_tokens
+
+            # don't sit on a partial batch while upstream has nothing for us
+            if inbox.empty():
+                flush()
+            harvest(block=False)
+
+        flush()
+        harvest(block=True)
+
+    return run
+
+
+def index_stage(write_batch, stats):
+    """
+    Writes embedded chunks to the index in batches, with
+    `write_batch(ids, documents, metadatas, embeddings)`.
+    """
+
+    def run(results, emit):
+        ids, documents, metadatas, embeddings = [], [], [], []
+
+        def flush():
+            if ids:
+                write_batch(
+                    list(ids), list(documents), list(metadatas), list(embeddings)
+                )
+                stats["indexed"] += len(ids)
+                for batch in (ids, documents, metadatas, embeddings):
+                    batch.clear()
+
+        for pairs in results:
+            for entry, embedding in pairs:
+                ids.append(entry["id"])
+                documents.append(entry["text"])
+                metadatas.append(entry["metadata"])
+                embeddings.append(
+                    embedding.tolist() if hasattr(embedding, "tolist") else embedding
+                )
+            if len(ids) >= INDEX_BATCH_SIZE:
+                flush()
+        flush()
+
+    return run
+
+
+@click.command()
+@click.argument("url")
+@click.option("--workers", default=download_transcripts.WORKERS)
+@click.option("--rate", default=download_transcripts.REQUESTS_PER_SECOND)
+@click.option("--concurrency", default=embeddingify.CONCURRENCY)
+@click.option("--batch-size", default=embeddingify.BATCH_MAX_INPUTS)
+@click.option("--batch-tokens", default=embeddingify.BATCH_MAX_TOKENS)
+@click.option("--cache", "cache_path", default=embedding_cache.DEFAULT_PATH)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only process videos published since the last incremental run of this URL.",
+)
+@click.option(
+    "--state-dir",
+    default=".",
+    help="Where the incremental sync state is kept.",
+)
+@click.option(
+    "--videos",
+    "videos_path",
+    default=videos.DEFAULT_PATH,
+    help="Video table the videos are added to.",
+)
+@click.option(
+    "--dedup",
+    "deduplicate",
+    is_flag=True,
+    help="Leave out near-duplicate chunks (intros, sponsor reads) before embedding.",
+)
+@click.option(
+    "--duplicates",
+    "duplicates_path",
+    default="./duplicates.jsonl",
+    help="Where --dedup records the chunks it leaves out.",
+)
+@click.option(
+    "--tap-transcripts",
+    default=None,
+    help="Also write downloaded transcripts to this directory.",
+)
+@click.option(
+    "--tap-chunks",
+    default=None,
+    help="Also write chunk entries to this JSONL file.",
+)
+@click.option(
+    "--tap-embeddings",
+    default=None,
+    help="Also write embedded chunks to this .jsonl/.npy file.",
+)
+def main(
+    url,
+    workers,
+    rate,
+    concurrency,
+    batch_size,
+    batch_tokens,
+    cache_path,
+    incremental,
+    state_dir,
+    videos_path,
+    deduplicate,
+    duplicates_path,
+    tap_transcripts,
+    tap_chunks,
+    tap_embeddings,
+):
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+
+    # index.py opens the collection on import
+    import index
+
+    state = download_transcripts.load_sync_state(state_dir)
+    newer_than = state.get(url) if incremental else None
+    video_ids, video_metadata = download_transcripts.get_video_ids_and_metadata(
+        url, newer_than
+    )
+    print(f"Processing {len(video_ids)} videos...")
+    # the stages modify the metadata dicts, keep what the sync state needs
+    published = [
+        (snippet["publishedAt"], video_id)
+        for snippet, video_id in zip(video_metadata, video_ids)
+    ]
+
+    if tap_transcripts is not None:
+        os.makedirs(tap_transcripts, exist_ok=True)
+    chunks_file = open(tap_chunks, "w") if tap_chunks is not None else None
+    duplicates_file = open(duplicates_path, "w") if deduplicate else None
+    embeddings_writer = (
+        vectorfile.open_writer(tap_embeddings) if tap_embeddings is not None else None
+    )
+
+    cache = embedding_cache.EmbeddingCache(
+        cache_path, model=embeddingify.EMBEDDING_MODEL
+    )
+    embedder = embeddingify.BackgroundEmbedder()
+    stats = {
+        "downloaded": 0,
+        "failed": set(),
+        "chunks": 0,
+        "duplicates": 0,
+        "embedded": 0,
+        "unembedded": set(),
+        "incomplete": set(),
+        "tokens": 0,
+        "indexed": 0,
+    }
+
+    indexer = index.IncrementalIndexer(index.collection)
+    table = videos.VideoTable(videos_path)
+
+    def write_batch(*batch):
+        # a running chatbot looks the videos of the chunks it retrieves up in
+        # the table, so their videos are saved before the chunks are indexed
+        table.save()
+        indexer.write(*batch)
+
+    failed = threading.Event()
+    queues = [queue.Queue(maxsize=QUEUE_SIZE) for _ in range(4 if deduplicate else 3)]
+    # with --dedup, chunks go through one more queue, deduplicated, to be embedded
+    chunked, to_embed, embedded = queues[1], queues[-2], queues[-1]
+    stages = [
+        Stage(
+            "download",
+            download_stage(
+                video_ids, video_metadata, workers, rate, stats, tap_transcripts
+            ),
+            None,
+            queues[0],
+            failed,
+        ),
+        Stage(
+            "chunk",
+            chunk_stage(stats, table, chunks_file),
+            queues[0],
+            chunked,
+            failed,
+        ),
+        Stage(
+            "embed",
+            embed_stage(
+                to_embed,
+                cache,
+                embedder,
+                concurrency,
+                batch_size,
+                batch_tokens,
+                stats,
+                embeddings_writer,
+            ),
+            to_embed,
+            embedded,
+            failed,
+        ),
+        Stage(
+            "index",
+            index_stage(write_batch, stats),
+            embedded,
+            None,
+            failed,
+        ),
+    ]
+    if deduplicate:
+        stages.insert(
+            2,
+            Stage(
+                "dedup", dedup_stage(stats, duplicates_file), chunked, to_embed, failed
+            ),
+        )
+
+    started = time.monotonic()
+    for stage in stages:
+        stage.start()
+
+    with tqdm(total=len(video_ids), unit="video") as progress:
+        while any(stage.is_alive() for stage in stages):
+            time.sleep(0.5)
+            done = stats["downloaded"] + len(stats["failed"])
+            progress.update(done - progress.n)
+            progress.set_postfix(
+                chunks=stats["chunks"],
+                duplicates=stats["duplicates"],
+                embedded=stats["embedded"],
+                indexed=stats["indexed"],
+                queued="/".join(str(q.qsize()) for q in queues),
+            )
+
+    embedder.close()
+    # saved even if a stage failed, for the chunks that did get indexed
+    table.save()
+    if chunks_file is not None:
+        chunks_file.close()
+    if duplicates_file is not None:
+        duplicates_file.close()
+    if embeddings_writer is not None:
+        embeddings_writer.close()
+
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+    elapsed = time.monotonic() - started
+    print(
+        f"{stats['downloaded']} videos, {stats['chunks']} chunks, "
+        f"{stats['duplicates']} duplicates left out, "
+        f"{stats['indexed']} indexed in {elapsed:.1f}s "
+        f"({stats['tokens'] / max(elapsed, 1e-9):,.0f} tokens/sec embedded), "
+        f"{len(stats['failed'])} failed downloads, "
+        f"{len(stats['unembedded'])} chunks failed to embed"
+    )
+    indexer.finish(keep=stats["unembedded"])
+    print(indexer.summary())
+    print(cache.stats_line())
+    cache.close()
+
+    # videos with chunks that failed to embed are tried again next time too
+    watermark = download_transcripts._sync_watermark(
+        published,
+        {video_id: "failed" for video_id in stats["failed"] | stats["incomplete"]},
+        state.get(url),
+    )
+    if watermark is not None:
+        state[url] = watermark
+        download_transcripts.save_sync_state(state_dir, state)
+
+
+if __name__ == "__main__":
+    main()
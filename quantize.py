@@ -0,0 +1,372 @@
+"""
+Compact codes of a .npy embedding matrix, so vector search can keep those in
+memory instead of the float32 vectors.
+
+    int8  each dimension scaled into a byte: 4x smaller
+    pq    product quantization: each vector is cut into `m` slices, and each
+          slice replaced by the nearest of 256 centroids learnt for it: one
+          byte per slice, 64x smaller for 1536 dimensions and m=96
+
+VectorIndex uses the codes of its matrix when they've been built: it ranks
+every row by its code, then rescores the best candidates exactly with their
+float32 rows, read from the memory-mapped matrix. Only those rows are ever
+paged in. The codes are kept next to the matrix (see vectorfile.codes_path),
+and built with `index.py --quantize` or
+
+    python quantize.py build index.npy --method pq
+    python quantize.py eval index.npy
+
+`eval` compares both methods with exact search: memory, recall@k and latency.
+"""
+
+import hashlib
+import logging
+import os
+import time
+
+import click
+import numpy as np
+from tqdm import tqdm
+
+import vectorfile
+
+METHODS = ("int8", "pq")
+
+# Rows scored at a time: the float32 copy of a block of int8 codes stays in
+# the CPU cache, which makes scoring several times faster than larger blocks
+BLOCK_ROWS = 1024
+
+# Product quantization: slices per vector, and centroids per slice (one byte)
+PQ_SUBVECTORS = 96
+PQ_CENTROIDS = 256
+# Rows the centroids are learnt from (~40 per centroid is enough), and
+# k-means iterations
+PQ_TRAINING_ROWS = 10000
+PQ_ITERATIONS = 15
+
+# Rows of the matrix hashed into the fingerprint its codes are saved with
+FINGERPRINT_ROWS = 256
+
+logger = logging.getLogger(__name__)
+
+
+def _blocks(rows):
+    for start in range(0, rows, BLOCK_ROWS):
+        yield start, min(start + BLOCK_ROWS, rows)
+
+
+class Int8Codes:
+    """
+    Each dimension mapped linearly from its range over the matrix onto the
+    256 values of a byte.
+    """
+
+    method = "int8"
+
+    def __init__(self, codes, offset, scale):
+        self.codes = codes
+        self.offset = offset
+        self.scale = scale
+
+    @classmethod
+    def train(cls, matrix):
+        low = np.full(matrix.shape[1], np.inf, dtype=np.float32)
+        high = np.full(matrix.shape[1], -np.inf, dtype=np.float32)
+        for start, end in _blocks(len(matrix)):
+            low = np.minimum(low, matrix[start:end].min(axis=0))
+            high = np.maximum(high, matrix[start:end].max(axis=0))
+        scale = (high - low) / 255
+        scale[scale == 0] = 1.0
+
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        for start, end in _blocks(len(matrix)):
+            levels = np.rint((matrix[start:end] - low) / scale)
+            codes[start:end] = np.clip(levels, 0, 255) - 128
+        return cls(codes, low, scale)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.offset.nbytes + self.scale.nbytes
+
+    def scores(self, queries):
+        """Approximate dot products of `queries` (a 2-D array) with every row"""
+        # q . x ~ q . (offset + scale * (code + 128))
+        weights = queries * self.scale
+        base = queries @ self.offset + 128 * weights.sum(axis=1)
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start, end in _blocks(len(self)):
+            block = self.codes[start:end].astype(np.float32)
+            scores[:, start:end] = weights @ block.T
+        scores += base[:, None]
+        return scores
+
+    def arrays(self):
+        return {"codes": self.codes, "offset": self.offset, "scale": self.scale}
+
+
+def _kmeans(x, k, iterations, rng):
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        distances = (centroids**2).sum(axis=1) - 2 * x @ centroids.T
+        nearest = distances.argmin(axis=1)
+        counts = np.bincount(nearest, minlength=k)
+        # a slice is only a few dimensions wide, and a bincount per dimension
+        # is much faster than np.add.at
+        sums = np.stack(
+            [np.bincount(nearest, weights=column, minlength=k) for column in x.T],
+            axis=1,
+        ).astype(np.float32)
+        # an empty cluster keeps its centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class PQCodes:
+    """
+    Product quantization: the vector is cut into `m` slices, and each slice is
+    stored as the index of its nearest centroid among those k-means found for
+    that slice. A query's dot product with a row is the sum of its dot
+    products with the row's centroids, read from a table computed per query.
+    """
+
+    method = "pq"
+
+    def __init__(self, codes, centroids):
+        self.codes = codes
+        self.centroids = centroids
+
+    @classmethod
+    def train(
+        cls,
+        matrix,
+        m=PQ_SUBVECTORS,
+        training_rows=PQ_TRAINING_ROWS,
+        iterations=PQ_ITERATIONS,
+        seed=0,
+    ):
+        rows, dimensions = matrix.shape
+        if dimensions % m:
+            raise ValueError(f"{dimensions} dimensions can't be cut into {m} slices")
+        if rows < PQ_CENTROIDS:
+            raise ValueError(f"Need at least {PQ_CENTROIDS} rows, got {rows}")
+        width = dimensions // m
+
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(rows, min(rows, training_rows), replace=False))
+        training = np.asarray(matrix[sample], dtype=np.float32)
+        centroids = np.stack(
+            [
+                _kmeans(
+                    np.ascontiguousarray(training[:, j * width : (j + 1) * width]),
+                    PQ_CENTROIDS,
+                    iterations,
+                    rng,
+                )
+                for j in tqdm(range(m), desc="pq centroids", leave=False)
+            ]
+        )
+
+        codes = np.empty((rows, m), dtype=np.uint8)
+        squared = (centroids**2).sum(axis=2)
+        for start, end in tqdm(
+            _blocks(rows), desc="pq codes", total=-(-rows // BLOCK_ROWS), leave=False
+        ):
+            block = np.asarray(matrix[start:end], dtype=np.float32)
+            for j in range(m):
+                piece = np.ascontiguousarray(block[:, j * width : (j + 1) * width])
+                distances = squared[j] - 2 * piece @ centroids[j].T
+                codes[start:end, j] = distances.argmin(axis=1)
+        return cls(codes, centroids)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.centroids.nbytes
+
+    def scores(self, queries):
+        """Approximate dot products of `queries` (a 2-D array) with every row"""
+        m, k, width = self.centroids.shape
+        # (queries, m, k): each query slice's dot product with each centroid
+        tables = np.einsum(
+            "qmw,mkw->qmk", queries.reshape(len(queries), m, width), self.centroids
+        ).reshape(len(queries), m * k)
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        slice_offsets = np.arange(m, dtype=np.int32) * k
+        for start, end in _blocks(len(self)):
+            cells = self.codes[start:end] + slice_offsets
+            for i, table in enumerate(tables):
+                scores[i, start:end] = table[cells].sum(axis=1)
+        return scores
+
+    def arrays(self):
+        return {"codes": self.codes, "centroids": self.centroids}
+
+
+def train(matrix, method):
+    if method == "int8":
+        return Int8Codes.train(matrix)
+    return PQCodes.train(matrix)
+
+
+def fingerprint(matrix):
+    """
+    A hash of the matrix's shape and of rows spread over all of it, which
+    tells a re-embedded or re-chunked matrix from the one codes were built
+    from, even with the same number of rows, without reading all of it.
+    """
+    rows = np.unique(
+        np.linspace(0, len(matrix) - 1, min(len(matrix), FINGERPRINT_ROWS)).astype(
+            np.int64
+        )
+    )
+    digest = hashlib.sha256(repr((matrix.shape, str(matrix.dtype))).encode())
+    digest.update(np.ascontiguousarray(matrix[rows]).tobytes())
+    return digest.hexdigest()
+
+
+def save_codes(path, codes, matrix):
+    """
+    Saves the codes of the matrix at `path` where VectorIndex finds them,
+    with the fingerprint of the matrix they were built from.
+    """
+    # written to the side and moved into place, so a running index never
+    # loads half of them
+    final = vectorfile.codes_path(path)
+    with open(f"{final}.partial", "wb") as f:
+        np.savez(
+            f, method=codes.method, fingerprint=fingerprint(matrix), **codes.arrays()
+        )
+    os.replace(f"{final}.partial", final)
+
+
+def load_codes(path, matrix):
+    """
+    The codes built for the matrix at `path`, or None if there aren't any or
+    they were built from another matrix than `matrix`, the one now there.
+    """
+    try:
+        arrays = np.load(vectorfile.codes_path(path))
+    except FileNotFoundError:
+        return None
+    with arrays:
+        if "fingerprint" not in arrays.files or str(
+            arrays["fingerprint"]
+        ) != fingerprint(matrix):
+            logger.warning(
+                "the codes of %s were built from another matrix, searching it "
+                "exactly; rebuild them with quantize.py",
+                path,
+            )
+            return None
+        if str(arrays["method"]) == "int8":
+            return Int8Codes(arrays["codes"], arrays["offset"], arrays["scale"])
+        return PQCodes(arrays["codes"], arrays["centroids"])
+
+
+def build_codes(path, method):
+    """Quantizes the .npy matrix at `path` and saves the codes. Returns them."""
+    matrix = vectorfile.load_matrix(path)
+    codes = train(matrix, method)
+    save_codes(path, codes, matrix)
+    return codes
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("index_path")
+@click.option("--method", type=click.Choice(METHODS), default="pq")
+def build(index_path, method):
+    """Quantize the .npy matrix INDEX_PATH for VectorIndex to search."""
+    started = time.perf_counter()
+    codes = build_codes(index_path, method)
+    matrix = vectorfile.load_matrix(index_path)
+    print(
+        f"{method}: {len(codes)} rows, {codes.nbytes / 2**20:.1f} MB of codes for "
+        f"{matrix.nbytes / 2**20:.1f} MB of vectors, "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+
+@cli.command(name="eval")
+@click.argument("index_path")
+@click.option("--method", type=click.Choice(METHODS), default=None)
+@click.option("--queries", default=200)
+@click.option("--k", default=25)
+@click.option("--rescore", default=None, type=int, help="Candidates rescored exactly.")
+@click.option(
+    "--noise",
+    default=0.5,
+    help="How far queries are from the rows they're drawn from (0 = the row).",
+)
+def evaluate(index_path, method, queries, k, rescore, noise):
+    """
+    Compare quantized search with exact search over INDEX_PATH: memory taken
+    by the vectors, recall@k and latency. The codes are built in memory, so
+    nothing needs to be built beforehand.
+
+    Queries are random rows with noise added, so each has neighbours as a
+    question has chunks about it, unlike random vectors.
+    """
+    from vectorsearch import RESCORE_CANDIDATES, VectorIndex
+
+    rescore = rescore or RESCORE_CANDIDATES
+    index = VectorIndex(index_path, exact=True)
+    matrix = index.matrix
+
+    rng = np.random.default_rng(0)
+    rows = matrix[np.sort(rng.choice(len(matrix), queries, replace=False))]
+    vectors = rows + noise * rng.standard_normal(rows.shape).astype(
+        np.float32
+    ) / np.sqrt(matrix.shape[1])
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def timed(search):
+        latencies, results = [], []
+        for vector in vectors:
+            began = time.perf_counter()
+            results.append({row for row, _ in search(vector)})
+            latencies.append(time.perf_counter() - began)
+        latencies = np.array(latencies) * 1000
+        return results, np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+    def recall(results):
+        return np.mean([len(r & t) / len(t) for r, t in zip(results, truth)])
+
+    truth, p50, p95 = timed(lambda v: index.search(v, k))
+    print(f"{len(matrix)} rows, {matrix.shape[1]} dimensions, {queries} queries, k={k}")
+    print(f"{'':>14}{'MB':>9}{'smaller':>9}{'recall':>8}{'p50 ms':>9}{'p95 ms':>9}")
+    print(
+        f"{'exact':>14}{matrix.nbytes / 2**20:>9.1f}{1:>8.0f}x{1:>8.3f}{p50:>9.2f}{p95:>9.2f}"
+    )
+
+    for name in [method] if method else METHODS:
+        started = time.perf_counter()
+        index.codes = train(matrix, name)
+        trained = time.perf_counter() - started
+        smaller = matrix.nbytes / index.codes.nbytes
+        megabytes = index.codes.nbytes / 2**20
+
+        index.rescore = k
+        results, p50, p95 = timed(lambda v: index.search(v, k))
+        print(
+            f"{name:>14}{megabytes:>9.1f}{smaller:>8.0f}x{recall(results):>8.3f}{p50:>9.2f}{p95:>9.2f}"
+        )
+        index.rescore = rescore
+        results, p50, p95 = timed(lambda v: index.search(v, k))
+        label = f"+rescore {rescore}"
+        print(f"{label:>14}{'':>9}{'':>9}{recall(results):>8.3f}{p50:>9.2f}{p95:>9.2f}")
+        print(f"{'':>14}(codes built in {trained:.1f}s)")
+
+
+if __name__ == "__main__":
+    cli()
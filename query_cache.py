@@ -0,0 +1,256 @@
+"""
+In-memory caches for the chatbot's question embeddings and retrieval results.
+
+Popular questions come up again and again, and each one otherwise costs an
+embedding request plus a k=25 vector search. Both layers are bounded LRU
+caches whose entries also expire after a while, keyed on the normalized
+question. Retrieval results are additionally tied to the version of the
+index they came from, so rebuilding the index drops them automatically.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseRetriever, Document
+
+import vectorfile
+from embedding_cache import normalize_text
+from tracing import span
+
+MAX_QUERIES = 1024
+TTL_SECONDS = 60 * 60
+# How often the index files are looked at to see whether it was rebuilt
+VERSION_CHECK_SECONDS = 10
+
+
+def normalize_query(text):
+    """Questions that only differ in case, spacing or final punctuation match"""
+    return normalize_text(text).casefold().rstrip("?!. ")
+
+
+def index_version(path):
+    """
+    Something that changes whenever the index at `path` is rebuilt: the size
+    and modification time of the .npy matrix, its sidecar and its quantized
+    codes, of every file under a Chroma persist directory, or of any other
+    file.
+    """
+    if os.path.isdir(path):
+        paths = [
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in names
+        ]
+    elif vectorfile.is_binary(path):
+        paths = [path, vectorfile.sidecar_path(path), vectorfile.codes_path(path)]
+    else:
+        paths = [path]
+
+    version = []
+    for p in sorted(paths):
+        try:
+            stat = os.stat(p)
+        except FileNotFoundError:
+            continue
+        version.append((p, stat.st_size, stat.st_mtime_ns))
+    return tuple(version)
+
+
+class LRUCache:
+    """A thread-safe LRU cache of at most `maxsize` entries, each living `ttl` seconds"""
+
+    def __init__(self, maxsize=MAX_QUERIES, ttl=TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached value, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class QueryCache:
+    """
+    The two caches for one index. Lookups use the version the index was
+    opened at, and `version` is only called again every `check_interval`
+    seconds. When what it returns has changed, `on_change` is called (e.g. to
+    reopen the index), the version is taken again and the retrieval results
+    are dropped. Embeddings don't depend on the index, so they're kept.
+    """
+
+    def __init__(
+        self,
+        version,
+        maxsize=MAX_QUERIES,
+        ttl=TTL_SECONDS,
+        on_change=None,
+        check_interval=VERSION_CHECK_SECONDS,
+    ):
+        self.version = version
+        self.on_change = on_change
+        self.check_interval = check_interval
+        self.embeddings = LRUCache(maxsize, ttl)
+        self.results = LRUCache(maxsize, ttl)
+        self.current_version = version()
+        self.next_check = time.monotonic() + check_interval
+        self.invalidations = 0
+        # concurrent lookups must not reopen the index more than once
+        self.lock = threading.RLock()
+
+    def check_version(self):
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.next_check:
+                self.next_check = now + self.check_interval
+                if self.version() != self.current_version:
+                    self.reopen()
+            return self.current_version
+
+    def reopen(self):
+        """Reopen the index and drop the results of the one before"""
+        with self.lock:
+            if self.on_change is not None:
+                self.on_change()
+            # taken after reopening so that it's the version that was opened
+            self.current_version = self.version()
+            self.results.clear()
+            self.invalidations += 1
+
+    def stats_line(self):
+        return (
+            f"Query cache: embeddings {self.embeddings.hits} hits / "
+            f"{self.embeddings.misses} misses, results {self.results.hits} hits / "
+            f"{self.results.misses} misses, {self.invalidations} invalidations"
+        )
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings, caching the vectors of queries (not of documents)."""
+
+    def __init__(self, embeddings, cache):
+        self.embeddings = embeddings
+        self.cache = cache.embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = normalize_query(text)
+        with span("embed_query") as attributes:
+            vector = self.cache.get(key)
+            attributes["cached"] = vector is not None
+            if vector is None:
+                vector = self.embeddings.embed_query(text)
+                self.cache.put(key, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Like embed_query for each question, with one request for the uncached ones."""
+        keys = [normalize_query(text) for text in texts]
+        with span("embed_query") as attributes:
+            vectors = {key: self.cache.get(key) for key in keys}
+            missing = {
+                key: text for key, text in zip(keys, texts) if vectors[key] is None
+            }
+            attributes["queries"] = len(texts)
+            attributes["cached"] = len(vectors) - len(missing)
+            if missing:
+                embedded = self.embeddings.embed_documents(list(missing.values()))
+                for key, vector in zip(missing, embedded):
+                    vectors[key] = vector
+                    self.cache.put(key, vector)
+        return [vectors[key] for key in keys]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = normalize_query(text)
+        with span("embed_query") as attributes:
+            vector = self.cache.get(key)
+            attributes["cached"] = vector is not None
+            if vector is None:
+                vector = await self.embeddings.aembed_query(text)
+                self.cache.put(key, vector)
+        return vector
+
+
+class CachingRetriever(BaseRetriever):
+    """Wraps a retriever, caching its results per question and index version."""
+
+    retriever: Any
+    cache: Any
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        with span("retrieve") as attributes:
+            key = (self.cache.check_version(), normalize_query(query))
+            documents = self.cache.results.get(key)
+            attributes["cached"] = documents is not None
+            if documents is None:
+                documents = self.retriever.get_relevant_documents(
+                    query, callbacks=run_manager.get_child()
+                )
+                self.cache.results.put(key, documents)
+            attributes["documents"] = len(documents)
+        # callers are free to reorder or trim the list they get
+        return list(documents)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        with span("retrieve") as attributes:
+            key = (self.cache.check_version(), normalize_query(query))
+            documents = self.cache.results.get(key)
+            attributes["cached"] = documents is not None
+            if documents is None:
+                documents = await self.retriever.aget_relevant_documents(
+                    query, callbacks=run_manager.get_child()
+                )
+                self.cache.results.put(key, documents)
+            attributes["documents"] = len(documents)
+        return list(documents)
@@ -0,0 +1,606 @@
+"""
+Serves Corydora over HTTP and WebSockets, to many conversations at once.
+
+    python server.py serve --port 8080 [--index index.npy]
+
+    POST   /chat            {"question": ..., "session_id": ...}, answers in one go
+    GET    /ws?session_id=  send {"question": ...}, get the answer a token at a time
+    DELETE /sessions/{id}
+    GET    /healthz
+    GET    /metrics         per-stage latency and token counts, for Prometheus
+
+Leave out the session id to start a new conversation; every response says
+which session it belongs to. All sessions share one ChatBackend (index, query
+caches, LLM clients) and one pool of connections to the OpenAI API, and only
+keep their own conversation memory. Conversations are saved to --history-db as
+they go, so one can be resumed by its id after it was evicted or the server
+restarted. Sessions are kept in this process though, so behind a load
+balancer a session's requests should stick to one instance.
+
+To load test it without spending anything, run fake_openai.py and point both
+the server and the load test at it:
+
+    python fake_openai.py --token-latency 0.02 &
+    OPENAI_API_BASE=http://127.0.0.1:8765/v1 python server.py serve --index index.npy
+    python server.py loadtest --sessions 50 --questions 3
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+
+import aiohttp
+import click
+import numpy as np
+import openai
+from aiohttp import web
+
+from chat_backend import AquariumCoOpChatBot, ChatBackend
+from defaults import (
+    CONDENSE_MODEL,
+    CONDENSE_MODES,
+    CONTEXT_TOKEN_BUDGET,
+    MEMORY_TOKEN_LIMIT,
+    RETRIEVAL_MODES,
+    VIDEOS_PATH,
+)
+from sqlite_history import (
+    DEFAULT_PATH,
+    HistoryStore,
+    SQLiteChatMessageHistory,
+    new_session_id,
+)
+
+# Conversations kept in memory; the least recently used idle ones go first
+MAX_SESSIONS = 1000
+SESSION_IDLE_SECONDS = 30 * 60
+# Questions being answered at once, i.e. concurrent LLM calls, and how many
+# more may wait for a turn before new ones are turned away
+MAX_CONCURRENCY = 16
+MAX_WAITING = 64
+API_CONNECTIONS = 64
+
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    pass
+
+
+class UnknownSession(Exception):
+    pass
+
+
+class Session:
+    def __init__(self, session_id, chatbot):
+        self.id = session_id
+        self.chatbot = chatbot
+        # a conversation answers one question at a time
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        # WebSockets open on it; such a session isn't idle, however long ago
+        # it was last asked something
+        self.sockets = 0
+
+    @property
+    def busy(self):
+        return self.lock.locked() or self.sockets > 0
+
+
+class SessionTable:
+    """
+    The conversations in progress, at most `max_sessions` of them, each with
+    an AquariumCoOpChatBot made by `new_chatbot(session_id)`. Sessions idle for
+    `idle_seconds` are dropped by `evict_idle`, and when the table is full the
+    least recently used idle session makes room for a new one. With a history
+    `store`, dropped sessions (and those from before a restart) are picked
+    up again from their saved history when they're next asked for.
+    """
+
+    def __init__(
+        self,
+        new_chatbot,
+        max_sessions=MAX_SESSIONS,
+        idle_seconds=SESSION_IDLE_SECONDS,
+        store=None,
+    ):
+        self.new_chatbot = new_chatbot
+        self.store = store
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.sessions = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    async def get(self, session_id=None):
+        """Returns the session `session_id`, or a new one if it's None"""
+        if session_id is None:
+            return self._create(new_session_id())
+
+        session = self.sessions.get(session_id)
+        if session is None:
+            if self.store is None or not await self.store.acall(
+                self.store.exists, session_id
+            ):
+                raise UnknownSession(session_id)
+            # another request may have resumed it in the meantime
+            session = self.sessions.get(session_id) or self._create(session_id)
+        self.sessions.move_to_end(session_id)
+        session.last_used = time.monotonic()
+        return session
+
+    def _create(self, session_id):
+        while len(self.sessions) >= self.max_sessions:
+            idle = next((s for s in self.sessions.values() if not s.busy), None)
+            if idle is None:
+                raise Overloaded("too many sessions")
+            self.remove(idle.id)
+            self.evicted += 1
+
+        session = Session(session_id, self.new_chatbot(session_id))
+        self.sessions[session_id] = session
+        return session
+
+    def remove(self, session_id):
+        return self.sessions.pop(session_id, None) is not None
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        expired = [
+            s.id for s in self.sessions.values() if s.last_used < cutoff and not s.busy
+        ]
+        for session_id in expired:
+            self.remove(session_id)
+        self.evicted += len(expired)
+        return len(expired)
+
+
+class Admission:
+    """
+    Caps the number of questions being answered at once. Up to `max_waiting`
+    more wait for a turn; past that, questions are refused with Overloaded
+    rather than piling up.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_waiting=MAX_WAITING):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.in_flight = 0
+        self.rejected = 0
+
+    @asynccontextmanager
+    async def turn(self):
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise Overloaded("too many questions waiting")
+
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+
+def _video_json(video):
+    return dict(video, publishedAt=video["publishedAt"].isoformat())
+
+
+async def answer(app, session, question, on_token=None):
+    # the session's own questions queue on its lock without holding one of
+    # the turns other sessions are waiting for
+    async with session.lock, app["admission"].turn():
+        answer, related_videos = await session.chatbot.achat(question, on_token)
+    session.last_used = time.monotonic()
+    return {
+        "session_id": session.id,
+        "answer": answer,
+        "related_videos": [_video_json(video) for video in related_videos],
+    }
+
+
+def _error(status, message):
+    return web.json_response({"error": message}, status=status)
+
+
+async def chat(request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return _error(400, "body must be JSON")
+    if not isinstance(body, dict):
+        return _error(400, "body must be a JSON object")
+    question = body.get("question")
+    if not isinstance(question, str) or not question.strip():
+        return _error(400, "question is required")
+
+    try:
+        session = await request.app["sessions"].get(body.get("session_id"))
+        return web.json_response(await answer(request.app, session, question))
+    except UnknownSession:
+        return _error(404, "unknown or expired session")
+    except Overloaded as e:
+        return _error(503, str(e))
+
+
+async def websocket(request):
+    try:
+        session = await request.app["sessions"].get(request.query.get("session_id"))
+    except UnknownSession:
+        return _error(404, "unknown or expired session")
+    except Overloaded as e:
+        return _error(503, str(e))
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    await ws.send_json({"type": "session", "session_id": session.id})
+
+    async def send_token(token):
+        await ws.send_json({"type": "token", "token": token})
+
+    session.sockets += 1
+    try:
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            try:
+                question = json.loads(message.data)["question"]
+            except (json.JSONDecodeError, KeyError, TypeError):
+                await ws.send_json(
+                    {"type": "error", "error": 'expected {"question": ...}'}
+                )
+                continue
+
+            try:
+                result = await answer(request.app, session, question, send_token)
+            except Overloaded as e:
+                await ws.send_json({"type": "error", "error": str(e)})
+                continue
+            except Exception as e:
+                # e.g. the API failed: this question is lost, not the session
+                logger.exception("Failed to answer in session %s", session.id)
+                await ws.send_json({"type": "error", "error": f"failed to answer: {e}"})
+                continue
+            await ws.send_json(dict(result, type="done"))
+    finally:
+        session.sockets -= 1
+        session.last_used = time.monotonic()
+
+    return ws
+
+
+async def delete_session(request):
+    """Ends a conversation, and deletes its saved history"""
+    sessions = request.app["sessions"]
+    session_id = request.match_info["session_id"]
+    found = sessions.remove(session_id)
+    if sessions.store is not None and await sessions.store.acall(
+        sessions.store.exists, session_id
+    ):
+        await sessions.store.acall(sessions.store.delete, session_id)
+        found = True
+
+    if not found:
+        return _error(404, "unknown or expired session")
+    return web.json_response({"deleted": True})
+
+
+async def healthz(request):
+    app = request.app
+    return web.json_response(
+        {
+            "sessions": len(app["sessions"]),
+            "evicted": app["sessions"].evicted,
+            "in_flight": app["admission"].in_flight,
+            "waiting": app["admission"].waiting,
+            "rejected": app["admission"].rejected,
+            "condense": app["backend"].condense_stats.as_dict(),
+        }
+    )
+
+
+async def metrics(request):
+    return web.Response(
+        text=request.app["backend"].tracer.prometheus(),
+        content_type="text/plain",
+    )
+
+
+async def _evict_idle_sessions(app):
+    while True:
+        await asyncio.sleep(min(60, app["sessions"].idle_seconds))
+        app["sessions"].evict_idle()
+
+
+async def _background_tasks(app):
+    task = asyncio.create_task(_evict_idle_sessions(app))
+    yield
+    task.cancel()
+
+
+def make_app(
+    backend,
+    max_sessions,
+    idle_seconds,
+    max_concurrency,
+    max_waiting,
+    memory_tokens=MEMORY_TOKEN_LIMIT,
+    summarize_history=False,
+    store=None,
+):
+    app = web.Application()
+
+    def new_chatbot(session_id):
+        return AquariumCoOpChatBot(
+            backend=backend,
+            memory_tokens=memory_tokens,
+            summarize_history=summarize_history,
+            history=(
+                SQLiteChatMessageHistory(store, session_id)
+                if store is not None
+                else None
+            ),
+        )
+
+    app["backend"] = backend
+    app["sessions"] = SessionTable(new_chatbot, max_sessions, idle_seconds, store)
+    app["admission"] = Admission(max_concurrency, max_waiting)
+    app.cleanup_ctx.append(_background_tasks)
+    app.add_routes(
+        [
+            web.post("/chat", chat),
+            web.get("/ws", websocket),
+            web.delete("/sessions/{session_id}", delete_session),
+            web.get("/healthz", healthz),
+            web.get("/metrics", metrics),
+        ]
+    )
+    return app
+
+
+async def _serve(app, host, port, api_connections):
+    # openai's async calls all go through this session, so connections to the
+    # API are pooled across every conversation
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=api_connections)
+    ) as http:
+        openai.aiosession.set(http)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        print(f"Serving on http://{host}:{port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8080)
+@click.option(
+    "--index",
+    "index_path",
+    default=None,
+    help="Search this .npy embedding matrix in-process instead of Chroma.",
+)
+@click.option(
+    "--lexical-index",
+    "lexical_path",
+    default=None,
+    help="BM25 index of the chunks, built with lexicalsearch.py.",
+)
+@click.option(
+    "--retrieval",
+    type=click.Choice(RETRIEVAL_MODES),
+    default="vector",
+    help="Search by embedding, by keyword (needs --lexical-index), or both.",
+)
+@click.option(
+    "--videos",
+    "videos_path",
+    default=VIDEOS_PATH,
+    help="Video table the related videos are looked up in.",
+)
+@click.option("--max-sessions", default=MAX_SESSIONS)
+@click.option("--idle-timeout", default=SESSION_IDLE_SECONDS, help="Seconds.")
+@click.option(
+    "--max-concurrency",
+    default=MAX_CONCURRENCY,
+    help="Questions answered at once.",
+)
+@click.option(
+    "--max-waiting",
+    default=MAX_WAITING,
+    help="Questions queued beyond that before answering 503.",
+)
+@click.option("--api-connections", default=API_CONNECTIONS)
+@click.option(
+    "--context-tokens",
+    default=CONTEXT_TOKEN_BUDGET,
+    help="Token budget for the retrieved transcript excerpts in the prompt.",
+)
+@click.option(
+    "--memory-tokens",
+    default=MEMORY_TOKEN_LIMIT,
+    help="How much of the conversation, in tokens, goes with each question.",
+)
+@click.option(
+    "--summarize-history",
+    is_flag=True,
+    help="Summarize the part of the conversation that no longer fits.",
+)
+@click.option(
+    "--condense",
+    "condense_mode",
+    type=click.Choice(CONDENSE_MODES),
+    default="auto",
+    help="When to rewrite follow-up questions before retrieval (see condense.py).",
+)
+@click.option(
+    "--condense-model",
+    default=CONDENSE_MODEL,
+    help="Model that rewrites follow-up questions.",
+)
+@click.option(
+    "--trace-file",
+    "trace_path",
+    default=None,
+    help="Append a trace of each turn's stages to this JSONL file.",
+)
+@click.option(
+    "--metrics-file",
+    "metrics_path",
+    default=None,
+    help="Also write the /metrics text to this file after each turn.",
+)
+@click.option(
+    "--history-db",
+    default=DEFAULT_PATH,
+    help="SQLite database conversations are saved to, so they can be resumed.",
+)
+def serve(
+    host,
+    port,
+    index_path,
+    lexical_path,
+    retrieval,
+    videos_path,
+    max_sessions,
+    idle_timeout,
+    max_concurrency,
+    max_waiting,
+    api_connections,
+    context_tokens,
+    memory_tokens,
+    summarize_history,
+    condense_mode,
+    condense_model,
+    trace_path,
+    metrics_path,
+    history_db,
+):
+    if retrieval != "vector" and lexical_path is None:
+        raise click.BadParameter(
+            f"{retrieval} retrieval needs --lexical-index", param_hint="--retrieval"
+        )
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+    store = HistoryStore(history_db)
+    app = make_app(
+        ChatBackend(
+            index_path,
+            context_tokens,
+            condense_mode,
+            condense_model,
+            lexical_path,
+            retrieval,
+            videos_path,
+            trace_path,
+            metrics_path,
+        ),
+        max_sessions,
+        idle_timeout,
+        max_concurrency,
+        max_waiting,
+        memory_tokens,
+        summarize_history,
+        store,
+    )
+    try:
+        asyncio.run(_serve(app, host, port, api_connections))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+        app["backend"].tracer.close()
+
+
+async def _conversation(http, url, questions, latencies, errors):
+    try:
+        await _ask(http, url, questions, latencies, errors)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        # e.g. the handshake refused with a 503, or the server went away
+        errors.append(f"{type(e).__name__}: {e}")
+
+
+async def _ask(http, url, questions, latencies, errors):
+    async with http.ws_connect(f"{url}/ws") as ws:
+        await ws.receive_json()
+        for i in range(questions):
+            started = time.perf_counter()
+            first_token = None
+            await ws.send_json({"question": f"What do cherry shrimp eat? ({i})"})
+            while True:
+                message = await ws.receive_json()
+                if message["type"] == "token" and first_token is None:
+                    first_token = time.perf_counter() - started
+                elif message["type"] == "done":
+                    latencies.append((first_token, time.perf_counter() - started))
+                    break
+                elif message["type"] == "error":
+                    errors.append(message["error"])
+                    break
+
+
+async def _loadtest(url, sessions, questions):
+    latencies, errors = [], []
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as http:
+        await asyncio.gather(
+            *(
+                _conversation(http, url, questions, latencies, errors)
+                for _ in range(sessions)
+            )
+        )
+    return latencies, errors, time.perf_counter() - started
+
+
+@cli.command()
+@click.option("--url", default="http://127.0.0.1:8080")
+@click.option("--sessions", default=20, help="Concurrent conversations.")
+@click.option("--questions", default=3, help="Questions per conversation.")
+def loadtest(url, sessions, questions):
+    """Holds many conversations with a running server over WebSockets."""
+    latencies, errors, elapsed = asyncio.run(_loadtest(url, sessions, questions))
+
+    print(f"{len(latencies)} answers, {len(errors)} errors in {elapsed:.1f}s")
+    for error, count in Counter(errors).most_common(5):
+        print(f"  {count} x {error}")
+    if latencies:
+        first = np.array([f for f, _ in latencies if f is not None]) * 1000
+        total = np.array([t for _, t in latencies]) * 1000
+        if len(first):
+            print(
+                f"time to first token: p50 {np.percentile(first, 50):.0f}ms, "
+                f"p95 {np.percentile(first, 95):.0f}ms"
+            )
+        else:
+            print("time to first token: no answer streamed a token")
+        print(
+            f"answer time: p50 {np.percentile(total, 50):.0f}ms, "
+            f"p95 {np.percentile(total, 95):.0f}ms, "
+            f"{len(latencies) / elapsed:.1f} answers/sec"
+        )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,244 @@
+"""
+Chat histories kept in SQLite, so conversations survive a restart.
+
+One database holds every session. Messages are only ever appended, a turn
+(question and answer) at a time, and a session only loads its last few
+messages when it's first used. All database work happens on one background
+thread per database, so the async server never waits on SQLite: writes are
+queued and forgotten about, and the one read, loading a session, can be
+awaited with `aload`.
+
+    python sqlite_history.py sessions
+    python sqlite_history.py show SESSION_ID
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List
+
+import click
+from langchain.schema import BaseChatMessageHistory
+from langchain.schema.messages import (
+    AIMessage,
+    BaseMessage,
+    _message_to_dict,
+    messages_from_dict,
+)
+
+from defaults import HISTORY_PATH as DEFAULT_PATH
+
+# Messages of a session loaded into memory when it's resumed; the memory only
+# shows the LLM the last few turns anyway
+LOAD_LAST_MESSAGES = 50
+
+logger = logging.getLogger(__name__)
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+class HistoryStore:
+    """
+    The database of chat histories. The connection is only used from the
+    store's own thread; `call` runs a function on it there and returns a
+    concurrent Future.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self.db = None
+        self.call(self._open).result()
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            ) WITHOUT ROWID
+            """)
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)"
+        )
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID
+            """)
+        self.db.commit()
+
+    def call(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    async def acall(self, fn, *args):
+        return await asyncio.wrap_future(self.call(fn, *args))
+
+    def exists(self, session_id):
+        row = self.db.execute(
+            "SELECT 1 FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        return row is not None
+
+    def load(self, session_id, limit):
+        """The last `limit` messages of a session"""
+        rows = self.db.execute(
+            "SELECT seq, message FROM messages WHERE session_id = ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (session_id, limit),
+        ).fetchall()
+        rows.reverse()
+        return messages_from_dict([json.loads(m) for _, m in rows])
+
+    def append(self, session_id, messages):
+        now = time.time()
+        with self.db:
+            # numbered in the same transaction as they're inserted, so two
+            # histories of one session (a session resumed while it's still
+            # open elsewhere) interleave their turns instead of colliding
+            (first_seq,) = self.db.execute(
+                "SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+            self.db.execute(
+                "INSERT INTO sessions (id, created, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET updated = excluded.updated",
+                (session_id, now, now),
+            )
+            self.db.executemany(
+                "INSERT INTO messages (session_id, seq, message, created) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (session_id, first_seq + i, json.dumps(_message_to_dict(m)), now)
+                    for i, m in enumerate(messages)
+                ],
+            )
+
+    def delete(self, session_id):
+        with self.db:
+            self.db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self.db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def recent_sessions(self, limit):
+        return self.db.execute(
+            "SELECT s.id, s.updated, "
+            "(SELECT COUNT(*) FROM messages m WHERE m.session_id = s.id) "
+            "FROM sessions s ORDER BY s.updated DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+
+    def close(self):
+        """Waits for queued writes, then closes the database"""
+        if self.db is not None:
+            self.call(self.db.close).result()
+            self.db = None
+        self.executor.shutdown()
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    """
+    The history of one session in a HistoryStore. Its last `load_last`
+    messages are read the first time `messages` is used, or ahead of time
+    with `aload`. New messages are written when a turn ends, i.e. on each AI
+    message, without waiting for the write to finish.
+    """
+
+    def __init__(self, store, session_id, load_last=LOAD_LAST_MESSAGES):
+        self.store = store
+        self.session_id = session_id
+        self.load_last = load_last
+        self._messages = None
+        self._pending = []
+
+    def _loaded(self, messages):
+        if self._messages is None:
+            self._messages = messages
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        if self._messages is None:
+            self._loaded(
+                self.store.call(
+                    self.store.load, self.session_id, self.load_last
+                ).result()
+            )
+        return self._messages
+
+    async def aload(self):
+        if self._messages is None:
+            self._loaded(
+                await self.store.acall(self.store.load, self.session_id, self.load_last)
+            )
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.messages.append(message)
+        self._pending.append(message)
+        if isinstance(message, AIMessage):
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        future = self.store.call(self.store.append, self.session_id, self._pending)
+        future.add_done_callback(self._log_failure)
+        self._pending = []
+
+    def _log_failure(self, future):
+        if future.exception() is not None:
+            logger.error(
+                "Failed to save chat history of %s: %s",
+                self.session_id,
+                future.exception(),
+            )
+
+    def clear(self) -> None:
+        self.store.call(self.store.delete, self.session_id)
+        self._messages = []
+        self._pending = []
+
+
+@click.group()
+@click.option("--db", "path", default=DEFAULT_PATH)
+@click.pass_context
+def cli(ctx, path):
+    ctx.obj = HistoryStore(path)
+    ctx.call_on_close(ctx.obj.close)
+
+
+@cli.command()
+@click.option("--limit", default=20)
+@click.pass_obj
+def sessions(store, limit):
+    """Lists the most recently active sessions."""
+    for session_id, updated, count in store.call(store.recent_sessions, limit).result():
+        when = datetime.fromtimestamp(updated).isoformat(sep=" ", timespec="seconds")
+        print(f"{session_id}  {when}  {count} messages")
+
+
+@cli.command()
+@click.argument("session_id")
+@click.option("--last", default=LOAD_LAST_MESSAGES)
+@click.pass_obj
+def show(store, session_id, last):
+    """Prints the last messages of a session."""
+    messages, _ = store.call(store.load, session_id, last).result()
+    for message in messages:
+        print(f"{message.type.upper()}> {message.content}\n")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,60 @@
+"""
+Golden test: chunkify.chunk_tokens makes exactly the chunks of the original
+token-at-a-time algorithm, chunkify.chunk_transcript_reference.
+
+    python -m pytest test_chunkify.py
+"""
+
+import random
+
+import pytest
+
+import bench
+import chunkify
+
+# (chunk, overlap) limits: the defaults, and others that move the window
+# edges against the transcript lines
+WINDOWS = [
+    (chunkify.CHUNK_TOKEN_LIMIT, chunkify.OVERLAP_TOKEN_LIMIT),
+    (10, 3),
+    (50, 1),
+    (200, 50),
+    (7, 6),
+    (20, 0),
+]
+
+# Lines per transcript: empty, shorter than a chunk, and a few windows long
+LINES = [0, 1, 3, 40, 250]
+
+
+def transcripts():
+    rng = random.Random(0)
+    for i, lines in enumerate(LINES):
+        yield bench.synthetic_video(i, lines, rng)["transcript"]
+
+
+@pytest.fixture
+def limits(monkeypatch, request):
+    # the reference algorithm only reads the module's limits
+    chunk_limit, overlap_limit = request.param
+    monkeypatch.setattr(chunkify, "CHUNK_TOKEN_LIMIT", chunk_limit)
+    monkeypatch.setattr(chunkify, "OVERLAP_TOKEN_LIMIT", overlap_limit)
+    return chunk_limit, overlap_limit
+
+
+@pytest.mark.parametrize("limits", WINDOWS, indirect=True, ids=str)
+def test_chunk_tokens_matches_reference(limits):
+    for transcript in transcripts():
+        tokens, entry_index = chunkify.tokenize_transcript(transcript)
+        chunks = chunkify.chunk_tokens(transcript, tokens, entry_index, *limits)
+        assert chunks == chunkify.chunk_transcript_reference(transcript)
+
+
+def test_cached_tokens_match(tmp_path):
+    for transcript in transcripts():
+        content = repr(transcript).encode()
+        expected = chunkify.tokenize_transcript(transcript)
+        for _ in range(2):  # tokenized, then read from the cache
+            tokens, entry_index = chunkify.cached_tokens(content, transcript, tmp_path)
+            assert tokens.tolist() == expected[0].tolist()
+            assert entry_index.tolist() == expected[1].tolist()
@@ -0,0 +1,108 @@
+"""
+download_transcripts.py against fake_youtube.py: resumable downloads and
+incremental syncs of a channel and of a user's playlist.
+
+    python -m pytest test_download_transcripts.py
+"""
+
+import json
+import os
+import threading
+
+import pytest
+from click.testing import CliRunner
+from youtube_transcript_api import _transcripts
+
+# the API key is read on import
+os.environ.setdefault("YOUTUBE_API_KEY", "fake")
+
+import download_transcripts  # noqa: E402
+import fake_youtube  # noqa: E402
+
+CHANNEL_URL = f"https://www.youtube.com/user/{fake_youtube.CHANNEL}"
+PLAYLIST_URL = f"https://www.youtube.com/playlist?list={fake_youtube.FAVOURITES}"
+
+
+@pytest.fixture
+def youtube(monkeypatch):
+    server = fake_youtube.make_server(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("YOUTUBE_API_ENDPOINT", server.api_endpoint)
+    monkeypatch.setattr(_transcripts, "WATCH_URL", server.watch_url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def sync(url, output_path, *args):
+    result = CliRunner().invoke(
+        download_transcripts.main,
+        [url, str(output_path), "--rate", "0", "--incremental", *args],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def downloaded(output_path):
+    return {name[: -len(".json")] for name in os.listdir(output_path)} - {".sync-state"}
+
+
+def test_channel_sync_stops_at_known_videos(youtube, tmp_path):
+    output = sync(CHANNEL_URL, tmp_path)
+    assert "120 downloaded, 0 already on disk, 0 failed" in output
+    assert youtube.page_requests[fake_youtube.UPLOADS] == 3
+    with open(tmp_path / "video00007.json") as f:
+        video = json.load(f)
+    assert video["url"] == "https://youtube.com/watch?v=video00007"
+    assert video["transcript"] == youtube.transcripts["video00007"]
+
+    # one new video with a transcript, one whose captions aren't ready yet
+    fake_youtube.publish(youtube, "new00000", "2024-02-01T12:00:00Z", seed=1)
+    fake_youtube.publish(
+        youtube, "new00001", "2024-02-02T12:00:00Z", captions=False, seed=2
+    )
+    youtube.page_requests.clear()
+    output = sync(CHANNEL_URL, tmp_path)
+    assert "2 videos added since" in output
+    assert "1 downloaded, 0 already on disk, 1 failed" in output
+    assert youtube.page_requests[fake_youtube.UPLOADS] == 1
+
+    # the failed video stays after the watermark and is tried again
+    youtube.transcripts["new00001"] = youtube.transcripts["new00000"]
+    output = sync(CHANNEL_URL, tmp_path)
+    assert "1 videos added since 2024-02-01T12:00:00Z" in output
+    assert "1 downloaded, 0 already on disk, 0 failed" in output
+    assert downloaded(tmp_path) >= {"new00000", "new00001"}
+
+    output = sync(CHANNEL_URL, tmp_path)
+    assert "0 videos added since" in output
+
+
+def test_playlist_sync_finds_videos_added_anywhere(youtube, tmp_path):
+    output = sync(PLAYLIST_URL, tmp_path)
+    assert "60 downloaded" in output
+
+    # user playlists aren't newest first, so the new video is on the last page
+    fake_youtube.add_to_playlist(
+        youtube, fake_youtube.FAVOURITES, "video00100", "2024-03-01T12:00:00Z"
+    )
+    youtube.page_requests.clear()
+    output = sync(PLAYLIST_URL, tmp_path)
+    assert "1 videos added since" in output
+    assert "1 downloaded" in output
+    assert youtube.page_requests[fake_youtube.FAVOURITES] == 2
+    assert "video00100" in downloaded(tmp_path)
+
+
+def test_existing_transcripts_are_skipped_unless_forced(youtube, tmp_path):
+    sync(PLAYLIST_URL, tmp_path)
+
+    # without the sync state every video is listed again
+    os.remove(tmp_path / download_transcripts.SYNC_STATE_FILE)
+    output = sync(PLAYLIST_URL, tmp_path)
+    assert "0 downloaded, 60 already on disk" in output
+    os.remove(tmp_path / download_transcripts.SYNC_STATE_FILE)
+    output = sync(PLAYLIST_URL, tmp_path, "--force")
+    assert "60 downloaded, 0 already on disk" in output
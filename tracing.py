@@ -0,0 +1,323 @@
+"""
+Where the time of each chat turn goes, without an outside service.
+
+A turn is traced as a list of spans, one per stage:
+
+    condense        the LLM call rewriting a follow-up question
+    retrieve        getting the chunks for the question, start to end
+    embed_query     the question's embedding (or its cache lookup)
+    vector_search   the nearest-neighbour search
+    lexical_search  the BM25 search
+    pack_context    merging and trimming the chunks into the prompt
+    generate        the LLM call writing the answer
+    turn            the whole turn
+
+LLM spans come from TracingCallbackHandler, the others from `span` blocks in
+the code of each stage, which find the turn being traced through a context
+variable. Spans carry what's useful about the stage: token counts, how many
+documents came back, whether a cache answered.
+
+Finished turns are appended to a JSONL file, if one is given, and added to
+Prometheus histograms that can be written to a file or served (server.py
+serves them on /metrics).
+
+    python tracing.py summary traces.jsonl
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+import click
+import numpy as np
+from langchain.callbacks.base import BaseCallbackHandler
+
+# Bucket bounds of the latency histograms, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+_tokenizer = None
+
+
+def _count_tokens(text):
+    global _tokenizer
+    if _tokenizer is None:
+        import tiktoken
+
+        _tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    return len(_tokenizer.encode(text))
+
+
+class Trace:
+    """The spans of one turn, timed from when it started"""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:16]
+        self.time = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.finished = False
+
+    def add(self, stage, started, ended, **attributes):
+        # work still running after its turn ended, like a condensing call
+        # that missed its deadline, is no longer part of the turn
+        if self.finished:
+            return
+        self.spans.append(
+            dict(
+                stage=stage,
+                start=round(started - self.started, 6),
+                seconds=round(ended - started, 6),
+                **attributes,
+            )
+        )
+
+    def to_dict(self):
+        return {"trace_id": self.id, "time": self.time, "spans": self.spans}
+
+
+@contextmanager
+def span(stage, **attributes):
+    """
+    Times the block as a span of the turn being traced, if any. The dict it
+    yields can be filled in with more attributes for the span.
+    """
+    trace = _current.get()
+    if trace is None:
+        yield attributes
+        return
+    started = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        trace.add(stage, started, time.perf_counter(), **attributes)
+
+
+def copy_context():
+    """The current context, to run work on another thread as part of the same turn"""
+    return contextvars.copy_context()
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Adds a span to `trace` for each LLM call, named after the call's "condense"
+    or "generate" tag, with its prompt and completion token counts and, when
+    it streams, the time to its first token.
+    """
+
+    # called right away even from async chains, so the times are right
+    run_inline = True
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.runs = {}
+
+    def _start(self, run_id, tags, prompt_tokens):
+        stage = next((t for t in tags or () if t in ("condense", "generate")), "llm")
+        self.runs[run_id] = {
+            "stage": stage,
+            "started": time.perf_counter(),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": 0,
+        }
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        self._start(
+            run_id,
+            tags,
+            sum(_count_tokens(m.content) for batch in messages for m in batch),
+        )
+
+    def on_llm_start(self, serialized, prompts, *, run_id, tags=None, **kwargs):
+        self._start(run_id, tags, sum(_count_tokens(p) for p in prompts))
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self.runs.get(run_id)
+        if run is None:
+            return
+        if "first_token" not in run:
+            run["first_token"] = time.perf_counter() - run["started"]
+        run["completion_tokens"] += 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        if not run["completion_tokens"]:
+            run["completion_tokens"] = sum(
+                _count_tokens(g.text) for gs in response.generations for g in gs
+            )
+        attributes = {
+            "prompt_tokens": run["prompt_tokens"],
+            "completion_tokens": run["completion_tokens"],
+        }
+        if "first_token" in run:
+            attributes["first_token_seconds"] = round(run["first_token"], 6)
+        self.trace.add(run["stage"], run["started"], time.perf_counter(), **attributes)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self.runs.pop(run_id, None)
+        if run is not None:
+            self.trace.add(
+                run["stage"], run["started"], time.perf_counter(), error=str(error)
+            )
+
+
+class Tracer:
+    """
+    Collects the traces of a ChatBackend's turns: appends each to the JSONL
+    file at `path` and rewrites the Prometheus metrics at `metrics_path`,
+    either of which may be None.
+    """
+
+    def __init__(self, path=None, metrics_path=None):
+        self.path = path
+        self.metrics_path = metrics_path
+        self.lock = threading.Lock()
+        self.file = open(path, "a") if path is not None else None
+        # stage -> [bucket counts..., sum, count]
+        self.histograms = defaultdict(lambda: [0] * (len(BUCKETS) + 2))
+        self.tokens = defaultdict(int)
+        self.documents = 0
+
+    @contextmanager
+    def turn(self):
+        """Traces the turn run in the block, which gets its TracingCallbackHandler"""
+        trace = Trace()
+        token = _current.set(trace)
+        try:
+            yield TracingCallbackHandler(trace)
+        finally:
+            _current.reset(token)
+            trace.add("turn", trace.started, time.perf_counter())
+            trace.finished = True
+            self.record(trace)
+
+    def record(self, trace):
+        with self.lock:
+            for s in trace.spans:
+                histogram = self.histograms[s["stage"]]
+                for i, bound in enumerate(BUCKETS):
+                    if s["seconds"] <= bound:
+                        histogram[i] += 1
+                histogram[-2] += s["seconds"]
+                histogram[-1] += 1
+                for kind in ("prompt_tokens", "completion_tokens"):
+                    if kind in s:
+                        self.tokens[s["stage"], kind] += s[kind]
+                if s["stage"] == "retrieve":
+                    self.documents += s.get("documents", 0)
+
+            if self.file is not None:
+                self.file.write(json.dumps(trace.to_dict()) + "\n")
+                self.file.flush()
+            if self.metrics_path is not None:
+                partial = f"{self.metrics_path}.partial"
+                with open(partial, "w") as f:
+                    f.write(self._prometheus())
+                os.replace(partial, self.metrics_path)
+
+    def prometheus(self):
+        """The metrics in Prometheus' text format"""
+        with self.lock:
+            return self._prometheus()
+
+    def _prometheus(self):
+        lines = [
+            "# HELP corydora_stage_seconds Time spent in each stage of a chat turn.",
+            "# TYPE corydora_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            for bound, count in zip(BUCKETS, histogram):
+                lines.append(
+                    f'corydora_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} '
+                    f"{count}"
+                )
+            lines.append(
+                f'corydora_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} '
+                f"{histogram[-1]}"
+            )
+            lines.append(
+                f'corydora_stage_seconds_sum{{stage="{stage}"}} {histogram[-2]}'
+            )
+            lines.append(
+                f'corydora_stage_seconds_count{{stage="{stage}"}} {histogram[-1]}'
+            )
+
+        lines += [
+            "# HELP corydora_llm_tokens_total Tokens sent to and generated by the LLM.",
+            "# TYPE corydora_llm_tokens_total counter",
+        ]
+        for (stage, kind), count in sorted(self.tokens.items()):
+            kind = kind[: -len("_tokens")]
+            lines.append(
+                f'corydora_llm_tokens_total{{stage="{stage}",kind="{kind}"}} {count}'
+            )
+
+        lines += [
+            "# HELP corydora_retrieved_documents_total Chunks retrieved for questions.",
+            "# TYPE corydora_retrieved_documents_total counter",
+            f"corydora_retrieved_documents_total {self.documents}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("trace_file")
+@click.option("--last", default=None, type=int, help="Only the last N turns.")
+def summary(trace_file, last):
+    """Per-stage latency of the turns traced in TRACE_FILE."""
+    with open(trace_file) as f:
+        traces = [json.loads(line) for line in f]
+    if last is not None:
+        traces = traces[-last:]
+
+    seconds = defaultdict(list)
+    tokens = defaultdict(int)
+    for trace in traces:
+        # a stage may run more than once a turn (e.g. nested retrievers)
+        per_turn = defaultdict(float)
+        for s in trace["spans"]:
+            per_turn[s["stage"]] += s["seconds"]
+            tokens[s["stage"]] += s.get("prompt_tokens", 0) + s.get(
+                "completion_tokens", 0
+            )
+        for stage, total in per_turn.items():
+            seconds[stage].append(total)
+
+    if not traces:
+        print("No turns traced")
+        return
+    turn_seconds = sum(seconds["turn"]) or 1.0
+    print(f"{len(traces)} turns")
+    print(
+        f"{'stage':<16}{'turns':>7}{'p50 ms':>10}{'p95 ms':>10}{'share':>8}{'tokens/turn':>13}"
+    )
+    for stage, values in sorted(seconds.items(), key=lambda kv: -sum(kv[1])):
+        ms = np.array(values) * 1000
+        print(
+            f"{stage:<16}{len(values):>7}"
+            f"{np.percentile(ms, 50):>10.1f}{np.percentile(ms, 95):>10.1f}"
+            f"{sum(values) / turn_seconds:>8.0%}"
+            f"{tokens[stage] / len(values):>13.0f}"
+        )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,268 @@
+"""
+Reading and writing embedded chunks in either of two formats:
+
+* JSONL (`*.jsonl`), one {"id", "text", "embedding", "metadata"} object per
+  line, the embedding being a JSON list of floats.
+* Binary (`*.npy`), the embeddings as a float32 matrix in a plain `.npy` file,
+  plus a `*.meta.jsonl` sidecar holding the id, text and metadata of each row
+  in the same order. The matrix is memory-mapped when reading, so vectors are
+  never parsed.
+
+Embedded chunks can also be written (not read) as Parquet (`*.parquet`), with
+the embedding as a fixed-size list of float32, which needs pyarrow.
+
+The format is picked from the file extension.
+
+    python vectorfile.py convert embeddings.jsonl embeddings.npy
+"""
+
+import json
+import struct
+
+import click
+import numpy as np
+from tqdm import tqdm
+
+# Fixed size of the .npy header we write, so it can be rewritten in place with
+# the final row count once all rows are written. 128 bytes keeps the data
+# 64-byte aligned.
+NPY_HEADER_SIZE = 128
+
+PARQUET_ROW_GROUP_SIZE = 10000
+
+
+def is_binary(path):
+    return path.endswith(".npy")
+
+
+def sidecar_path(path):
+    """Path of the metadata file that goes with the .npy file at `path`"""
+    return path[: -len(".npy")] + ".meta.jsonl"
+
+
+def codes_path(path):
+    """Path of the quantized codes of the .npy file at `path` (see quantize.py)"""
+    return path[: -len(".npy")] + ".codes.npz"
+
+
+def _npy_header(rows, dimensions):
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (
+        rows,
+        dimensions,
+    )
+    # magic string + version + header length take up the first 10 bytes
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode()
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self.file = open(path, "w")
+
+    def write(self, data, embedding):
+        if isinstance(embedding, np.ndarray):
+            embedding = embedding.tolist()
+
+        # add the embedding before the metadata key
+        data = {
+            "id": data["id"],
+            "text": data["text"],
+            "embedding": embedding,
+            "metadata": data["metadata"],
+        }
+
+        json.dump(data, self.file)
+        self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NpyWriter:
+    """
+    Streams rows into a float32 .npy file and its metadata sidecar. The row
+    count isn't known up front, so the header is written last.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(b"\0" * NPY_HEADER_SIZE)
+        self.sidecar = open(sidecar_path(path), "w")
+        self.rows = 0
+        self.dimensions = None
+
+    def write(self, data, embedding):
+        vector = np.asarray(embedding, dtype="<f4")
+        if self.dimensions is None:
+            self.dimensions = len(vector)
+        elif len(vector) != self.dimensions:
+            raise ValueError(
+                f"Embedding for {data['id']} has {len(vector)} dimensions, "
+                f"expected {self.dimensions}"
+            )
+
+        self.file.write(vector.tobytes())
+        json.dump(
+            {"id": data["id"], "text": data["text"], "metadata": data["metadata"]},
+            self.sidecar,
+        )
+        self.sidecar.write("\n")
+        self.rows += 1
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(_npy_header(self.rows, self.dimensions or 0))
+        self.file.close()
+        self.sidecar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParquetWriter:
+    """
+    Writes rows to a Parquet file, buffering them into row groups of
+    `row_group_size`. Metadata is stored as a JSON string.
+    """
+
+    def __init__(self, path, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        # only needed for this format; fail before anything is written
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError as e:
+            raise ImportError(
+                "Writing .parquet needs pyarrow (pip install pyarrow), "
+                "or write .npy instead"
+            ) from e
+
+        self.path = path
+        self.row_group_size = row_group_size
+        self.writer = None
+        self.rows = []
+
+    def write(self, data, embedding):
+        self.rows.append((data, np.asarray(embedding, dtype=np.float32)))
+        if len(self.rows) >= self.row_group_size:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        matrix = np.stack([embedding for _, embedding in self.rows])
+        table = pa.table(
+            {
+                "id": [data["id"] for data, _ in self.rows],
+                "text": [data["text"] for data, _ in self.rows],
+                "metadata": [json.dumps(data["metadata"]) for data, _ in self.rows],
+                "embedding": pa.FixedSizeListArray.from_arrays(
+                    pa.array(matrix.ravel()), matrix.shape[1]
+                ),
+            }
+        )
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        if self.rows:
+            self._write_row_group()
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writer(path):
+    if is_binary(path):
+        return NpyWriter(path)
+    if path.endswith(".parquet"):
+        return ParquetWriter(path)
+    return JsonlWriter(path)
+
+
+def load_matrix(path):
+    """Memory-maps the float32 embedding matrix of a .npy file"""
+    return np.load(path, mmap_mode="r")
+
+
+def count_rows(path):
+    if is_binary(path):
+        return load_matrix(path).shape[0]
+    return sum(1 for _ in open(path))
+
+
+def iter_batches(path, batch_size=1000):
+    """
+    Yields (ids, texts, metadatas, embeddings) batches from a file in either
+    format. For .npy files `embeddings` is a read-only float32 view of the
+    memory-mapped matrix, for JSONL files it is a list of lists.
+    """
+    ids, texts, metadatas, embeddings = [], [], [], []
+
+    if is_binary(path):
+        matrix = load_matrix(path)
+        start = 0
+        with open(sidecar_path(path)) as sidecar:
+            for line in sidecar:
+                entry = json.loads(line)
+                ids.append(entry["id"])
+                texts.append(entry["text"])
+                metadatas.append(entry["metadata"])
+                if len(ids) >= batch_size:
+                    yield ids, texts, metadatas, matrix[start : start + len(ids)]
+                    start += len(ids)
+                    ids, texts, metadatas = [], [], []
+        if ids:
+            yield ids, texts, metadatas, matrix[start : start + len(ids)]
+        return
+
+    with open(path) as infile:
+        for line in infile:
+            entry = json.loads(line)
+            ids.append(entry["id"])
+            texts.append(entry["text"])
+            metadatas.append(entry["metadata"])
+            embeddings.append(entry["embedding"])
+            if len(ids) >= batch_size:
+                yield ids, texts, metadatas, embeddings
+                ids, texts, metadatas, embeddings = [], [], [], []
+    if ids:
+        yield ids, texts, metadatas, embeddings
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("input_file")
+@click.argument("output_file")
+def convert(input_file, output_file):
+    """Convert embeddings between JSONL and .npy, based on the file extensions."""
+    with open_writer(output_file) as writer, tqdm(
+        total=count_rows(input_file)
+    ) as progress:
+        for ids, texts, metadatas, embeddings in iter_batches(input_file):
+            for id, text, metadata, embedding in zip(ids, texts, metadatas, embeddings):
+                writer.write({"id": id, "text": text, "metadata": metadata}, embedding)
+            progress.update(len(ids))
+
+
+if __name__ == "__main__":
+    cli()
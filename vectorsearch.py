@@ -0,0 +1,297 @@
+"""
+Exact, in-process vector search over a memory-mapped embedding matrix.
+
+The index is the binary output of vectorfile.py: a float32 `.npy` matrix plus
+its `.meta.jsonl` sidecar. Export the collection with
+
+    python chroma-to-tsv.py index.npy metadata.tsv
+
+Search is a single matrix-vector product and an argpartition, which for a
+corpus of this size is faster than going through Chroma and keeps nothing in
+memory but the line offsets of the sidecar; the OS pages the matrix in.
+
+If the matrix has been quantized (see quantize.py), its compact codes are
+searched instead, and only the best candidates' rows are read to rescore
+them exactly, so the matrix is no longer paged in whole.
+
+    python vectorsearch.py bench index.npy
+"""
+
+import json
+import mmap
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, List
+
+import click
+import numpy as np
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import BaseRetriever, Document
+
+import quantize
+import vectorfile
+from tracing import span
+
+# Candidates from the quantized codes that are rescored with their vectors
+RESCORE_CANDIDATES = 100
+
+
+def _top(scores, k):
+    """The columns of the `k` highest scores of each row, best first"""
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+class VectorIndex:
+    """
+    A read-only index over a .npy embedding matrix. Rows are ranked by dot
+    product, which for ada-002's unit-length embeddings gives the same order
+    as cosine similarity and Chroma's L2 distance.
+
+    When the matrix has quantized codes, they're searched first and the best
+    `rescore` candidates rescored exactly, unless `exact` is set. Codes built
+    from another matrix than the one at `path` (see quantize.fingerprint) are
+    ignored.
+    """
+
+    def __init__(self, path, exact=False, rescore=RESCORE_CANDIDATES):
+        self.path = path
+        self.matrix = vectorfile.load_matrix(path)
+        self.codes = None if exact else quantize.load_codes(path, self.matrix)
+        self.rescore = rescore
+
+        # Find where each line of the sidecar starts, so a row's metadata can
+        # be read without parsing any of the others
+        with open(vectorfile.sidecar_path(path), "rb") as f:
+            # an empty file can't be mapped, an index of no rows has one
+            if os.fstat(f.fileno()).st_size == 0:
+                self.sidecar = b""
+            else:
+                self.sidecar = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        newlines = np.flatnonzero(np.frombuffer(self.sidecar, dtype=np.uint8) == 10)
+        self.offsets = np.concatenate(([0], newlines + 1))
+
+        if len(self.offsets) - 1 != len(self.matrix):
+            raise ValueError(
+                f"{path} has {len(self.matrix)} rows but its sidecar has "
+                f"{len(self.offsets) - 1}"
+            )
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def search(self, queries, k=25):
+        """
+        Finds the `k` nearest rows for each query vector. `queries` is either
+        a single vector or a 2-D array of them. Returns, per query, a list of
+        (row, score) pairs, best first.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+
+        if self.codes is None:
+            scores = queries @ self.matrix.T
+            top = _top(scores, k)
+            results = [
+                list(zip(rows.tolist(), row_scores[rows].tolist()))
+                for rows, row_scores in zip(top, scores)
+            ]
+        else:
+            candidates = _top(self.codes.scores(queries), max(k, self.rescore))
+            results = []
+            for query, rows in zip(queries, candidates):
+                # in file order, so the reads from the mmap go forwards
+                rows = np.sort(rows)
+                scores = self.matrix[rows] @ query
+                best = _top(scores[None], k)[0]
+                results.append(list(zip(rows[best].tolist(), scores[best].tolist())))
+        return results[0] if single else results
+
+    def row(self, i):
+        """The {"id", "text", "metadata"} entry of row `i`"""
+        return json.loads(self.sidecar[self.offsets[i] : self.offsets[i + 1]])
+
+    def documents(self, hits):
+        documents = []
+        for i, _ in hits:
+            entry = self.row(i)
+            documents.append(
+                Document(page_content=entry["text"], metadata=entry["metadata"])
+            )
+        return documents
+
+
+class MmapRetriever(BaseRetriever):
+    """
+    LangChain retriever over a VectorIndex, a drop-in replacement for
+    `Chroma.as_retriever(search_kwargs={"k": k})`.
+    """
+
+    index: Any
+    embeddings: Any
+    k: int = 25
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector = self.embeddings.embed_query(query)
+        with span("vector_search") as attributes:
+            documents = self.index.documents(self.index.search(vector, self.k))
+            attributes["documents"] = len(documents)
+        return documents
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector = await self.embeddings.aembed_query(query)
+        with span("vector_search") as attributes:
+            documents = self.index.documents(self.index.search(vector, self.k))
+            attributes["documents"] = len(documents)
+        return documents
+
+    def get_relevant_documents_batch(self, queries: List[str]) -> List[List[Document]]:
+        """Retrieves documents for several queries with one embedding call and one search."""
+        if hasattr(self.embeddings, "embed_queries"):
+            # query_cache.CachedEmbeddings, which only embeds uncached queries
+            vectors = self.embeddings.embed_queries(queries)
+        else:
+            vectors = self.embeddings.embed_documents(queries)
+        with span("vector_search") as attributes:
+            results = [
+                self.index.documents(hits)
+                for hits in self.index.search(vectors, self.k)
+            ]
+            attributes["queries"] = len(queries)
+            attributes["documents"] = sum(len(documents) for documents in results)
+        return results
+
+
+def _rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _bench_backend(backend, path, queries, k, batch_size):
+    """Times `queries` searches for a backend, in the current process."""
+    started = time.perf_counter()
+    if backend == "mmap":
+        index = VectorIndex(path)
+        dimensions = index.matrix.shape[1]
+
+        def search(vectors):
+            for hits in index.search(vectors, k):
+                index.documents(hits)
+
+    else:
+        import chromadb
+        from chromadb.config import Settings
+
+        client = chromadb.Client(
+            Settings(chroma_db_impl="duckdb+parquet", persist_directory=path)
+        )
+        collection = client.get_collection(name="aquarium-co-op-youtube")
+        dimensions = len(collection.peek(1)["embeddings"][0])
+
+        def search(vectors):
+            collection.query(
+                query_embeddings=vectors.tolist(),
+                n_results=k,
+                include=["documents", "metadatas"],
+            )
+
+    load_seconds = time.perf_counter() - started
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((queries, dimensions)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    latencies = []
+    for start in range(0, queries, batch_size):
+        began = time.perf_counter()
+        search(vectors[start : start + batch_size])
+        latencies.append((time.perf_counter() - began) / batch_size)
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "backend": backend,
+        "load_seconds": load_seconds,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "max_rss_mb": _rss_mb(),
+    }
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("index_path")
+@click.option("--chroma", "chroma_path", default="./chroma.db")
+@click.option("--queries", default=200)
+@click.option("--k", default=25)
+@click.option(
+    "--batch-size",
+    default=1,
+    help="Queries per search call, to measure batched search.",
+)
+@click.option("--backend", type=click.Choice(["mmap", "chroma"]), default=None)
+def bench(index_path, chroma_path, queries, k, batch_size, backend):
+    """
+    Compare search latency and memory use of the mmap index against Chroma.
+    Each backend runs in its own process so their memory use doesn't mix.
+    """
+    if backend is not None:
+        path = index_path if backend == "mmap" else chroma_path
+        print(json.dumps(_bench_backend(backend, path, queries, k, batch_size)))
+        return
+
+    for backend in ("mmap", "chroma"):
+        output = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "bench",
+                index_path,
+                "--chroma",
+                chroma_path,
+                "--queries",
+                str(queries),
+                "--k",
+                str(k),
+                "--batch-size",
+                str(batch_size),
+                "--backend",
+                backend,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{backend:>6}: load {result['load_seconds']:.2f}s, "
+            f"p50 {result['p50_ms']:.2f}ms, p95 {result['p95_ms']:.2f}ms per query, "
+            f"max RSS {result['max_rss_mb']:.0f} MB"
+        )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,124 @@
+"""
+The table of videos that chunks belong to.
+
+A chunk's metadata is just the `video_id` of its video and where in the video
+it is (`start`, `end`, `duration`). Everything else about the video - title,
+description, url, thumbnail, publishedAt, ... - is kept once per video in a
+JSON lines file, rather than being repeated in every chunk of the video, and
+loaded into memory whole.
+
+chunklines.py and pipeline.py add the videos they chunk to the table. Files
+of embedded chunks from before the table existed carry the whole video in
+each chunk; `split` moves it into the table:
+
+    python videos.py split embeddings.npy embeddings-slim.npy
+"""
+
+import json
+import os
+import threading
+
+import click
+from tqdm import tqdm
+
+import vectorfile
+from defaults import VIDEOS_PATH as DEFAULT_PATH
+
+# What each chunk keeps in its own metadata
+CHUNK_METADATA_KEYS = ("video_id", "start", "end", "duration")
+
+# What else a transcript file or old chunk metadata has that isn't the video's
+_NOT_VIDEO_KEYS = {"transcript", "chunks", "content_hash", "start", "end", "duration"}
+
+
+def video_record(video_data):
+    """A video's row in the table, from its transcript file or chunk metadata"""
+    return {
+        key: value for key, value in video_data.items() if key not in _NOT_VIDEO_KEYS
+    }
+
+
+def chunk_metadata(metadata):
+    return {key: metadata[key] for key in CHUNK_METADATA_KEYS if key in metadata}
+
+
+class VideoTable:
+    """The videos in the table at `path`, by video id. A missing file is an empty table."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.videos = {}
+        # pipeline.py adds videos on one thread and saves on another
+        self.lock = threading.Lock()
+        self.changed = False
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    video = json.loads(line)
+                    self.videos[video["video_id"]] = video
+
+    def __len__(self):
+        return len(self.videos)
+
+    def __contains__(self, video_id):
+        return video_id in self.videos
+
+    def get(self, video_id, default=None):
+        return self.videos.get(video_id, default)
+
+    def add(self, video):
+        with self.lock:
+            self.videos[video["video_id"]] = video
+            self.changed = True
+
+    def save(self):
+        """Writes the table out, if anything was added since it was last saved"""
+        with self.lock:
+            if not self.changed and os.path.exists(self.path):
+                return
+            rows = list(self.videos.values())
+            self.changed = False
+        # written to the side and moved into place, so readers never see half
+        # a table
+        partial = f"{self.path}.partial"
+        with open(partial, "w") as f:
+            for video in rows:
+                json.dump(video, f)
+                f.write("\n")
+        os.replace(partial, self.path)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("input_file")
+@click.argument("output_file")
+@click.option("--videos", "videos_path", default=DEFAULT_PATH)
+def split(input_file, output_file, videos_path):
+    """
+    Copy embedded chunks (.jsonl or .npy) from INPUT_FILE to OUTPUT_FILE with
+    only the chunk's own metadata, adding their videos to the video table.
+    """
+    table = VideoTable(videos_path)
+    before = len(table)
+    with vectorfile.open_writer(output_file) as writer, tqdm(
+        total=vectorfile.count_rows(input_file)
+    ) as progress:
+        for ids, texts, metadatas, embeddings in vectorfile.iter_batches(input_file):
+            for id, text, metadata, embedding in zip(ids, texts, metadatas, embeddings):
+                if metadata["video_id"] not in table:
+                    table.add(video_record(metadata))
+                writer.write(
+                    {"id": id, "text": text, "metadata": chunk_metadata(metadata)},
+                    embedding,
+                )
+            progress.update(len(ids))
+    table.save()
+    print(f"Added {len(table) - before} videos to {videos_path}")
+
+
+if __name__ == "__main__":
+    cli()